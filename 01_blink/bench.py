@@ -1,23 +1,16 @@
 from amaranth.sim import Simulator
 
 from soc import SOC
+from testbench import on_change
 
 soc = SOC()
 
-prev_leds = 0
-
-async def testbench(ctx):
-    global prev_leds
-    while True:
-        leds = ctx.get(soc.leds)
-        if leds != prev_leds:
-            print("LEDS = {:05b}".format(leds))
-            prev_leds = leds
-        await ctx.tick()
+def print_leds(ctx, leds):
+    print("LEDS = {:05b}".format(leds))
 
 sim = Simulator(soc)
 sim.add_clock(1e-6)
-sim.add_testbench(testbench)
+sim.add_testbench(on_change(soc.leds, print_leds))
 
 with sim.write_vcd('bench.vcd'):
     sim.run_until(2e-5)
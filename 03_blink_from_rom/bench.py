@@ -1,25 +1,16 @@
-from amaranth import *
-from amaranth.sim import *
+from amaranth.sim import Simulator
 
 from soc import SOC
+from testbench import on_change
 
 soc = SOC()
 
-sim = Simulator(soc)
-
-prev_leds = 0
-
-def proc():
-    global prev_leds
-    while True:
-        leds = yield soc.leds
-        if leds != prev_leds:
-            print("LEDS = {:05b}".format(leds))
-            prev_leds = leds
-        yield
+def print_leds(ctx, leds):
+    print("LEDS = {:05b}".format(leds))
 
+sim = Simulator(soc)
 sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+sim.add_testbench(on_change(soc.leds, print_leds))
 
 with sim.write_vcd('bench.vcd'):
     # Let's run for a quite long time
@@ -2,41 +2,34 @@ from amaranth import *
 from amaranth.sim import *
 
 from soc import SOC
+from testbench import on_change
 
 soc = SOC()
 
 sim = Simulator(soc)
 
-prev_pc = 0
-
-def proc():
-    while True:
-        global prev_pc
-        pc = yield soc.pc
-        if prev_pc != pc:
-            print("pc={}".format(pc))
-            print("instr={:#032b}".format((yield soc.instr)))
-            print("LEDS = {:05b}".format((yield soc.leds)))
-            if (yield soc.isALUreg):
-                print("ALUreg rd={} rs1={} rs2={} funct3={}".format(
-                    (yield soc.rdId), (yield soc.rs1Id), (yield soc.rs2Id),
-                    (yield soc.funct3)))
-            if (yield soc.isALUimm):
-                print("ALUimm rd={} rs1={} imm={} funct3={}".format(
-                    (yield soc.rdId), (yield soc.rs1Id), (yield soc.Iimm),
-                    (yield soc.funct3)))
-            if (yield soc.isLoad):
-                print("LOAD")
-            if (yield soc.isStore):
-                print("STORE")
-            if (yield soc.isSystem):
-                print("SYSTEM")
-                break
-        yield
-        prev_pc = pc
+def proc(ctx, pc):
+    print("pc={}".format(pc))
+    print("instr={:#032b}".format(ctx.get(soc.instr)))
+    print("LEDS = {:05b}".format(ctx.get(soc.leds)))
+    if ctx.get(soc.isALUreg):
+        print("ALUreg rd={} rs1={} rs2={} funct3={}".format(
+            ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.rs2Id),
+            ctx.get(soc.funct3)))
+    if ctx.get(soc.isALUimm):
+        print("ALUimm rd={} rs1={} imm={} funct3={}".format(
+            ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.Iimm),
+            ctx.get(soc.funct3)))
+    if ctx.get(soc.isLoad):
+        print("LOAD")
+    if ctx.get(soc.isStore):
+        print("STORE")
+    if ctx.get(soc.isSystem):
+        print("SYSTEM")
+        return True
 
 sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+sim.add_testbench(on_change(soc.pc, proc))
 
 with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
     # Let's run for a quite long time
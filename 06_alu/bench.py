@@ -2,52 +2,46 @@ from amaranth import *
 from amaranth.sim import *
 
 from soc import SOC
+from testbench import on_change
 
 soc = SOC()
 
 sim = Simulator(soc)
 
-prev_clk = 0
+# The pc changes at the end of EXECUTE, instr, rs1 and rs2 still hold the
+# instruction at the previous pc, which has just been executed
+prev_pc = 0
 
-def proc():
-    while True:
-        global prev_clk
-        clk = yield soc.slow_clk
-        if prev_clk == 0 and prev_clk != clk:
-            state = (yield soc.state)
-            if state == 2:
-                print("-- NEW CYCLE -----------------------")
-                print("  F: LEDS = {:05b}".format((yield soc.leds)))
-                print("  F: pc={}".format((yield soc.pc)))
-                print("  F: instr={:#032b}".format((yield soc.instr)))
-                if (yield soc.isALUreg):
-                    print("     ALUreg rd={} rs1={} rs2={} funct3={}".format(
-                        (yield soc.rdId), (yield soc.rs1Id), (yield soc.rs2Id),
-                        (yield soc.funct3)))
-                if (yield soc.isALUimm):
-                    print("     ALUimm rd={} rs1={} imm={} funct3={}".format(
-                        (yield soc.rdId), (yield soc.rs1Id), (yield soc.Iimm),
-                        (yield soc.funct3)))
-                if (yield soc.isLoad):
-                    print("    LOAD")
-                if (yield soc.isStore):
-                    print("    STORE")
-                if (yield soc.isSystem):
-                    print("    SYSTEM")
-                    break
-            if state == 4:
-                print("  R: LEDS = {:05b}".format((yield soc.leds)))
-                print("  R: rs1={}".format((yield soc.rs1)))
-                print("  R: rs2={}".format((yield soc.rs2)))
-            if state == 1:
-                print("  E: LEDS = {:05b}".format((yield soc.leds)))
-                print("  E: Writeback x{} = {:032b}".format((yield soc.rdId),
-                                             (yield soc.writeBackData)))
-        yield
-        prev_clk = clk
+def proc(ctx, pc):
+    global prev_pc
+    print("-- NEW INSTRUCTION -----------------")
+    print("  LEDS = {:05b}".format(ctx.get(soc.leds)))
+    print("  pc={}".format(prev_pc))
+    print("  instr={:#032b}".format(ctx.get(soc.instr)))
+    if ctx.get(soc.isALUreg):
+        print("  ALUreg rd={} rs1={} rs2={} funct3={}".format(
+            ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.rs2Id),
+            ctx.get(soc.funct3)))
+    if ctx.get(soc.isALUimm):
+        print("  ALUimm rd={} rs1={} imm={} funct3={}".format(
+            ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.Iimm),
+            ctx.get(soc.funct3)))
+    if ctx.get(soc.isLoad):
+        print("  LOAD")
+    if ctx.get(soc.isStore):
+        print("  STORE")
+    print("  rs1={} rs2={}".format(ctx.get(soc.rs1), ctx.get(soc.rs2)))
+    # The result of the ALU still depends on rs1 and rs2 only
+    if ctx.get(soc.isALUreg) or ctx.get(soc.isALUimm):
+        print("  Writeback x{} = {:032b}".format(
+            ctx.get(soc.rdId), ctx.get(soc.writeBackData)))
+    if ctx.get(soc.isSystem):
+        print("  SYSTEM")
+        return True
+    prev_pc = pc
 
 sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+sim.add_testbench(on_change(soc.pc, proc))
 
 with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
     # Let's run for a quite long time
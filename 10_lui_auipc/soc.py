@@ -1,9 +1,12 @@
+import logging
 import sys
 from amaranth import *
 
 from clockworks import Clockworks
 from riscv_assembler import RiscvAssembler
 
+log = logging.getLogger("soc")
+
 class SOC(Elaboratable):
 
     def __init__(self):
@@ -22,7 +25,7 @@ class SOC(Elaboratable):
 
         a.assemble()
         self.sequence = a.mem
-        print("memory = {}".format(self.sequence))
+        log.debug("memory = %s", self.sequence)
 
     def elaborate(self, platform):
 
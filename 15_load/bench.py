@@ -2,59 +2,49 @@ from amaranth import *
 from amaranth.sim import *
 
 from soc import SOC
+from testbench import on_change
+from log_level import set_log_level
 
+set_log_level()
 soc = SOC()
 
 sim = Simulator(soc)
 
-prev_clk = 0
+# The pc changes at the end of EXECUTE, instr, rs1 and rs2 still hold the
+# instruction at the previous pc, which has just been executed
+prev_pc = 0
 
-def proc():
+def proc(ctx, pc):
+    global prev_pc
     cpu = soc.cpu
-    mem = soc.memory
-    while True:
-        global prev_clk
-        clk = yield soc.slow_clk
-        if prev_clk == 0 and prev_clk != clk:
-            state = (yield soc.cpu.fsm.state)
-            if state == 2:
-                print("-- NEW CYCLE -----------------------")
-                print("  F: LEDS = {:05b}".format((yield soc.leds)))
-                print("  F: pc={}".format((yield cpu.pc)))
-                print("  F: instr={:#032b}".format((yield cpu.instr)))
-                if (yield cpu.isALUreg):
-                    print("     ALUreg rd={} rs1={} rs2={} funct3={}".format(
-                        (yield cpu.rdId), (yield cpu.rs1Id), (yield cpu.rs2Id),
-                        (yield cpu.funct3)))
-                if (yield cpu.isALUimm):
-                    print("     ALUimm rd={} rs1={} imm={} funct3={}".format(
-                        (yield cpu.rdId), (yield cpu.rs1Id), (yield cpu.Iimm),
-                        (yield cpu.funct3)))
-                if (yield cpu.isBranch):
-                    print("    BRANCH rs1={} rs2={}".format(
-                        (yield cpu.rs1Id), (yield cpu.rs2Id)))
-                if (yield cpu.isLoad):
-                    print("    LOAD")
-                if (yield cpu.isStore):
-                    print("    STORE")
-                if (yield cpu.isSystem):
-                    print("    SYSTEM")
-                    break
-            if state == 4:
-                print("  R: LEDS = {:05b}".format((yield soc.leds)))
-                print("  R: rs1={}".format((yield cpu.rs1)))
-                print("  R: rs2={}".format((yield cpu.rs2)))
-            if state == 1:
-                print("  E: LEDS = {:05b}".format((yield soc.leds)))
-                print("  E: Writeback x{} = {:032b}".format((yield cpu.rdId),
-                                             (yield cpu.writeBackData)))
-            if state == 8:
-                print("  NEW")
-        yield
-        prev_clk = clk
+    print("-- NEW INSTRUCTION -----------------")
+    print("  LEDS = {:05b}".format(ctx.get(soc.leds)))
+    print("  pc={}".format(prev_pc))
+    print("  instr={:#032b}".format(ctx.get(cpu.instr)))
+    if ctx.get(cpu.isALUreg):
+        print("  ALUreg rd={} rs1={} rs2={} funct3={}".format(
+            ctx.get(cpu.rdId), ctx.get(cpu.rs1Id), ctx.get(cpu.rs2Id),
+            ctx.get(cpu.funct3)))
+    if ctx.get(cpu.isALUimm):
+        print("  ALUimm rd={} rs1={} imm={} funct3={}".format(
+            ctx.get(cpu.rdId), ctx.get(cpu.rs1Id), ctx.get(cpu.Iimm),
+            ctx.get(cpu.funct3)))
+    if ctx.get(cpu.isBranch):
+        print("  BRANCH rs1={} rs2={}".format(
+            ctx.get(cpu.rs1Id), ctx.get(cpu.rs2Id)))
+    if ctx.get(cpu.isLoad):
+        print("  LOAD")
+    if ctx.get(cpu.isStore):
+        print("  STORE")
+    print("  rs1={} rs2={}".format(ctx.get(cpu.rs1), ctx.get(cpu.rs2)))
+    # The result of the ALU still depends on rs1 and rs2 only
+    if ctx.get(cpu.isALUreg) or ctx.get(cpu.isALUimm):
+        print("  Writeback x{} = {:032b}".format(
+            ctx.get(cpu.rdId), ctx.get(cpu.writeBackData)))
+    prev_pc = pc
 
 sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+sim.add_testbench(on_change(soc.cpu.pc, proc))
 
 with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
     # Let's run for a quite long time
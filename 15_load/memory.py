@@ -1,6 +1,9 @@
+import logging
 from amaranth import *
 from riscv_assembler import RiscvAssembler
 
+log = logging.getLogger("memory")
+
 class Memory(Elaboratable):
 
     def __init__(self):
@@ -29,7 +32,7 @@ class Memory(Elaboratable):
 
         a.assemble()
         self.instructions = a.mem
-        print("memory = {}".format(self.instructions))
+        log.debug("memory = %s", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem{}".format(i))
@@ -1,6 +1,9 @@
+import logging
 from amaranth import *
 from riscv_assembler import RiscvAssembler
 
+log = logging.getLogger("memory")
+
 class Memory(Elaboratable):
 
     def __init__(self):
@@ -51,7 +54,7 @@ class Memory(Elaboratable):
         while len(self.instructions) < 256:
             self.instructions.append(0)
 
-        print("memory = {}".format(self.instructions))
+        log.debug("memory = %s", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem{}".format(i))
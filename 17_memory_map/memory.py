@@ -1,12 +1,17 @@
+import logging
 from amaranth import *
 from riscv_assembler import RiscvAssembler
 
+log = logging.getLogger("memory")
+
 class Mem(Elaboratable):
 
     def __init__(self):
         a = RiscvAssembler()
 
         a.read("""begin:
+        slow_bit equ 18
+
         LI sp, 0x1800
         LI gp, 0x400000
 
@@ -39,23 +44,8 @@ class Mem(Elaboratable):
 
         EBREAK
 
-        wait:
-        LI t0, 1
-        SLLI t0, t0, 18
-
-        wait_loop:
-        ADDI t0, t0, -1
-        BNEZ t0, wait_loop
-        RET
-
-        putc:
-        SW a0, gp, 8
-        LI t0, 0x200
-        putc_loop:
-        LW t1, gp, 0x10
-        AND t1, t1, t0
-        BNEZ t1, putc_loop
-        RET
+        INCLUDE wait.s
+        INCLUDE putc.s
         """)
 
         a.assemble()
@@ -65,7 +55,7 @@ class Mem(Elaboratable):
         while len(self.instructions) < (1024 * 6 / 4):
             self.instructions.append(0)
 
-        print("memory = {}".format(self.instructions))
+        log.debug("memory = %s", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Memory(width=32, depth=len(self.instructions),
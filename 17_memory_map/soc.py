@@ -18,7 +18,10 @@ class SOC(Elaboratable):
 
     def elaborate(self, platform):
 
-        clk_frequency = int(platform.default_clk_constraint.frequency)
+        if platform is None:
+            clk_frequency = 12*1000000
+        else:
+            clk_frequency = int(platform.default_clk_constraint.frequency)
         print("clock frequency = {}".format(clk_frequency))
 
         m = Module()
@@ -35,6 +38,7 @@ class SOC(Elaboratable):
 
         self.cpu = cpu
         self.memory = memory
+        self.uart_tx = uart_tx
 
         ram_rdata = Signal(32)
         mem_wordaddr = Signal(30)
@@ -71,6 +75,7 @@ class SOC(Elaboratable):
 
         # UART
         uart_valid = Signal()
+        self.uart_valid = uart_valid
         uart_ready = Signal()
 
         m.d.comb += [
@@ -1,47 +1,117 @@
+import sys
 from amaranth import *
 from amaranth.sim import *
+from amaranth.hdl import Fragment
 from ctypes import c_int32 as int32
 
 from soc import SOC
+from testbench import uart_monitor, nop_monitor
+from log_level import set_log_level
+from waveform import Trace, WindowTrigger, PcTrigger, UartTrigger
+from checkpoint import Checkpoint
+from fastforward import FastForward
 
-soc = SOC()
+# The CPU core can be chosen on the command line, e.g.
+# python bench.py pipelined
+#
+# Instead of a full bench.vcd, a trace of the CPU bus can be written from a
+# trigger on, optionally with the cycles before it:
+# python bench.py fsm trace=bench.vcd.gz trigger=pc:0x40:0x80 length=1000
+# python bench.py fsm trace=bench.fst trigger=uart:* history=100
+# python bench.py fsm trace=bench.vcd trigger=cycle:50000
+#
+# The state of the SOC can be saved at a cycle, and a later simulation can
+# start from there:
+# python bench.py fsm checkpoint=mandelbrot.json:200000
+# python bench.py fsm restore=mandelbrot.json
+#
+# The loops waiting for the UART (putc_loop) and the timer (wait_loop) can be
+# fast-forwarded:
+# python bench.py fsm fastforward=1
+core = "fsm"
+options = {}
+for arg in sys.argv[1:]:
+    if "=" in arg:
+        key, value = arg.split("=", 1)
+        options[key] = value
+    else:
+        core = arg
 
-sim = Simulator(soc)
+set_log_level()
+soc = SOC(core=core)
 
-def proc():
+fragment = Fragment.get(soc, None)
+checkpoint = Checkpoint(fragment)
+
+sim = Simulator(fragment)
+
+n_nops = 0
+
+def print_regs(ctx, pc):
+    global n_nops
     cpu = soc.cpu
-    mem = soc.memory
-    prev_pc = 0
-    n_nops = 0
-    while True:
-        pc = yield cpu.pc
-        uart_valid = (yield soc.uart_valid)
-        if uart_valid:
-            print("out: '{}'".format(chr((yield soc.mem_wdata[0:8]))))
-        rdata = (yield mem.mem_rdata)
-        if prev_pc != pc:
-            prev_pc = pc
-            if rdata == 0b00000000000000000000000000110011:
-                print("NOP {:03d}: pc=0x{:04x}={:4d}".format(n_nops, pc, pc))
-                n_nops += 1
-                for i in range(5):
-                    reg = (yield cpu.regs[10 + i])
-                    regi = int32(reg).value
-                    print("   a{} = {}={}".format(i, regi, hex(reg)))
-                for i in range(2):
-                    reg = (yield cpu.regs[8 + i])
-                    regi = int32(reg).value
-                    print("   s{} = {}={}".format(i, regi, hex(reg)))
-                for i in range(0,10):
-                    reg = (yield cpu.regs[18 + i])
-                    regi = int32(reg).value
-                    print("   s{} = {}={}".format(i+2, regi, hex(reg)))
-
-        yield
+    print("NOP {:03d}: pc=0x{:04x}={:4d}".format(n_nops, pc, pc))
+    n_nops += 1
+    for i in range(5):
+        reg = ctx.get(cpu.regs[10 + i])
+        regi = int32(reg).value
+        print("   a{} = {}={}".format(i, regi, hex(reg)))
+    for i in range(2):
+        reg = ctx.get(cpu.regs[8 + i])
+        regi = int32(reg).value
+        print("   s{} = {}={}".format(i, regi, hex(reg)))
+    for i in range(0,10):
+        reg = ctx.get(cpu.regs[18 + i])
+        regi = int32(reg).value
+        print("   s{} = {}={}".format(i+2, regi, hex(reg)))
+
+def make_trigger(spec):
+    kind, *args = spec.split(":")
+    if kind == "pc":
+        return PcTrigger(soc.cpu.pc, int(args[0], 0), int(args[1], 0))
+    elif kind == "uart":
+        return UartTrigger(soc, None if args[0] == "*" else args[0])
+    elif kind == "cycle":
+        return WindowTrigger(int(args[0]))
+    print("Unknown trigger '{}'".format(spec))
+    exit(1)
+
+async def checkpoints(ctx):
+    cycle = 0
+    if "restore" in options:
+        cycle = checkpoint.restore(ctx, options["restore"])
+    if "checkpoint" in options:
+        filename, at = options["checkpoint"].rsplit(":", 1)
+        await ctx.tick("slow").repeat(int(at) - cycle)
+        checkpoint.save(ctx, filename, int(at))
 
 sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+sim.add_testbench(uart_monitor(soc))
+sim.add_testbench(nop_monitor(soc, print_regs))
+sim.add_testbench(checkpoints)
+
+fastforward = None
+if options.get("fastforward", "0") != "0":
+    fastforward = FastForward(soc, checkpoint)
+    sim.add_testbench(fastforward.testbench)
 
-with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
-    # Let's run for a quite long time
+if "trace" in options:
+    cpu = soc.cpu
+    trace = Trace(options["trace"],
+                  [cpu.pc, cpu.mem_addr, cpu.mem_rdata, cpu.mem_rstrb,
+                   cpu.mem_wdata, cpu.mem_wmask, soc.uart_valid, soc.leds],
+                  trigger=make_trigger(options["trigger"])
+                      if "trigger" in options else None,
+                  length=int(options["length"])
+                      if "length" in options else None,
+                  history=int(options.get("history", 0)))
+    sim.add_testbench(trace.testbench)
     sim.run_until(2, )
+    trace.close()
+else:
+    with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
+        # Let's run for a quite long time
+        sim.run_until(2, )
+
+if fastforward is not None:
+    print("fast-forward: {} cycles skipped".format(fastforward.skipped))
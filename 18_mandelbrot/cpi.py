@@ -0,0 +1,78 @@
+import sys
+import inspect
+from amaranth import *
+from amaranth.sim import *
+
+from soc import SOC, cores
+from log_level import set_log_level
+from options import bool_option
+
+# Run the Mandelbrot firmware on each of the CPU cores for the same number of
+# cycles and report the average number of cycles per instruction (CPI).
+# With 'rv32m', the cores and the firmware use the RV32M extension. Other
+# options ('early_regs', 'regfile=memory', ...) are given to the cores that
+# support them.
+#
+# python cpi.py [n_cycles] [core ...] [rv32m] [option[=value] ...]
+
+set_log_level()
+
+n_cycles = 100000
+selected = []
+options = {}
+for arg in sys.argv[1:]:
+    if arg.isdigit():
+        n_cycles = int(arg)
+    elif arg in cores:
+        selected.append(arg)
+    elif "=" in arg:
+        key, value = arg.split("=", 1)
+        options[key] = value
+    else:
+        options[arg] = True
+if not selected:
+    selected = list(cores.keys())
+rv32m = bool_option("rv32m", options.get("rv32m", False))
+
+def core_options(core):
+    accepted = inspect.signature(cores[core]).parameters
+    return {k: v for k, v in options.items() if k in accepted}
+
+def measure(core):
+    soc = SOC(core=core, **core_options(core))
+    sim = Simulator(soc)
+    result = {}
+
+    async def testbench(ctx):
+        n_instr = 0
+        n_chars = 0
+        for i in range(n_cycles):
+            await ctx.tick("slow")
+            if ctx.get(soc.cpu.retire):
+                n_instr += 1
+            if ctx.get(soc.uart_valid):
+                n_chars += 1
+        result["instructions"] = n_instr
+        result["chars"] = n_chars
+
+    sim.add_clock(1e-6)
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return result
+
+results = {}
+for core in selected:
+    results[core] = measure(core)
+
+print("")
+print("RV32M: {}".format("ON" if rv32m else "OFF"))
+for core in selected:
+    print("{} options: {}".format(core, core_options(core)))
+print("{:12} {:>10} {:>14} {:>8} {:>8}".format(
+    "core", "cycles", "instructions", "CPI", "chars"))
+for core, result in results.items():
+    n_instr = result["instructions"]
+    cpi = n_cycles / n_instr if n_instr else float("inf")
+    print("{:12} {:>10} {:>14} {:>8.3f} {:>8}".format(
+        core, n_cycles, n_instr, cpi, result["chars"]))
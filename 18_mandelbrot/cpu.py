@@ -1,15 +1,46 @@
 from amaranth import *
 
+from muldiv import MulDiv
+from regfile import RegisterFile
+from csr import CSR
+from options import bool_option
+
 class CPU(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, rv32m=False, regfile="array", zicsr=False,
+                 early_regs=False):
+        # Include the RV32M multiply / divide unit
+        self.rv32m = bool_option("rv32m", rv32m)
+        # Register bank in flip-flops ("array") or in a memory ("memory")
+        self.regfile = regfile
+        # Include the Zicsr extension with the cycle, time and instret
+        # counters
+        self.zicsr = bool_option("zicsr", zicsr)
+        # Read the registers in WAIT_INSTR, without the FETCH_REGS state
+        self.early_regs = bool_option("early_regs", early_regs)
+
         self.mem_addr = Signal(32)
         self.mem_rstrb = Signal()
         self.mem_rdata = Signal(32)
         self.mem_wdata = Signal(32)
         self.mem_wmask = Signal(4)
         self.x10 = Signal(32)
+        self.retire = Signal()
         self.fsm = None
+        # Wall clock for the time CSR
+        self.time = Signal(64)
+
+        # Events for the performance counters of the SOC, set for one cycle
+        # per executed instruction
+        self.branch_taken = Signal()
+        self.branch_not_taken = Signal()
+        self.loads = Signal()
+        self.stores = Signal()
+        # Cycles spent in the states waiting for the memory
+        self.wait_instr_cycles = Signal()
+        self.load_cycles = Signal()
+        self.wait_data_cycles = Signal()
+        self.store_cycles = Signal()
 
     def elaborate(self, platform):
         m = Module()
@@ -26,10 +57,18 @@ class CPU(Elaboratable):
         self.instr = instr
 
         # Register bank
-        regs = Array([Signal(32, name="x"+str(x)) for x in range(32)])
+        # As a memory, the registers are read in FETCH_REGS and the read
+        # ports keep rs1 and rs2 until the next instruction.
+        if self.regfile == "memory":
+            regfile = m.submodules.regfile = RegisterFile(read_domain="sync")
+            regs = regfile.mem
+            rs1 = regfile.rs1
+            rs2 = regfile.rs2
+        else:
+            regs = Array([Signal(32, name="x"+str(x)) for x in range(32)])
+            rs1 = Signal(32)
+            rs2 = Signal(32)
         self.regs = regs
-        rs1 = Signal(32)
-        rs2 = Signal(32)
 
         # ALU registers
         aluOut = Signal(32)
@@ -152,6 +191,33 @@ class CPU(Elaboratable):
             with m.Case(0b111):
                 m.d.comb += aluOut.eq(aluIn1 & aluIn2)
 
+        # RV32M extension
+        isMulDiv = Signal()
+        isDiv = Signal()
+        if self.rv32m:
+            muldiv = m.submodules.muldiv = MulDiv()
+            m.d.comb += [
+                isMulDiv.eq(isALUreg & (funct7 == 0b0000001)),
+                isDiv.eq(isMulDiv & muldiv.isDiv),
+                muldiv.op1.eq(rs1),
+                muldiv.op2.eq(rs2),
+                muldiv.funct3.eq(funct3)
+            ]
+
+        # Zicsr: CSR instructions read the counters, the other system
+        # instructions (EBREAK, ECALL) halt the CPU.
+        isCSR = Signal()
+        isHalt = Signal()
+        m.d.comb += isHalt.eq(isSystem & ~isCSR)
+        if self.zicsr:
+            csr = m.submodules.csr = CSR()
+            m.d.comb += [
+                isCSR.eq(isSystem & (funct3 != 0)),
+                csr.addr.eq(instr[20:32]),
+                csr.retire.eq(self.retire),
+                csr.time.eq(self.time)
+            ]
+
         with m.Switch(funct3) as alu_branch:
             with m.Case(0b000):
                 m.d.comb += takeBranch.eq(EQ)
@@ -186,22 +252,46 @@ class CPU(Elaboratable):
                 m.next = "WAIT_INSTR"
             with m.State("WAIT_INSTR"):
                 m.d.sync += instr.eq(self.mem_rdata)
-                m.next = ("FETCH_REGS")
-            with m.State("FETCH_REGS"):
-                m.d.sync += [
-                    rs1.eq(regs[rs1Id]),
-                    rs2.eq(regs[rs2Id])
-                ]
-                m.next = "EXECUTE"
+                if self.early_regs:
+                    # The register ids are taken directly from the
+                    # instruction on the memory output, so the registers
+                    # are there in EXECUTE.
+                    if self.regfile == "memory":
+                        m.d.comb += regfile.ren.eq(1)
+                    else:
+                        m.d.sync += [
+                            rs1.eq(regs[mem_rdata[15:20]]),
+                            rs2.eq(regs[mem_rdata[20:25]])
+                        ]
+                    m.next = "EXECUTE"
+                else:
+                    m.next = "FETCH_REGS"
+            if not self.early_regs:
+                with m.State("FETCH_REGS"):
+                    if self.regfile == "memory":
+                        m.d.comb += regfile.ren.eq(1)
+                    else:
+                        m.d.sync += [
+                            rs1.eq(regs[rs1Id]),
+                            rs2.eq(regs[rs2Id])
+                        ]
+                    m.next = "EXECUTE"
             with m.State("EXECUTE"):
-                with m.If(~isSystem):
+                with m.If(~isHalt):
                     m.d.sync += pc.eq(nextPc)
                 with m.If(isLoad):
                     m.next = "LOAD"
                 with m.Elif(isStore):
                     m.next = "STORE"
+                if self.rv32m:
+                    with m.Elif(isDiv):
+                        m.next = "WAIT_DIV"
                 with m.Else():
                     m.next = "FETCH_INSTR"
+            if self.rv32m:
+                with m.State("WAIT_DIV"):
+                    with m.If(~muldiv.busy):
+                        m.next = "FETCH_INSTR"
             with m.State("LOAD"):
                 m.next = "WAIT_DATA"
             with m.State("WAIT_DATA"):
@@ -280,14 +370,58 @@ class CPU(Elaboratable):
                                     Mux(isLoad, loadData,
                                     aluOut))))
 
-        writeBackEn = ((fsm.ongoing("EXECUTE") & ~isBranch & ~isStore & ~isLoad)
+        writeBackEn = ((fsm.ongoing("EXECUTE") & ~isBranch & ~isStore & ~isLoad
+                        & ~isDiv)
                        | fsm.ongoing("WAIT_DATA"))
 
+        # The multiplication result is there right away, the division is
+        # started in EXECUTE and written back at the end of WAIT_DIV.
+        if self.rv32m:
+            m.d.comb += muldiv.start.eq(fsm.ongoing("EXECUTE") & isDiv)
+            writeBackData = Mux(isMulDiv, muldiv.result, writeBackData)
+            writeBackEn = writeBackEn | (fsm.ongoing("WAIT_DIV") & ~muldiv.busy)
+
+        if self.zicsr:
+            writeBackData = Mux(isCSR, csr.rdata, writeBackData)
+
         self.writeBackData = writeBackData
 
+        # An instruction is done when it leaves EXECUTE
+        m.d.comb += self.retire.eq(fsm.ongoing("EXECUTE") & ~isHalt)
+
+        # Performance counter events
+        execute = fsm.ongoing("EXECUTE")
+        m.d.comb += [
+            self.branch_taken.eq(execute & isBranch & takeBranch[0]),
+            self.branch_not_taken.eq(execute & isBranch & ~takeBranch[0]),
+            self.loads.eq(execute & isLoad),
+            self.stores.eq(execute & isStore),
+            self.wait_instr_cycles.eq(fsm.ongoing("WAIT_INSTR")),
+            self.load_cycles.eq(fsm.ongoing("LOAD")),
+            self.wait_data_cycles.eq(fsm.ongoing("WAIT_DATA")),
+            self.store_cycles.eq(fsm.ongoing("STORE"))
+        ]
+
+        if self.regfile == "memory":
+            if self.early_regs:
+                m.d.comb += [
+                    regfile.rs1Id.eq(mem_rdata[15:20]),
+                    regfile.rs2Id.eq(mem_rdata[20:25])
+                ]
+            else:
+                m.d.comb += [
+                    regfile.rs1Id.eq(rs1Id),
+                    regfile.rs2Id.eq(rs2Id)
+                ]
+            m.d.comb += [
+                regfile.rdId.eq(rdId),
+                regfile.wdata.eq(writeBackData),
+                regfile.wen.eq(writeBackEn)
+            ]
 
         with m.If(writeBackEn & (rdId != 0)):
-            m.d.sync += regs[rdId].eq(writeBackData)
+            if self.regfile != "memory":
+                m.d.sync += regs[rdId].eq(writeBackData)
             # Also assign to debug output to see what is happening
             with m.If(rdId == 10):
                 m.d.sync += self.x10.eq(writeBackData)
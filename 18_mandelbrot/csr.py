@@ -0,0 +1,54 @@
+from amaranth import *
+
+# Read-only counters of the Zicsr / Zicntr extensions, as used by RDCYCLE,
+# RDTIME and RDINSTRET (and the ...H variants for the upper 32 bits).
+#
+# 'cycle' counts the clock cycles of the CPU, 'instret' the retired
+# instructions. 'time' is a wall clock counter which is provided by the SOC.
+# Writes are ignored, other CSRs read as 0.
+
+CSR_CYCLE    = 0xC00
+CSR_TIME     = 0xC01
+CSR_INSTRET  = 0xC02
+CSR_CYCLEH   = 0xC80
+CSR_TIMEH    = 0xC81
+CSR_INSTRETH = 0xC82
+
+class CSR(Elaboratable):
+
+    def __init__(self):
+        # Inputs
+        self.addr = Signal(12)
+        self.retire = Signal()
+        self.time = Signal(64)
+
+        # Outputs
+        self.rdata = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        cycle = Signal(64)
+        instret = Signal(64)
+        self.cycle = cycle
+        self.instret = instret
+
+        m.d.sync += cycle.eq(cycle + 1)
+        with m.If(self.retire):
+            m.d.sync += instret.eq(instret + 1)
+
+        with m.Switch(self.addr):
+            with m.Case(CSR_CYCLE):
+                m.d.comb += self.rdata.eq(cycle[0:32])
+            with m.Case(CSR_TIME):
+                m.d.comb += self.rdata.eq(self.time[0:32])
+            with m.Case(CSR_INSTRET):
+                m.d.comb += self.rdata.eq(instret[0:32])
+            with m.Case(CSR_CYCLEH):
+                m.d.comb += self.rdata.eq(cycle[32:64])
+            with m.Case(CSR_TIMEH):
+                m.d.comb += self.rdata.eq(self.time[32:64])
+            with m.Case(CSR_INSTRETH):
+                m.d.comb += self.rdata.eq(instret[32:64])
+
+        return m
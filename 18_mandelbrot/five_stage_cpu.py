@@ -0,0 +1,546 @@
+from amaranth import *
+
+from muldiv import MulDiv
+from regfile import RegisterFile
+from csr import CSR
+from options import bool_option
+
+# A classic five stage pipelined variant of the CPU in cpu.py.
+#
+# F: the address of the next instruction is put on the memory bus
+# D: the instruction arrives from the memory, the registers are read
+# E: ALU, branch resolution and load/store address computation
+# M: loads and stores access the memory
+# W: the result is written back to the register bank
+#
+# Results are forwarded from M and W to E, and from W to D. A load followed
+# by an instruction that uses the loaded register stalls F and D for one
+# cycle. Branches are predicted not taken, a taken branch or jump flushes
+# D and the instruction being fetched (two cycles penalty).
+#
+# Instructions and data share the single memory port, so a load or store in
+# M delays the fetch by one cycle.
+#
+# With the RV32M extension, multiplications are done in E, divisions hold E
+# (and everything before it) until the divider is done.
+#
+# The memory interface is the same as the one of the CPU in cpu.py.
+
+class FiveStageCPU(Elaboratable):
+
+    def __init__(self, rv32m=False, regfile="array", zicsr=False):
+        # Include the RV32M multiply / divide unit
+        self.rv32m = bool_option("rv32m", rv32m)
+        # Register bank in flip-flops ("array") or in a memory ("memory")
+        self.regfile = regfile
+        # Include the Zicsr extension with the cycle, time and instret
+        # counters
+        self.zicsr = bool_option("zicsr", zicsr)
+
+        self.mem_addr = Signal(32)
+        self.mem_rstrb = Signal()
+        self.mem_rdata = Signal(32)
+        self.mem_wdata = Signal(32)
+        self.mem_wmask = Signal(4)
+        self.x10 = Signal(32)
+        self.retire = Signal()
+        self.fsm = None
+        # Wall clock for the time CSR
+        self.time = Signal(64)
+
+        # Events for the performance counters of the SOC, set for one cycle
+        # per executed instruction
+        self.branch_taken = Signal()
+        self.branch_not_taken = Signal()
+        self.loads = Signal()
+        self.stores = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Memory
+        mem_rdata = self.mem_rdata
+
+        # Register bank
+        # As a memory, the registers are read asynchronously in D (LUT RAM).
+        if self.regfile == "memory":
+            regfile = m.submodules.regfile = RegisterFile(read_domain="comb")
+            regs = regfile.mem
+        else:
+            regs = Array([Signal(32, name="x"+str(x)) for x in range(32)])
+        self.regs = regs
+
+        # Extend a signal with a sign bit repeated n times
+        def SignExtend(signal, sign, n):
+            return Cat(signal, sign.replicate(n))
+
+        def flip32(x):
+            a = [x[i] for i in range(0, 32)]
+            return Cat(*reversed(a))
+
+        # Pipeline registers
+        # F -> D
+        f_pc = Signal(32)
+        d_valid = Signal()
+        d_pc = Signal(32)
+        d_fresh = Signal()
+        d_hold = Signal(32)
+
+        # D -> E
+        e_valid = Signal()
+        e_pc = Signal(32)
+        e_instr = Signal(32, init=0b0110011)
+        e_rs1 = Signal(32)
+        e_rs2 = Signal(32)
+
+        # E -> M
+        m_valid = Signal()
+        m_isLoad = Signal()
+        m_isStore = Signal()
+        m_writes = Signal()
+        m_rdId = Signal(5)
+        m_result = Signal(32)
+        m_addr = Signal(32)
+        m_wdata = Signal(32)
+        m_wmask = Signal(4)
+        m_funct3 = Signal(3)
+
+        # M -> W
+        w_valid = Signal()
+        w_isLoad = Signal()
+        w_writes = Signal()
+        w_rdId = Signal(5)
+        w_result = Signal(32)
+        w_addr = Signal(2)
+        w_funct3 = Signal(3)
+
+        # The program counter of the instruction being executed
+        self.pc = e_pc
+        self.instr = e_instr
+
+        # Hazard and control signals
+        stall = Signal()
+        halt = Signal()
+        hold = Signal()
+        flush = Signal()
+        fetch = Signal()
+        memBusy = Signal()
+        nextPc = Signal(32)
+
+        ## W: write back
+
+        # Load
+        memByteAccess = Signal()
+        memHalfwordAccess = Signal()
+        loadHalfword = Signal(16)
+        loadByte = Signal(8)
+        loadSign = Signal()
+        loadData = Signal(32)
+
+        m.d.comb += [
+            memByteAccess.eq(w_funct3[0:2] == C(0,2)),
+            memHalfwordAccess.eq(w_funct3[0:2] == C(1,2)),
+            loadHalfword.eq(Mux(w_addr[1], mem_rdata[16:32],
+                                mem_rdata[0:16])),
+            loadByte.eq(Mux(w_addr[0], loadHalfword[8:16],
+                            loadHalfword[0:8])),
+            loadSign.eq(~w_funct3[2] & Mux(memByteAccess, loadByte[7],
+                                           loadHalfword[15])),
+            loadData.eq(
+                Mux(memByteAccess, SignExtend(loadByte, loadSign, 24),
+                    Mux(memHalfwordAccess, SignExtend(loadHalfword,
+                                                      loadSign, 16),
+                        mem_rdata)))
+        ]
+
+        writeBackData = Signal(32)
+        writeBackEn = Signal()
+        m.d.comb += [
+            writeBackData.eq(Mux(w_isLoad, loadData, w_result)),
+            writeBackEn.eq(w_valid & w_writes),
+            self.retire.eq(w_valid)
+        ]
+        self.writeBackData = writeBackData
+
+        if self.regfile == "memory":
+            m.d.comb += [
+                regfile.rdId.eq(w_rdId),
+                regfile.wdata.eq(writeBackData),
+                regfile.wen.eq(writeBackEn)
+            ]
+
+        with m.If(writeBackEn):
+            if self.regfile != "memory":
+                m.d.sync += regs[w_rdId].eq(writeBackData)
+            # Also assign to debug output to see what is happening
+            with m.If(w_rdId == 10):
+                m.d.sync += self.x10.eq(writeBackData)
+
+        ## F: fetch
+
+        # The memory port is used by loads and stores in M, the fetch has to
+        # wait then.
+        m.d.comb += [
+            memBusy.eq(m_valid & (m_isLoad | m_isStore)),
+            fetch.eq(~memBusy & ~stall & ~hold)
+        ]
+
+        with m.If(flush):
+            m.d.sync += f_pc.eq(nextPc)
+        with m.Elif(fetch):
+            m.d.sync += f_pc.eq(f_pc + 4)
+
+        ## D: decode and register read
+
+        # The instruction is on the memory output in the cycle after the
+        # fetch, in later cycles (when D is stalled) the copy is used.
+        d_instr = Signal(32)
+        m.d.comb += d_instr.eq(Mux(d_fresh, mem_rdata, d_hold))
+        m.d.sync += d_hold.eq(d_instr)
+
+        d_rs1Id = d_instr[15:20]
+        d_rs2Id = d_instr[20:25]
+
+        # Register read, with the value being written back in this cycle
+        # bypassed.
+        d_rs1 = Signal(32)
+        d_rs2 = Signal(32)
+        if self.regfile == "memory":
+            m.d.comb += [
+                regfile.rs1Id.eq(d_rs1Id),
+                regfile.rs2Id.eq(d_rs2Id)
+            ]
+            d_rs1Reg = regfile.rs1
+            d_rs2Reg = regfile.rs2
+        else:
+            d_rs1Reg = regs[d_rs1Id]
+            d_rs2Reg = regs[d_rs2Id]
+        m.d.comb += [
+            d_rs1.eq(Mux(writeBackEn & (w_rdId == d_rs1Id), writeBackData,
+                         d_rs1Reg)),
+            d_rs2.eq(Mux(writeBackEn & (w_rdId == d_rs2Id), writeBackData,
+                         d_rs2Reg))
+        ]
+
+        with m.If(flush):
+            m.d.sync += [
+                d_valid.eq(0),
+                d_fresh.eq(0)
+            ]
+        with m.Elif(fetch):
+            m.d.sync += [
+                d_valid.eq(1),
+                d_fresh.eq(1),
+                d_pc.eq(f_pc)
+            ]
+        with m.Elif(stall | hold):
+            m.d.sync += d_fresh.eq(0)
+        with m.Else():
+            m.d.sync += [
+                d_valid.eq(0),
+                d_fresh.eq(0)
+            ]
+
+        ## E: execute
+
+        instr = e_instr
+
+        # Opcode decoder
+        isALUreg = Signal()
+        isALUimm = Signal()
+        isBranch = Signal()
+        isJALR   = Signal()
+        isJAL    = Signal()
+        isAUIPC  = Signal()
+        isLUI    = Signal()
+        isLoad   = Signal()
+        isStore  = Signal()
+        isSystem = Signal()
+        m.d.comb += [
+            isALUreg.eq(instr[0:7] == 0b0110011),
+            isALUimm.eq(instr[0:7] == 0b0010011),
+            isBranch.eq(instr[0:7] == 0b1100011),
+            isJALR.eq(instr[0:7] == 0b1100111),
+            isJAL.eq(instr[0:7] == 0b1101111),
+            isAUIPC.eq(instr[0:7] == 0b0010111),
+            isLUI.eq(instr[0:7] == 0b0110111),
+            isLoad.eq(instr[0:7] == 0b0000011),
+            isStore.eq(instr[0:7] == 0b0100011),
+            isSystem.eq(instr[0:7] == 0b1110011)
+        ]
+        self.isALUreg = isALUreg
+        self.isALUimm = isALUimm
+        self.isBranch = isBranch
+        self.isLoad = isLoad
+        self.isStore = isStore
+        self.isSystem = isSystem
+
+        # Immediate format decoder
+        Uimm = Signal(32)
+        Iimm = Signal(32)
+        Simm = Signal(32)
+        Bimm = Signal(32)
+        Jimm = Signal(32)
+        m.d.comb += [
+            Uimm.eq(Cat(Const(0).replicate(12), instr[12:32])),
+            Iimm.eq(Cat(instr[20:31], instr[31].replicate(21))),
+            Simm.eq(Cat(instr[7:12], instr[25:31], instr[31].replicate(21))),
+            Bimm.eq(Cat(0, instr[8:12], instr[25:31], instr[7],
+                instr[31].replicate(20))),
+            Jimm.eq(Cat(0, instr[21:31], instr[20], instr[12:20],
+                instr[31].replicate(12)))
+        ]
+        self.Iimm = Iimm
+
+        # Register addresses decoder
+        rs1Id = instr[15:20]
+        rs2Id = instr[20:25]
+        rdId = instr[7:12]
+
+        self.rdId = rdId
+        self.rs1Id = rs1Id
+        self.rs2Id = rs2Id
+
+        # Function code decoder
+        funct3 = instr[12:15]
+        funct7 = instr[25:32]
+        self.funct3 = funct3
+
+        # Forwarding from M (not for loads, see the load-use stall below)
+        # and from W.
+        rs1 = Signal(32)
+        rs2 = Signal(32)
+        m.d.comb += [
+            rs1.eq(Mux(m_valid & m_writes & ~m_isLoad & (m_rdId == rs1Id),
+                       m_result,
+                       Mux(writeBackEn & (w_rdId == rs1Id), writeBackData,
+                           e_rs1))),
+            rs2.eq(Mux(m_valid & m_writes & ~m_isLoad & (m_rdId == rs2Id),
+                       m_result,
+                       Mux(writeBackEn & (w_rdId == rs2Id), writeBackData,
+                           e_rs2)))
+        ]
+
+        # ALU
+        aluOut = Signal(32)
+        takeBranch = Signal()
+        aluIn1 = Signal.like(rs1)
+        aluIn2 = Signal.like(rs2)
+        aluMinus = Signal(33)
+        aluPlus = Signal.like(aluIn1)
+
+        m.d.comb += [
+            aluIn1.eq(rs1),
+            aluIn2.eq(Mux((isALUreg | isBranch), rs2, Iimm)),
+        ]
+
+        m.d.comb += [
+            aluMinus.eq(Cat(~aluIn2, C(1,1)) + Cat(aluIn1, C(0,1)) + 1),
+            aluPlus.eq(aluIn1 + aluIn2)
+        ]
+
+        EQ = aluMinus[0:32] == 0
+        LTU = aluMinus[32]
+        LT = Mux((aluIn1[31] ^ aluIn2[31]), aluIn1[31], aluMinus[32])
+
+        shifter_in = Mux(funct3 == 0b001, flip32(aluIn1), aluIn1)
+        shifter = (Cat(shifter_in,
+                       (instr[30] & aluIn1[31]))).as_signed() >> aluIn2[0:5]
+        leftshift = flip32(shifter)
+
+        with m.Switch(funct3) as alu:
+            with m.Case(0b000):
+                m.d.comb += aluOut.eq(Mux(funct7[5] & instr[5],
+                                          aluMinus[0:32], aluPlus))
+            with m.Case(0b001):
+                m.d.comb += aluOut.eq(leftshift)
+            with m.Case(0b010):
+                m.d.comb += aluOut.eq(LT)
+            with m.Case(0b011):
+                m.d.comb += aluOut.eq(LTU)
+            with m.Case(0b100):
+                m.d.comb += aluOut.eq(aluIn1 ^ aluIn2)
+            with m.Case(0b101):
+                m.d.comb += aluOut.eq(shifter)
+            with m.Case(0b110):
+                m.d.comb += aluOut.eq(aluIn1 | aluIn2)
+            with m.Case(0b111):
+                m.d.comb += aluOut.eq(aluIn1 & aluIn2)
+
+        # RV32M extension
+        isMulDiv = Signal()
+        isDiv = Signal()
+        divWait = Signal()
+        if self.rv32m:
+            muldiv = m.submodules.muldiv = MulDiv()
+            divActive = Signal()
+            m.d.comb += [
+                isMulDiv.eq(isALUreg & (funct7 == 0b0000001)),
+                isDiv.eq(isMulDiv & muldiv.isDiv),
+                muldiv.op1.eq(rs1),
+                muldiv.op2.eq(rs2),
+                muldiv.funct3.eq(funct3),
+                # The division is started when it enters E, E is held until
+                # the result is there.
+                muldiv.start.eq(e_valid & isDiv & ~divActive),
+                divWait.eq(e_valid & isDiv & (~divActive | muldiv.busy))
+            ]
+            with m.If(muldiv.start):
+                m.d.sync += divActive.eq(1)
+            with m.Elif(~divWait):
+                m.d.sync += divActive.eq(0)
+
+        # Zicsr: CSR instructions read the counters, the other system
+        # instructions (EBREAK, ECALL) halt the CPU. The counters are read
+        # in E, instret does not include the instructions in M and W yet.
+        isCSR = Signal()
+        isHalt = Signal()
+        m.d.comb += isHalt.eq(isSystem & ~isCSR)
+        if self.zicsr:
+            csr = m.submodules.csr = CSR()
+            m.d.comb += [
+                isCSR.eq(isSystem & (funct3 != 0)),
+                csr.addr.eq(instr[20:32]),
+                csr.retire.eq(self.retire),
+                csr.time.eq(self.time)
+            ]
+
+        with m.Switch(funct3) as alu_branch:
+            with m.Case(0b000):
+                m.d.comb += takeBranch.eq(EQ)
+            with m.Case(0b001):
+                m.d.comb += takeBranch.eq(~EQ)
+            with m.Case(0b100):
+                m.d.comb += takeBranch.eq(LT)
+            with m.Case(0b101):
+                m.d.comb += takeBranch.eq(~LT)
+            with m.Case(0b110):
+                m.d.comb += takeBranch.eq(LTU)
+            with m.Case(0b111):
+                m.d.comb += takeBranch.eq(~LTU)
+            with m.Case("---"):
+                m.d.comb += takeBranch.eq(0)
+
+        # Branch resolution. The pipeline keeps fetching sequentially, so
+        # taken branches and jumps have to flush the wrong path.
+        pc = e_pc
+        pcPlusImm = pc + Mux(instr[3], Jimm[0:32],
+                             Mux(instr[4], Uimm[0:32],
+                                 Bimm[0:32]))
+        pcPlus4 = pc + 4
+
+        m.d.comb += [
+            nextPc.eq(Mux(isJALR, Cat(C(0, 1), aluPlus[1:32]), pcPlusImm)),
+            flush.eq(e_valid & ((isBranch & takeBranch) | isJAL | isJALR))
+        ]
+
+        # An EBREAK (or any other system instruction but CSR instructions)
+        # stops the pipeline
+        m.d.comb += [
+            halt.eq(e_valid & isHalt),
+            hold.eq(halt | divWait)
+        ]
+
+        # Load-use hazard: the instruction in D needs the result of the load
+        # in E, which is only available in W.
+        m.d.comb += stall.eq(d_valid & e_valid & isLoad & (rdId != 0) &
+                             ((rdId == d_rs1Id) | (rdId == d_rs2Id)))
+
+        # Load and store
+        loadStoreAddr = Signal(32)
+        m.d.comb += loadStoreAddr.eq(rs1 + Mux(isStore, Simm, Iimm))
+
+        storeByteAccess = funct3[0:2] == C(0,2)
+        storeHalfwordAccess = funct3[0:2] == C(1,2)
+
+        store_wdata = Signal(32)
+        m.d.comb += [
+            store_wdata[ 0: 8].eq(rs2[0:8]),
+            store_wdata[ 8:16].eq(
+                Mux(loadStoreAddr[0], rs2[0:8], rs2[8:16])),
+            store_wdata[16:24].eq(
+                Mux(loadStoreAddr[1], rs2[0:8], rs2[16:24])),
+            store_wdata[24:32].eq(
+                Mux(loadStoreAddr[0], rs2[0:8],
+                    Mux(loadStoreAddr[1], rs2[8:16], rs2[24:32])))
+        ]
+
+        store_wmask = Signal(4)
+        m.d.comb += store_wmask.eq(
+                Mux(storeByteAccess,
+                    Mux(loadStoreAddr[1],
+                        Mux(loadStoreAddr[0], 0b1000, 0b0100),
+                        Mux(loadStoreAddr[0], 0b0010, 0b0001)
+                        ),
+                    Mux(storeHalfwordAccess,
+                        Mux(loadStoreAddr[1], 0b1100, 0b0011),
+                        0b1111)
+                    )
+                )
+
+        result = Mux((isJAL | isJALR), pcPlus4,
+                     Mux(isLUI, Uimm,
+                         Mux(isAUIPC, pcPlusImm,
+                             aluOut)))
+        if self.rv32m:
+            result = Mux(isMulDiv, muldiv.result, result)
+        if self.zicsr:
+            result = Mux(isCSR, csr.rdata, result)
+
+        # D -> E
+        with m.If(hold):
+            pass
+        with m.Elif(flush | stall):
+            m.d.sync += e_valid.eq(0)
+        with m.Else():
+            m.d.sync += [
+                e_valid.eq(d_valid),
+                e_pc.eq(d_pc),
+                e_instr.eq(d_instr),
+                e_rs1.eq(d_rs1),
+                e_rs2.eq(d_rs2)
+            ]
+
+        # Performance counter events, instructions are counted in E
+        m.d.comb += [
+            self.branch_taken.eq(e_valid & isBranch & takeBranch),
+            self.branch_not_taken.eq(e_valid & isBranch & ~takeBranch),
+            self.loads.eq(e_valid & isLoad),
+            self.stores.eq(e_valid & isStore)
+        ]
+
+        # E -> M
+        m.d.sync += [
+            m_valid.eq(e_valid & ~isHalt & ~divWait),
+            m_isLoad.eq(isLoad),
+            m_isStore.eq(isStore),
+            m_writes.eq(~isBranch & ~isStore & ~isHalt & (rdId != 0)),
+            m_rdId.eq(rdId),
+            m_result.eq(result),
+            m_addr.eq(loadStoreAddr),
+            m_wdata.eq(store_wdata),
+            m_wmask.eq(store_wmask),
+            m_funct3.eq(funct3)
+        ]
+
+        ## M: memory access
+
+        m.d.comb += [
+            self.mem_addr.eq(Mux(memBusy, m_addr, f_pc)),
+            self.mem_rstrb.eq((m_valid & m_isLoad) | fetch),
+            self.mem_wmask.eq((m_valid & m_isStore).replicate(4) & m_wmask),
+            self.mem_wdata.eq(m_wdata)
+        ]
+
+        # M -> W
+        m.d.sync += [
+            w_valid.eq(m_valid),
+            w_isLoad.eq(m_isLoad),
+            w_writes.eq(m_writes),
+            w_rdId.eq(m_rdId),
+            w_result.eq(m_result),
+            w_addr.eq(m_addr[0:2]),
+            w_funct3.eq(m_funct3)
+        ]
+
+        return m
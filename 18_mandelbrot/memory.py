@@ -1,10 +1,29 @@
+import logging
 from amaranth import *
 from riscv_assembler import RiscvAssembler
+from options import bool_option
+
+log = logging.getLogger("memory")
 
 class Mem(Elaboratable):
 
-    def __init__(self):
-        a = RiscvAssembler()
+    def __init__(self, simulation = False, rv32m = False):
+        self.simulation = simulation
+        self.rv32m = bool_option("rv32m", rv32m)
+
+        # In the simulation, don't spend millions of cycles blinking
+        slow_bit = 1 if simulation else 18
+
+        # a0 <- rs1 * rs2, either with the MUL instruction of the RV32M
+        # extension or with the mulsi3 subroutine
+        def mul(rs1, rs2):
+            if self.rv32m:
+                return "MUL     a0, {}, {}".format(rs1, rs2)
+            return ("MV      a0, {}\n"
+                    "        MV      a1, {}\n"
+                    "        CALL    mulsi3").format(rs1, rs2)
+
+        a = RiscvAssembler(simulation=simulation)
 
         a.read("""begin:
 
@@ -19,8 +38,7 @@ class Mem(Elaboratable):
         dy              equ 51      ; (ymax - ymin) / 80
         norm_max        equ 4096    ; (4 << mandel_shift)
         io_leds         equ 4       ; (2 + 2)
-        slow_bit        equ 18      ; wait (1 << 18) clocks
-        ; slow_bit        equ 1      ; wait (1 << 18) clocks
+        slow_bit        equ {slow_bit}      ; wait (1 << slow_bit) clocks
 
         LI      sp, 0x1800          ; end of RAM, 6 kB
         LI      gp, 0x400000        ; IO page
@@ -63,17 +81,11 @@ class Mem(Elaboratable):
 
 
         loop_z:
-        MV      a0, s4
-        MV      a1, s4
-        CALL    mulsi3
+        {mul_zr_zr}
         SRLI    s6, a0, mandel_shift    ; s6=Zrr <- (Zr*Zr) >> mandel_shift
-        MV      a0, s4
-        MV      a1, s5
-        CALL    mulsi3
+        {mul_zr_zi}
         SRAI    s7, a0, mandel_shift_m1 ; s7=Zri <- (Zr*Zi) >> (mandelshift-1)
-        MV      a0, s5
-        MV      a1, s5
-        CALL    mulsi3
+        {mul_zi_zi}
         SRLI    s8, a0, mandel_shift    ; s8=Zii <- (Zi*Zi) >> mandelshift
         SUB     s4, s6, s8              ; s4=Zr <- Zrr - Zii + Cr
         ADD     s4, s4, s2
@@ -110,37 +122,14 @@ class Mem(Elaboratable):
 
         EBREAK
 
-        wait:
-        LI      t0, 1
-        SLLI    t0, t0, slow_bit
-        wait_loop:
-        ADDI    t0, t0, -1
-        BNEZ    t0, wait_loop
-        RET
+        INCLUDE wait.s
+        INCLUDE mulsi3.s
+        INCLUDE putc.s
 
-        mulsi3:                 ; integer multiplication
-        MV      a2, a0
-        LI      a0, 0
-        mulsi3_l0:
-        ANDI    a3, a1, 1
-        BEQZ    a3, mulsi3_l1
-        ADD     a0, a0, a2
-        mulsi3_l1:
-        SRLI    a1, a1, 1
-        SLLI    a2, a2, 1
-        BNEZ    a1, mulsi3_l0
-        RET
-
-        putc:                   ; Send one character
-        SW      a0, gp, 8       ; (1 << IO_UART_DAT_bit + 2)
-        LI      t0, 0x200       ; Test bit 9 (status bit) below
-        putc_loop:
-        LW      t1, gp, 0x10    ; (1 << IO_UART_CNTL_bit + 2)
-        AND     t1, t1, t0      ; Test
-        BNEZ    t1, putc_loop
-        RET
-
-        """)
+        """.format(slow_bit=slow_bit,
+                   mul_zr_zr=mul("s4", "s4"),
+                   mul_zr_zi=mul("s4", "s5"),
+                   mul_zi_zi=mul("s5", "s5")))
 
         a.assemble()
         self.instructions = a.mem
@@ -149,7 +138,7 @@ class Mem(Elaboratable):
         while len(self.instructions) < (1024 * 6 / 4):
             self.instructions.append(0)
 
-        print("memory = {}".format(self.instructions))
+        log.debug("memory = %s", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Memory(width=32, depth=len(self.instructions),
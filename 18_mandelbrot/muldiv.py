@@ -0,0 +1,105 @@
+from amaranth import *
+
+# Execution unit for the RV32M extension (MUL, MULH, MULHSU, MULHU, DIV,
+# DIVU, REM, REMU).
+#
+# The multiplication is a single 33 x 33 bit multiplication, which the
+# synthesis tools map to the DSP blocks of the FPGA. The result is available
+# combinatorially in the same cycle.
+#
+# The division is done iteratively, one bit per cycle. The operands are
+# taken when 'start' is set, 'busy' is set in the following 32 cycles. When
+# 'busy' is low again, 'result' holds the quotient or the remainder until the
+# next division is started.
+
+class MulDiv(Elaboratable):
+
+    def __init__(self):
+        # Inputs
+        self.op1 = Signal(32)
+        self.op2 = Signal(32)
+        self.funct3 = Signal(3)
+        self.start = Signal()
+
+        # Outputs
+        self.result = Signal(32)
+        self.isDiv = Signal()
+        self.busy = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        op1 = self.op1
+        op2 = self.op2
+        funct3 = self.funct3
+
+        m.d.comb += self.isDiv.eq(funct3[2])
+
+        ## Multiplication
+
+        # MULH: both signed, MULHSU: op1 signed, MULHU: both unsigned
+        op1Signed = (funct3[0:2] == 0b01) | (funct3[0:2] == 0b10)
+        op2Signed = (funct3[0:2] == 0b01)
+
+        mulIn1 = Cat(op1, op1[31] & op1Signed).as_signed()
+        mulIn2 = Cat(op2, op2[31] & op2Signed).as_signed()
+        product = Signal(64)
+        m.d.comb += product.eq(mulIn1 * mulIn2)
+
+        mulResult = Mux(funct3[0:2] == 0b00, product[0:32], product[32:64])
+
+        ## Division
+
+        # The division works on the absolute values, the signs are applied to
+        # the quotient and the remainder at the end.
+        divSigned = ~funct3[0]
+        divRem = funct3[1]
+
+        quotient = Signal(32)
+        remainder = Signal(32)
+        divisor = Signal(32)
+        count = Signal(range(33))
+        negQuotient = Signal()
+        negRemainder = Signal()
+        isRem = Signal()
+
+        op1Neg = divSigned & op1[31]
+        op2Neg = divSigned & op2[31]
+
+        with m.If(self.start & self.isDiv):
+            m.d.sync += [
+                quotient.eq(Mux(op1Neg, -op1, op1)),
+                remainder.eq(0),
+                divisor.eq(Mux(op2Neg, -op2, op2)),
+                count.eq(32),
+                # Division by zero gives -1, which is left unchanged
+                negQuotient.eq((op1Neg ^ op2Neg) & (op2 != 0)),
+                negRemainder.eq(op1Neg),
+                isRem.eq(divRem),
+                self.busy.eq(1)
+            ]
+        with m.Elif(self.busy):
+            shifted = Cat(quotient[31], remainder)
+            diff = Signal(33)
+            m.d.comb += diff.eq(shifted - divisor)
+            with m.If(diff[32]):
+                m.d.sync += [
+                    remainder.eq(shifted[0:32]),
+                    quotient.eq(Cat(0, quotient[0:31]))
+                ]
+            with m.Else():
+                m.d.sync += [
+                    remainder.eq(diff[0:32]),
+                    quotient.eq(Cat(1, quotient[0:31]))
+                ]
+            m.d.sync += count.eq(count - 1)
+            with m.If(count == 1):
+                m.d.sync += self.busy.eq(0)
+
+        divResult = Mux(isRem,
+                        Mux(negRemainder, -remainder, remainder),
+                        Mux(negQuotient, -quotient, quotient))
+
+        m.d.comb += self.result.eq(Mux(self.isDiv, divResult, mulResult))
+
+        return m
@@ -0,0 +1,570 @@
+from amaranth import *
+from amaranth.utils import exact_log2
+
+from muldiv import MulDiv
+from regfile import RegisterFile
+from csr import CSR
+from options import bool_option
+
+# A two stage variant of the CPU in cpu.py.
+#
+# While the instruction at 'pc' is executed, the instruction at 'pc + 4' is
+# already being fetched. The instruction is decoded straight from the memory
+# output, so an ALU instruction retires every cycle. Taken branches and jumps
+# discard the prefetched instruction and cost one extra cycle, loads and
+# stores need the (single) memory port for one cycle and also cost one extra
+# cycle. With the RV32M extension, multiplications take one cycle and
+# divisions wait for the divider in WAIT_DIV.
+#
+# With static branch prediction, the fetch follows JAL and backward branches
+# (loops) right away, and forward branches are expected not to be taken. Only
+# wrong predictions and JALR cost an extra cycle.
+#
+# The targets of JALR can be predicted with a return address stack (for
+# RET, JALR x0, 0(x1)) and a branch target buffer (for all other JALR, e.g.
+# CALL, which is AUIPC + JALR). Both are looked up with the pc and the
+# instruction bits only, not with the registers.
+#
+# The memory interface is the same as the one of the CPU in cpu.py.
+
+class PipelinedCPU(Elaboratable):
+
+    def __init__(self, rv32m=False, regfile="array", zicsr=False,
+                 predict=False, btb=0, ras=0):
+        # Include the RV32M multiply / divide unit
+        self.rv32m = bool_option("rv32m", rv32m)
+        # Register bank in flip-flops ("array") or in a memory ("memory")
+        self.regfile = regfile
+        # Include the Zicsr extension with the cycle, time and instret
+        # counters
+        self.zicsr = bool_option("zicsr", zicsr)
+        # Static branch prediction: backward taken, forward not taken
+        self.predict = bool_option("predict", predict)
+        # Number of entries of the branch target buffer (a power of 2, or 0
+        # for none) and of the return address stack (0 for none)
+        self.btb = int(btb)
+        self.ras = int(ras)
+
+        self.mem_addr = Signal(32)
+        self.mem_rstrb = Signal()
+        self.mem_rdata = Signal(32)
+        self.mem_wdata = Signal(32)
+        self.mem_wmask = Signal(4)
+        self.x10 = Signal(32)
+        self.retire = Signal()
+        self.fsm = None
+        # Wall clock for the time CSR
+        self.time = Signal(64)
+
+        # Events for the performance counters of the SOC, set for one cycle
+        # per executed instruction
+        self.branch_taken = Signal()
+        self.branch_not_taken = Signal()
+        self.loads = Signal()
+        self.stores = Signal()
+        # Cycles spent waiting for an instruction (after a jump) and for
+        # loaded data
+        self.wait_instr_cycles = Signal()
+        self.wait_data_cycles = Signal()
+
+        # Prediction events of the branch target buffer and the return
+        # address stack, set for one cycle per executed JALR
+        self.btb_hit = Signal()
+        self.btb_miss = Signal()
+        self.ras_hit = Signal()
+        self.ras_miss = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Program counter of the instruction in the execute stage
+        pc = Signal(32)
+        self.pc = pc
+
+        # Memory
+        mem_rdata = self.mem_rdata
+
+        # Current instruction
+        # In EXECUTE the instruction comes directly from the memory, in the
+        # other states the copy taken during EXECUTE is used.
+        instr = Signal(32)
+        instrReg = Signal(32, init=0b0110011)
+        self.instr = instr
+
+        # Register bank
+        # As a memory, the registers are read asynchronously (LUT RAM).
+        if self.regfile == "memory":
+            regfile = m.submodules.regfile = RegisterFile(read_domain="comb")
+            regs = regfile.mem
+            rs1 = regfile.rs1
+            rs2 = regfile.rs2
+        else:
+            regs = Array([Signal(32, name="x"+str(x)) for x in range(32)])
+            rs1 = Signal(32)
+            rs2 = Signal(32)
+        self.regs = regs
+
+        # ALU registers
+        aluOut = Signal(32)
+        takeBranch = Signal(32)
+
+        # Opcode decoder
+        isALUreg = Signal()
+        isALUimm = Signal()
+        isBranch = Signal()
+        isJALR   = Signal()
+        isJAL    = Signal()
+        isAUIPC  = Signal()
+        isLUI    = Signal()
+        isLoad   = Signal()
+        isStore  = Signal()
+        isSystem = Signal()
+        m.d.comb += [
+            isALUreg.eq(instr[0:7] == 0b0110011),
+            isALUimm.eq(instr[0:7] == 0b0010011),
+            isBranch.eq(instr[0:7] == 0b1100011),
+            isJALR.eq(instr[0:7] == 0b1100111),
+            isJAL.eq(instr[0:7] == 0b1101111),
+            isAUIPC.eq(instr[0:7] == 0b0010111),
+            isLUI.eq(instr[0:7] == 0b0110111),
+            isLoad.eq(instr[0:7] == 0b0000011),
+            isStore.eq(instr[0:7] == 0b0100011),
+            isSystem.eq(instr[0:7] == 0b1110011)
+        ]
+        self.isALUreg = isALUreg
+        self.isALUimm = isALUimm
+        self.isBranch = isBranch
+        self.isLoad = isLoad
+        self.isStore = isStore
+        self.isSystem = isSystem
+
+        # Extend a signal with a sign bit repeated n times
+        def SignExtend(signal, sign, n):
+            return Cat(signal, sign.replicate(n))
+
+        # Immediate format decoder
+        Uimm = Signal(32)
+        Iimm = Signal(32)
+        Simm = Signal(32)
+        Bimm = Signal(32)
+        Jimm = Signal(32)
+        m.d.comb += [
+            Uimm.eq(Cat(Const(0).replicate(12), instr[12:32])),
+            Iimm.eq(Cat(instr[20:31], instr[31].replicate(21))),
+            Simm.eq(Cat(instr[7:12], instr[25:31], instr[31].replicate(21))),
+            Bimm.eq(Cat(0, instr[8:12], instr[25:31], instr[7],
+                instr[31].replicate(20))),
+            Jimm.eq(Cat(0, instr[21:31], instr[20], instr[12:20],
+                instr[31].replicate(12)))
+        ]
+        self.Iimm = Iimm
+
+        # Register addresses decoder
+        rs1Id = instr[15:20]
+        rs2Id = instr[20:25]
+        rdId = instr[7:12]
+
+        self.rdId = rdId
+        self.rs1Id = rs1Id
+        self.rs2Id = rs2Id
+
+        # Function code decoder
+        funct3 = instr[12:15]
+        funct7 = instr[25:32]
+        self.funct3 = funct3
+
+        # The registers are read in the same cycle as the instruction is
+        # executed, there is no FETCH_REGS state.
+        if self.regfile == "memory":
+            m.d.comb += [
+                regfile.rs1Id.eq(rs1Id),
+                regfile.rs2Id.eq(rs2Id)
+            ]
+        else:
+            m.d.comb += [
+                rs1.eq(regs[rs1Id]),
+                rs2.eq(regs[rs2Id])
+            ]
+
+        # ALU
+        aluIn1 = Signal.like(rs1)
+        aluIn2 = Signal.like(rs2)
+        shamt = Signal(5)
+        aluMinus = Signal(33)
+        aluPlus = Signal.like(aluIn1)
+
+        m.d.comb += [
+            aluIn1.eq(rs1),
+            aluIn2.eq(Mux((isALUreg | isBranch), rs2, Iimm)),
+            shamt.eq(Mux(isALUreg, rs2[0:5], instr[20:25]))
+        ]
+
+        m.d.comb += [
+            aluMinus.eq(Cat(~aluIn2, C(1,1)) + Cat(aluIn1, C(0,1)) + 1),
+            aluPlus.eq(aluIn1 + aluIn2)
+        ]
+
+        EQ = aluMinus[0:32] == 0
+        LTU = aluMinus[32]
+        LT = Mux((aluIn1[31] ^ aluIn2[31]), aluIn1[31], aluMinus[32])
+
+        def flip32(x):
+            a = [x[i] for i in range(0, 32)]
+            return Cat(*reversed(a))
+
+        shifter_in = Mux(funct3 == 0b001, flip32(aluIn1), aluIn1)
+        shifter = (Cat(shifter_in,
+                       (instr[30] & aluIn1[31]))).as_signed() >> aluIn2[0:5]
+        leftshift = flip32(shifter)
+
+        with m.Switch(funct3) as alu:
+            with m.Case(0b000):
+                m.d.comb += aluOut.eq(Mux(funct7[5] & instr[5],
+                                          aluMinus[0:32], aluPlus))
+            with m.Case(0b001):
+                m.d.comb += aluOut.eq(leftshift)
+            with m.Case(0b010):
+                m.d.comb += aluOut.eq(LT)
+            with m.Case(0b011):
+                m.d.comb += aluOut.eq(LTU)
+            with m.Case(0b100):
+                m.d.comb += aluOut.eq(aluIn1 ^ aluIn2)
+            with m.Case(0b101):
+                m.d.comb += aluOut.eq(shifter)
+            with m.Case(0b110):
+                m.d.comb += aluOut.eq(aluIn1 | aluIn2)
+            with m.Case(0b111):
+                m.d.comb += aluOut.eq(aluIn1 & aluIn2)
+
+        # RV32M extension
+        isMulDiv = Signal()
+        isDiv = Signal()
+        if self.rv32m:
+            muldiv = m.submodules.muldiv = MulDiv()
+            m.d.comb += [
+                isMulDiv.eq(isALUreg & (funct7 == 0b0000001)),
+                isDiv.eq(isMulDiv & muldiv.isDiv),
+                muldiv.op1.eq(rs1),
+                muldiv.op2.eq(rs2),
+                muldiv.funct3.eq(funct3)
+            ]
+
+        # Zicsr: CSR instructions read the counters, the other system
+        # instructions (EBREAK, ECALL) halt the CPU.
+        isCSR = Signal()
+        isHalt = Signal()
+        m.d.comb += isHalt.eq(isSystem & ~isCSR)
+        if self.zicsr:
+            csr = m.submodules.csr = CSR()
+            m.d.comb += [
+                isCSR.eq(isSystem & (funct3 != 0)),
+                csr.addr.eq(instr[20:32]),
+                csr.retire.eq(self.retire),
+                csr.time.eq(self.time)
+            ]
+
+        with m.Switch(funct3) as alu_branch:
+            with m.Case(0b000):
+                m.d.comb += takeBranch.eq(EQ)
+            with m.Case(0b001):
+                m.d.comb += takeBranch.eq(~EQ)
+            with m.Case(0b100):
+                m.d.comb += takeBranch.eq(LT)
+            with m.Case(0b101):
+                m.d.comb += takeBranch.eq(~LT)
+            with m.Case(0b110):
+                m.d.comb += takeBranch.eq(LTU)
+            with m.Case(0b111):
+                m.d.comb += takeBranch.eq(~LTU)
+            with m.Case("---"):
+                m.d.comb += takeBranch.eq(0)
+
+        # Next program counter is either next intstruction or depends on
+        # jump target
+        pcPlusImm = pc + Mux(instr[3], Jimm[0:32],
+                             Mux(instr[4], Uimm[0:32],
+                                 Bimm[0:32]))
+        pcPlus4 = pc + 4
+
+        nextPc = Mux(((isBranch & takeBranch) | isJAL), pcPlusImm,
+                     Mux(isJALR, Cat(C(0, 1), aluPlus[1:32]),
+                         pcPlus4))
+
+        # The instruction at pc + 4 is fetched while executing. If the
+        # program continues elsewhere, the fetched instruction is dropped.
+        #
+        # With prediction, the fetch goes to the target of JAL and of
+        # backward branches (negative offset, sign bit in instr[31]) instead.
+        # The prefetched instruction is dropped when the prediction was
+        # wrong, and after JALR.
+        predictTaken = Signal()
+        fetchPc = Signal(32)
+        mispredict = Signal()
+        if self.predict:
+            m.d.comb += predictTaken.eq(isJAL | (isBranch & instr[31]))
+
+        # JALR targets come from the return address stack or the branch
+        # target buffer. The prediction is checked against the computed
+        # target (nextPc).
+        isReturn = Signal()
+        isLink = Signal()
+        rasPredict = Signal()
+        rasTarget = Signal(32)
+        btbPredict = Signal()
+        btbTarget = Signal(32)
+        jalrTarget = Signal(32)
+        jalrCorrect = Signal()
+        m.d.comb += [
+            isReturn.eq(isJALR & (rs1Id == 1) & (rdId == 0)),
+            isLink.eq((isJAL | isJALR) & (rdId == 1)),
+            jalrTarget.eq(Mux(rasPredict, rasTarget, btbTarget)),
+            jalrCorrect.eq((rasPredict | btbPredict) & (jalrTarget == nextPc))
+        ]
+
+        m.d.comb += [
+            fetchPc.eq(Mux(isJALR & (rasPredict | btbPredict), jalrTarget,
+                           Mux(predictTaken, pcPlusImm, pcPlus4))),
+            mispredict.eq((isJALR & ~jalrCorrect) | (isJAL & ~predictTaken) |
+                          (isBranch & (takeBranch[0] != predictTaken)))
+        ]
+
+        ## Load and store
+
+        loadStoreAddr = Signal(32)
+        m.d.comb += loadStoreAddr.eq(rs1 + Mux(isStore, Simm, Iimm))
+
+        # Main state machine
+        with m.FSM(init="FETCH") as fsm:
+            self.fsm = fsm
+            with m.State("FETCH"):
+                m.d.comb += [
+                    instr.eq(instrReg),
+                    self.mem_addr.eq(pc),
+                    self.mem_rstrb.eq(1)
+                ]
+                m.next = "EXECUTE"
+            with m.State("EXECUTE"):
+                m.d.comb += instr.eq(mem_rdata)
+                m.d.sync += instrReg.eq(mem_rdata)
+                with m.If(isHalt):
+                    # Halt, keep the instruction on the memory output
+                    m.d.comb += self.mem_addr.eq(pc)
+                with m.Elif(isLoad):
+                    m.d.comb += [
+                        self.mem_addr.eq(loadStoreAddr),
+                        self.mem_rstrb.eq(1)
+                    ]
+                    m.d.sync += pc.eq(pcPlus4)
+                    m.next = "WAIT_DATA"
+                with m.Elif(isStore):
+                    m.d.comb += self.mem_addr.eq(loadStoreAddr)
+                    m.d.sync += pc.eq(pcPlus4)
+                    m.next = "FETCH"
+                if self.rv32m:
+                    with m.Elif(isDiv):
+                        # The next instruction is fetched and stays on the
+                        # memory output until the division is done.
+                        m.d.comb += [
+                            self.mem_addr.eq(pcPlus4),
+                            self.mem_rstrb.eq(1)
+                        ]
+                        m.d.sync += pc.eq(pcPlus4)
+                        m.next = "WAIT_DIV"
+                with m.Else():
+                    m.d.comb += [
+                        self.mem_addr.eq(fetchPc),
+                        self.mem_rstrb.eq(1)
+                    ]
+                    m.d.sync += pc.eq(nextPc)
+                    with m.If(mispredict):
+                        m.next = "FETCH"
+            with m.State("WAIT_DATA"):
+                # Write back the loaded data and fetch the next instruction
+                m.d.comb += [
+                    instr.eq(instrReg),
+                    self.mem_addr.eq(pc),
+                    self.mem_rstrb.eq(1)
+                ]
+                m.next = "EXECUTE"
+            if self.rv32m:
+                with m.State("WAIT_DIV"):
+                    m.d.comb += [
+                        instr.eq(instrReg),
+                        self.mem_addr.eq(pc)
+                    ]
+                    with m.If(~muldiv.busy):
+                        m.next = "EXECUTE"
+
+        # Return address stack and branch target buffer updates, once per
+        # executed JALR (EXECUTE is left after a JALR).
+        executeJump = Signal()
+        m.d.comb += executeJump.eq(fsm.ongoing("EXECUTE") & (isJAL | isJALR))
+
+        if self.ras > 0:
+            # Circular buffer, the oldest return address is overwritten when
+            # the stack is full.
+            ras = Array([Signal(32, name="ras"+str(i))
+                         for i in range(self.ras)])
+            rasTop = Signal(range(self.ras))
+            rasCount = Signal(range(self.ras + 1))
+            rasPrev = Mux(rasTop == 0, self.ras - 1, rasTop - 1)
+            rasNext = Mux(rasTop == self.ras - 1, 0, rasTop + 1)
+
+            m.d.comb += [
+                rasPredict.eq(isReturn & (rasCount != 0)),
+                rasTarget.eq(ras[rasPrev])
+            ]
+
+            with m.If(executeJump & isLink):
+                m.d.sync += [
+                    ras[rasTop].eq(pcPlus4),
+                    rasTop.eq(rasNext)
+                ]
+                with m.If(rasCount != self.ras):
+                    m.d.sync += rasCount.eq(rasCount + 1)
+            with m.Elif(executeJump & rasPredict):
+                m.d.sync += [
+                    rasTop.eq(rasPrev),
+                    rasCount.eq(rasCount - 1)
+                ]
+
+            m.d.comb += [
+                self.ras_hit.eq(executeJump & isReturn & jalrCorrect),
+                self.ras_miss.eq(executeJump & isReturn & ~jalrCorrect)
+            ]
+
+        if self.btb > 0:
+            # Direct mapped, indexed by the low bits of the pc (the JALR
+            # instruction address), the other bits are the tag.
+            indexBits = exact_log2(self.btb)
+            btbValid = Array([Signal(name="btb_valid"+str(i))
+                              for i in range(self.btb)])
+            btbTag = Array([Signal(30 - indexBits, name="btb_tag"+str(i))
+                            for i in range(self.btb)])
+            btbTargets = Array([Signal(32, name="btb_target"+str(i))
+                                for i in range(self.btb)])
+            btbIndex = pc[2:2 + indexBits]
+            btbLookup = Signal()
+
+            m.d.comb += [
+                btbLookup.eq(isJALR & ~rasPredict),
+                btbPredict.eq(btbLookup & btbValid[btbIndex] &
+                              (btbTag[btbIndex] == pc[2 + indexBits:32])),
+                btbTarget.eq(btbTargets[btbIndex])
+            ]
+
+            with m.If(executeJump & btbLookup):
+                m.d.sync += [
+                    btbValid[btbIndex].eq(1),
+                    btbTag[btbIndex].eq(pc[2 + indexBits:32]),
+                    btbTargets[btbIndex].eq(nextPc)
+                ]
+
+            m.d.comb += [
+                self.btb_hit.eq(executeJump & btbLookup & jalrCorrect),
+                self.btb_miss.eq(executeJump & btbLookup & ~jalrCorrect)
+            ]
+
+        # Load
+        # The address is computed again from the saved instruction, the
+        # registers did not change since EXECUTE.
+        memByteAccess = Signal()
+        memHalfwordAccess = Signal()
+        loadHalfword = Signal(16)
+        loadByte = Signal(8)
+        loadSign = Signal()
+        loadData = Signal(32)
+
+        m.d.comb += [
+            memByteAccess.eq(funct3[0:2] == C(0,2)),
+            memHalfwordAccess.eq(funct3[0:2] == C(1,2)),
+            loadHalfword.eq(Mux(loadStoreAddr[1], mem_rdata[16:32],
+                                mem_rdata[0:16])),
+            loadByte.eq(Mux(loadStoreAddr[0], loadHalfword[8:16],
+                            loadHalfword[0:8])),
+            loadSign.eq(~funct3[2] & Mux(memByteAccess, loadByte[7],
+                                         loadHalfword[15])),
+            loadData.eq(
+                Mux(memByteAccess, SignExtend(loadByte, loadSign, 24),
+                    Mux(memHalfwordAccess, SignExtend(loadHalfword,
+                                                      loadSign, 16),
+                        mem_rdata)))
+        ]
+
+        # Store
+        m.d.comb += [
+            self.mem_wdata[ 0: 8].eq(rs2[0:8]),
+            self.mem_wdata[ 8:16].eq(
+                Mux(loadStoreAddr[0], rs2[0:8], rs2[8:16])),
+            self.mem_wdata[16:24].eq(
+                Mux(loadStoreAddr[1], rs2[0:8], rs2[16:24])),
+            self.mem_wdata[24:32].eq(
+                Mux(loadStoreAddr[0], rs2[0:8],
+                    Mux(loadStoreAddr[1], rs2[8:16], rs2[24:32])))
+        ]
+
+        store_wmask = Signal(4)
+        m.d.comb += store_wmask.eq(
+                Mux(memByteAccess,
+                    Mux(loadStoreAddr[1],
+                        Mux(loadStoreAddr[0], 0b1000, 0b0100),
+                        Mux(loadStoreAddr[0], 0b0010, 0b0001)
+                        ),
+                    Mux(memHalfwordAccess,
+                        Mux(loadStoreAddr[1], 0b1100, 0b0011),
+                        0b1111)
+                    )
+                )
+
+        m.d.comb += self.mem_wmask.eq(
+            (fsm.ongoing("EXECUTE") & isStore).replicate(4) & store_wmask)
+
+        # Register write back
+        writeBackData = Mux((isJAL | isJALR), pcPlus4,
+                            Mux(isLUI, Uimm,
+                                Mux(isAUIPC, pcPlusImm,
+                                    Mux(isLoad, loadData,
+                                    aluOut))))
+
+        writeBackEn = ((fsm.ongoing("EXECUTE") & ~isBranch & ~isStore
+                        & ~isLoad & ~isHalt & ~isDiv)
+                       | fsm.ongoing("WAIT_DATA"))
+
+        if self.rv32m:
+            m.d.comb += muldiv.start.eq(fsm.ongoing("EXECUTE") & isDiv)
+            writeBackData = Mux(isMulDiv, muldiv.result, writeBackData)
+            writeBackEn = writeBackEn | (fsm.ongoing("WAIT_DIV") & ~muldiv.busy)
+
+        if self.zicsr:
+            writeBackData = Mux(isCSR, csr.rdata, writeBackData)
+
+        self.writeBackData = writeBackData
+
+        m.d.comb += self.retire.eq(fsm.ongoing("EXECUTE") & ~isHalt)
+
+        # Performance counter events
+        execute = fsm.ongoing("EXECUTE")
+        m.d.comb += [
+            self.branch_taken.eq(execute & isBranch & takeBranch[0]),
+            self.branch_not_taken.eq(execute & isBranch & ~takeBranch[0]),
+            self.loads.eq(execute & isLoad),
+            self.stores.eq(execute & isStore),
+            self.wait_instr_cycles.eq(fsm.ongoing("FETCH")),
+            self.wait_data_cycles.eq(fsm.ongoing("WAIT_DATA"))
+        ]
+
+        if self.regfile == "memory":
+            m.d.comb += [
+                regfile.rdId.eq(rdId),
+                regfile.wdata.eq(writeBackData),
+                regfile.wen.eq(writeBackEn)
+            ]
+
+        with m.If(writeBackEn & (rdId != 0)):
+            if self.regfile != "memory":
+                m.d.sync += regs[rdId].eq(writeBackData)
+            # Also assign to debug output to see what is happening
+            with m.If(rdId == 10):
+                m.d.sync += self.x10.eq(writeBackData)
+
+        return m
@@ -0,0 +1,70 @@
+from amaranth import *
+
+# Register bank in a memory, instead of an Array of 32 signals.
+#
+# An Array of 32 signals ends up as 1024 flip-flops, two 32:1 multiplexers
+# for the source registers and a decoder for the destination register. With
+# a memory with two read ports and one write port, the synthesis tools can
+# use distributed (LUT) RAM or block RAM instead (duplicating the memory for
+# the second read port if needed).
+#
+# read_domain="sync": the registers are read in the cycle after 'ren' is set,
+# the data stays on 'rs1' and 'rs2' until the next read (block RAM or LUT
+# RAM).
+# read_domain="comb": the registers are read asynchronously (LUT RAM).
+#
+# Register x0 is never written, it stays 0.
+
+class RegisterFile(Elaboratable):
+
+    def __init__(self, read_domain="sync"):
+        self.read_domain = read_domain
+
+        self.mem = Memory(width=32, depth=32, name="regs")
+
+        # Read ports
+        self.rs1Id = Signal(5)
+        self.rs2Id = Signal(5)
+        self.ren = Signal()
+        self.rs1 = Signal(32)
+        self.rs2 = Signal(32)
+
+        # Write port
+        self.rdId = Signal(5)
+        self.wdata = Signal(32)
+        self.wen = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        w_port = m.submodules.w_port = self.mem.write_port(domain="sync")
+
+        if self.read_domain == "comb":
+            r_port1 = m.submodules.r_port1 = self.mem.read_port(domain="comb")
+            r_port2 = m.submodules.r_port2 = self.mem.read_port(domain="comb")
+        else:
+            r_port1 = m.submodules.r_port1 = self.mem.read_port(
+                domain="sync", transparent=False)
+            r_port2 = m.submodules.r_port2 = self.mem.read_port(
+                domain="sync", transparent=False)
+            m.d.comb += [
+                r_port1.en.eq(self.ren),
+                r_port2.en.eq(self.ren)
+            ]
+
+        # Hook up read ports
+        m.d.comb += [
+            r_port1.addr.eq(self.rs1Id),
+            r_port2.addr.eq(self.rs2Id),
+            self.rs1.eq(r_port1.data),
+            self.rs2.eq(r_port2.data)
+        ]
+
+        # Hook up write port
+        m.d.comb += [
+            w_port.addr.eq(self.rdId),
+            w_port.data.eq(self.wdata),
+            w_port.en.eq(self.wen & (self.rdId != 0))
+        ]
+
+        return m
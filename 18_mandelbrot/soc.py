@@ -4,11 +4,34 @@ from amaranth import *
 from clockworks import Clockworks
 from memory import Mem
 from cpu import CPU
+from pipelined_cpu import PipelinedCPU
+from five_stage_cpu import FiveStageCPU
 from uart_tx import UartTx
+from options import bool_option
+
+# The CPU cores that can be used in the SOC. They all share the same memory
+# interface.
+cores = {
+    "fsm": CPU,
+    "pipelined": PipelinedCPU,
+    "five_stage": FiveStageCPU,
+}
 
 class SOC(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, core="fsm", rv32m=False, regfile="array", **options):
+
+        if core not in cores:
+            raise ValueError("Unknown core '{}', choose one of {}".format(
+                core, list(cores.keys())))
+        self.core = core
+        # Use the RV32M extension in the CPU and the firmware
+        self.rv32m = bool_option("rv32m", rv32m)
+        # Keep the CPU registers in flip-flops ("array") or in a memory
+        # ("memory", distributed or block RAM)
+        self.regfile = regfile
+        # Options of the selected core only, e.g. early_regs=True for "fsm"
+        self.options = options
 
         self.leds = Signal(5)
         self.tx = Signal()
@@ -18,13 +41,20 @@ class SOC(Elaboratable):
 
     def elaborate(self, platform):
 
-        clk_frequency = int(platform.default_clk_constraint.frequency)
+        simulation = platform is None
+
+        if simulation:
+            clk_frequency = 12*1000000
+        else:
+            clk_frequency = int(platform.default_clk_constraint.frequency)
         print("clock frequency = {}".format(clk_frequency))
 
         m = Module()
         cw = Clockworks(m)
-        memory = DomainRenamer("slow")(Mem())
-        cpu = DomainRenamer("slow")(CPU())
+        memory = DomainRenamer("slow")(
+                Mem(simulation=simulation, rv32m=self.rv32m))
+        cpu = DomainRenamer("slow")(cores[self.core](
+                rv32m=self.rv32m, regfile=self.regfile, **self.options))
         uart_tx = DomainRenamer("slow")(
                 UartTx(freq_hz=clk_frequency, baud_rate=1000000))
 
@@ -35,6 +65,7 @@ class SOC(Elaboratable):
 
         self.cpu = cpu
         self.memory = memory
+        self.uart_tx = uart_tx
 
         ram_rdata = Signal(32)
         mem_wordaddr = Signal(30)
@@ -42,11 +73,14 @@ class SOC(Elaboratable):
         isRAM = Signal()
         mem_wstrb = Signal()
         io_rdata = Signal(32)
+        isRAM_q = Signal()
+        io_rdata_q = Signal(32)
 
         # Memory map bits
         IO_LEDS_bit = 0
         IO_UART_DAT_bit = 1
         IO_UART_CNTL_bit = 2
+        IO_COUNTERS_bit = 3
 
         m.d.comb += [
             mem_wordaddr.eq(cpu.mem_addr[2:32]),
@@ -64,9 +98,18 @@ class SOC(Elaboratable):
             memory.mem_wdata.eq(cpu.mem_wdata),
             memory.mem_wmask.eq(isRAM.replicate(4) & cpu.mem_wmask),
             ram_rdata.eq(memory.mem_rdata),
-            cpu.mem_rdata.eq(Mux(isRAM, ram_rdata, io_rdata))
+            cpu.mem_rdata.eq(Mux(isRAM_q, ram_rdata, io_rdata_q))
         ]
 
+        # IO reads are registered just like RAM reads, so the read data
+        # does not depend on the address the CPU puts on the bus in the
+        # cycle after the read (the pipelined core is already fetching then).
+        with m.If(cpu.mem_rstrb):
+            m.d.slow += [
+                isRAM_q.eq(isRAM),
+                io_rdata_q.eq(io_rdata)
+            ]
+
         # LEDs
         with m.If(isIO & mem_wstrb & mem_wordaddr[IO_LEDS_bit]):
             m.d.sync += self.leds.eq(cpu.mem_wdata)
@@ -88,10 +131,85 @@ class SOC(Elaboratable):
             self.tx.eq(uart_tx.tx)
         ]
 
-        # Data from UART
+        # Wall clock in microseconds, for the time CSR of the CPU
+        cycles_per_us = max(1, clk_frequency // 1000000)
+        mtime = Signal(64)
+        mtime_prescaler = Signal(range(cycles_per_us))
+        with m.If(mtime_prescaler == cycles_per_us - 1):
+            m.d.slow += [
+                mtime_prescaler.eq(0),
+                mtime.eq(mtime + 1)
+            ]
+        with m.Else():
+            m.d.slow += mtime_prescaler.eq(mtime_prescaler + 1)
+        m.d.comb += cpu.time.eq(mtime)
+
+        # Performance counters
+        # Counter n is read at IO_COUNTERS_bit, with n in the word address
+        # bits above it (byte offset 0x20 + n * 0x40). Events the CPU core
+        # does not have stay 0.
+        # Writing to IO_COUNTERS_bit controls the counters: with bit 0 set,
+        # a snapshot of all counters is taken, which is what is read. With
+        # bit 1 set, the counters are reset (after taking the snapshot).
+        counter_events = [
+            "btb_hit", "btb_miss", "ras_hit", "ras_miss",
+            "cycles",
+            "wait_instr_cycles", "load_cycles", "wait_data_cycles",
+            "store_cycles",
+            "branch_taken", "branch_not_taken",
+            "loads", "stores",
+            "uart_wait_cycles"
+        ]
+
+        # UART polling: from a read of the status that says busy to a read
+        # that says ready, the CPU waits in putc_loop.
+        uart_status_read = Signal()
+        uart_polling = Signal()
+        m.d.comb += uart_status_read.eq(
+            isIO & cpu.mem_rstrb & mem_wordaddr[IO_UART_CNTL_bit])
+        with m.If(uart_status_read):
+            m.d.slow += uart_polling.eq(~uart_ready)
+
+        soc_events = {
+            "cycles": C(1, 1),
+            "uart_wait_cycles": uart_polling
+        }
+
+        counters = [Signal(32, name="counter_"+name)
+                    for name in counter_events]
+        snapshots = Array([Signal(32, name="snapshot_"+name)
+                           for name in counter_events])
+        self.counters = dict(zip(counter_events, counters))
+
+        counters_wstrb = Signal()
+        m.d.comb += counters_wstrb.eq(
+            isIO & mem_wstrb & mem_wordaddr[IO_COUNTERS_bit])
+
+        for name, counter, snapshot in zip(counter_events, counters,
+                                           snapshots):
+            with m.If(counters_wstrb & cpu.mem_wdata[0]):
+                m.d.slow += snapshot.eq(counter)
+            if name in soc_events:
+                event = soc_events[name]
+            elif hasattr(cpu, name):
+                event = getattr(cpu, name)
+            else:
+                continue
+            with m.If(counters_wstrb & cpu.mem_wdata[1]):
+                m.d.slow += counter.eq(0)
+            with m.Elif(event):
+                m.d.slow += counter.eq(counter + 1)
+
+        counter_index = mem_wordaddr[IO_COUNTERS_bit + 1:IO_COUNTERS_bit + 6]
+        counter_rdata = Mux(counter_index < len(snapshots),
+                            snapshots[counter_index], 0)
+
+        # Data from UART and counters
         m.d.comb += [
-            io_rdata.eq(Mux(mem_wordaddr[IO_UART_CNTL_bit],
-                Cat(C(0, 9), ~uart_ready, C(0, 22)), C(0, 32)))
+            io_rdata.eq(
+                Mux(mem_wordaddr[IO_COUNTERS_bit], counter_rdata,
+                    Mux(mem_wordaddr[IO_UART_CNTL_bit],
+                        Cat(C(0, 9), ~uart_ready, C(0, 22)), C(0, 32))))
         ]
 
 
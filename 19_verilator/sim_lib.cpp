@@ -0,0 +1,122 @@
+#include "Vsoc.h"
+#include "verilated.h"
+#include "verilated_vpi.h"
+#include <cstdint>
+#include <string>
+
+// C interface of the Verilated SOC, built as a shared library and used from
+// Python by verilated_soc.py.
+//
+// Signals are accessed by their hierarchical name below the SOC, e.g.
+// "leds" or "cpu.pc" (with VPI, so the design is built with
+// --public-flat-rw). Values are up to 64 bits wide.
+
+typedef void (*uart_callback)(int c);
+
+struct Sim {
+	Vsoc top;
+	uint64_t cycles;
+	uart_callback on_uart;
+};
+
+static vpiHandle
+handle(const char *name)
+{
+	std::string path = std::string("TOP.bench.soc.") + name;
+	return vpi_handle_by_name((PLI_BYTE8 *)path.c_str(), NULL);
+}
+
+extern "C" {
+
+Sim *
+soc_new(void)
+{
+	Sim *sim = new Sim();
+	sim->cycles = 0;
+	sim->on_uart = NULL;
+	sim->top.clk = 0;
+	sim->top.eval();
+	return sim;
+}
+
+void
+soc_delete(Sim *sim)
+{
+	sim->top.final();
+	delete sim;
+}
+
+void
+soc_set_uart_callback(Sim *sim, uart_callback on_uart)
+{
+	sim->on_uart = on_uart;
+}
+
+// Run n clock cycles (less if the design calls $finish), returns the number
+// of cycles since the start.
+uint64_t
+soc_step(Sim *sim, uint64_t n)
+{
+	Vsoc &top = sim->top;
+	for (uint64_t i = 0; i < n && !Verilated::gotFinish(); i++) {
+		for (int edge = 0; edge < 2; edge++) {
+			// The UART data is taken at the rising edge of the slow
+			// clock, with the values from before the edge
+			bool slow_clk = top.slow_clk;
+			bool uart_valid = top.uart_valid;
+			int uart_data = top.uart_data;
+			top.clk = !top.clk;
+			top.eval();
+			if (!slow_clk && top.slow_clk && uart_valid && sim->on_uart) {
+				sim->on_uart(uart_data);
+			}
+		}
+		sim->cycles++;
+	}
+	return sim->cycles;
+}
+
+// Returns the width of the signal, or -1 if there is no such signal
+int
+soc_peek(Sim *sim, const char *name, uint64_t *value)
+{
+	vpiHandle h = handle(name);
+	if (!h) {
+		return -1;
+	}
+	int size = vpi_get(vpiSize, h);
+	s_vpi_value v;
+	v.format = vpiVectorVal;
+	vpi_get_value(h, &v);
+	uint64_t result = (uint32_t)v.value.vector[0].aval;
+	if (size > 32) {
+		result |= (uint64_t)(uint32_t)v.value.vector[1].aval << 32;
+	}
+	*value = result;
+	vpi_release_handle(h);
+	return size;
+}
+
+int
+soc_poke(Sim *sim, const char *name, uint64_t value)
+{
+	vpiHandle h = handle(name);
+	if (!h) {
+		return -1;
+	}
+	int size = vpi_get(vpiSize, h);
+	s_vpi_vecval vector[2];
+	vector[0].aval = (uint32_t)value;
+	vector[0].bval = 0;
+	vector[1].aval = (uint32_t)(value >> 32);
+	vector[1].bval = 0;
+	s_vpi_value v;
+	v.format = vpiVectorVal;
+	v.value.vector = vector;
+	vpi_put_value(h, &v, NULL, vpiNoDelay);
+	vpi_release_handle(h);
+	sim->top.eval();
+	return size;
+}
+
+}
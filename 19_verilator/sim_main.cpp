@@ -1,15 +1,31 @@
 #include "Vsoc.h"
 #include "verilated.h"
+#include <cstdlib>
 #include <iostream>
 
+// Usage: Vsoc [max_cycles]
+// Without max_cycles (or 0), the simulation runs until $finish.
+
 int
 main(int argc, char **argv, char **env)
 {
+	Verilated::commandArgs(argc, argv);
+	unsigned long max_cycles = 0;
+	if (argc > 1) {
+		max_cycles = strtoul(argv[1], NULL, 0);
+	}
+
 	Vsoc top;
+	unsigned long cycles = 0;
 	top.clk = 0;
 	while (!Verilated::gotFinish()) {
 		top.clk = !top.clk;
 		top.eval();
+		if (top.clk && ++cycles == max_cycles) {
+			break;
+		}
 	}
+	top.final();
+	std::cout << std::endl << cycles << " cycles" << std::endl;
 	return 0;
 }
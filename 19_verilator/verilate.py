@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import sys
+import os
+import glob
+import hashlib
+import shutil
+import subprocess
+import time
+
+from amaranth import *
+from amaranth.hdl import Fragment
+from amaranth.back import verilog
+
+# Compiled simulation of the SOC of a step with Verilator.
+#
+# The SOC is elaborated for simulation (like in bench.py) and converted to
+# Verilog. A 'bench' module which instantiates the SOC and prints the
+# characters sent to the UART is added, then Verilator builds the simulator.
+# The build is kept in 19_verilator/obj_dir/<hash of the Verilog>, so it is
+# only done again when the design (or the options) change. The Verilog itself
+# is cached by the hash of the Python sources (lib/design_cache.py), so an
+# unchanged design is not even elaborated.
+#
+# The simulation runs until the design calls $finish or for the given number
+# of clock cycles (default 10000000, 0: no limit).
+#
+# python 19_verilator/verilate.py step_number [core] [option ...] [cycles=N]
+# e.g. python 19_verilator/verilate.py 18 pipelined rv32m cycles=50000000
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+verilator_args = ["-Wno-fatal", "--top-module", "bench", "--prefix", "Vsoc",
+                  "--cc", "--exe", "--build", "-j", "0", "-O3"]
+
+def step_path(step):
+    paths = glob.glob(os.path.join(root, "{:02d}_*".format(step)))
+    paths = [p for p in paths if os.path.exists(os.path.join(p, "soc.py"))]
+    if len(paths) != 1:
+        print("Invalid step_number {}.".format(step))
+        exit(1)
+    return paths[0]
+
+def bench_module(soc):
+    # Top level module for Verilator, with the UART monitor of the former
+    # snippet.v. The UART signals are also outputs, for verilated_soc.py.
+    lines = ["module bench(input clk, output slow_clk, output uart_valid,",
+             "             output [7:0] uart_data);"]
+    connections = [".clk(clk)", ".rst(1'b0)"]
+    if hasattr(soc, "uart_valid"):
+        lines += [
+            "  wire [31:0] mem_wdata;",
+            "  assign uart_data = mem_wdata[7:0];",
+            "`ifndef SOC_LIBRARY",
+            "  always @(posedge slow_clk)",
+            "    if (uart_valid) begin",
+            "      $write(\"%c\", uart_data);",
+            "      $fflush(32'h8000_0001);",
+            "    end",
+            "`endif"
+        ]
+        connections += [".slow_clk(slow_clk)", ".uart_valid(uart_valid)",
+                        ".mem_wdata(mem_wdata)"]
+    else:
+        lines += [
+            "  assign slow_clk = 1'b0;",
+            "  assign uart_valid = 1'b0;",
+            "  assign uart_data = 8'h00;"
+        ]
+    lines.append("  soc soc({});".format(", ".join(connections)))
+    lines.append("endmodule")
+    return "\n".join(lines) + "\n"
+
+def convert(soc):
+    # Elaborate first, the signals of the UART monitor only exist afterwards
+    fragment = Fragment.get(soc, None)
+    ports = [soc.leds]
+    if hasattr(soc, "tx"):
+        ports.append(soc.tx)
+    if hasattr(soc, "uart_valid"):
+        ports += [soc.slow_clk, soc.uart_valid, soc.cpu.mem_wdata]
+    return verilog.convert(fragment, name="soc", ports=ports,
+                           emit_src=False) + bench_module(soc)
+
+def build(verilog_text, main="sim_main.cpp", args=None, target="Vsoc"):
+    # Returns the path of the built target (the simulator binary by
+    # default), which is only built if it is not in the cache
+    main = os.path.join(here, main)
+    args = verilator_args + (args if args is not None else [])
+    with open(main) as f:
+        key = verilog_text + f.read() + " ".join(args)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    obj_dir = os.path.join(here, "obj_dir", digest)
+    path = os.path.join(obj_dir, target)
+    if os.path.exists(path):
+        print("using cached build {}".format(obj_dir))
+        return path
+
+    if shutil.which("verilator") is None:
+        print("verilator not found, please install it.")
+        exit(1)
+
+    os.makedirs(obj_dir, exist_ok=True)
+    soc_v = os.path.join(obj_dir, "soc.v")
+    with open(soc_v, "w") as f:
+        f.write(verilog_text)
+    print("building {}".format(obj_dir))
+    subprocess.run(["verilator"] + args + ["-Mdir", obj_dir, "-o", target,
+                   main, soc_v], check=True)
+    return path
+
+def convert_step(step, core=None, options=None):
+    # Returns the Verilog of the SOC of the step, from the cache if the
+    # sources didn't change
+    if options is None:
+        options = {}
+    add_step_path(step)
+    from design_cache import DesignCache
+
+    cache = DesignCache(step_path(step), "verilator", core, options,
+                        files=[__file__])
+    verilog_text = cache.load("soc.v")
+    if verilog_text is not None:
+        print("using cached Verilog {}".format(cache.path))
+        return verilog_text
+
+    # The SOC is only imported and elaborated without a cached Verilog
+    from soc import SOC
+    if core is not None:
+        soc = SOC(core=core, **options)
+    else:
+        soc = SOC()
+    verilog_text = convert(soc)
+    cache.store("soc.v", verilog_text)
+    return verilog_text
+
+def add_step_path(step):
+    # add project path to give priority to this project
+    # and avoid global including "soc" packages
+    sys.path = [step_path(step), os.path.join(root, "lib"),
+                os.path.join(root, "tools")] + sys.path
+
+def parse_options(args):
+    # Optional core of the SOC and options, e.g. 'rv32m' or 'regfile=memory'
+    if len(args) == 0:
+        return None, {}
+    core = args[0]
+    options = {}
+    for x in args[1:]:
+        if "=" in x:
+            key, value = x.split("=", 1)
+            options[key] = value
+        else:
+            options[x] = True
+    print("core = {}, options = {}".format(core, options))
+    return core, options
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        print("Usage: {} step_number [core] [option ...] [cycles=N]".format(
+            sys.argv[0]))
+        exit(1)
+    step = int(sys.argv[1])
+    print("step = {}".format(step))
+
+    cycles = 10000000
+    args = []
+    for x in sys.argv[2:]:
+        if x.startswith("cycles="):
+            cycles = int(x.split("=", 1)[1])
+        else:
+            args.append(x)
+
+    core, options = parse_options(args)
+    binary = build(convert_step(step, core, options))
+
+    start = time.time()
+    result = subprocess.run([binary, str(cycles)])
+    print("simulation took {:.2f} s".format(time.time() - start))
+    exit(result.returncode)
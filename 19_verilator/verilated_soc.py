@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import sys
+import os
+import ctypes
+import time
+
+from verilate import convert_step, parse_options, build
+
+# The Verilated SOC of a step as a shared library (sim_lib.cpp), for test
+# benches in Python which need more cycles than the Amaranth simulator can
+# run:
+#
+#   soc = VerilatedSOC(18, "pipelined", {"rv32m": True},
+#                      on_uart=lambda c: print(chr(c), end=""))
+#   soc.step(1000000)
+#   print(soc.peek("leds"), soc.peek("cpu.pc"))
+#
+# peek() and poke() take the hierarchical name of a signal below the SOC,
+# as in the Verilog generated by Amaranth. on_uart is called with every byte
+# sent to the UART.
+#
+# python 19_verilator/verilated_soc.py step_number [core] [option ...]
+#                                      [cycles=N]
+
+library_args = ["--vpi", "--public-flat-rw", "-DSOC_LIBRARY",
+                "-CFLAGS", "-fPIC", "-LDFLAGS", "-shared"]
+
+uart_callback = ctypes.CFUNCTYPE(None, ctypes.c_int)
+
+class VerilatedSOC():
+    def __init__(self, step, core=None, options={}, on_uart=None):
+        path = build(convert_step(step, core, options), main="sim_lib.cpp",
+                     args=library_args, target="libsoc.so")
+        lib = ctypes.CDLL(path)
+        lib.soc_new.restype = ctypes.c_void_p
+        lib.soc_delete.argtypes = [ctypes.c_void_p]
+        lib.soc_set_uart_callback.argtypes = [ctypes.c_void_p, uart_callback]
+        lib.soc_step.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
+        lib.soc_step.restype = ctypes.c_uint64
+        lib.soc_peek.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                 ctypes.POINTER(ctypes.c_uint64)]
+        lib.soc_peek.restype = ctypes.c_int
+        lib.soc_poke.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                 ctypes.c_uint64]
+        lib.soc_poke.restype = ctypes.c_int
+        self.lib = lib
+
+        self.sim = lib.soc_new()
+        self.cycles = 0
+
+        # Keep a reference, the library calls it
+        self.on_uart = None
+        if on_uart is not None:
+            self.on_uart = uart_callback(on_uart)
+            lib.soc_set_uart_callback(self.sim, self.on_uart)
+
+    def step(self, n=1):
+        # Runs n clock cycles, returns the number of cycles since the start
+        self.cycles = self.lib.soc_step(self.sim, n)
+        return self.cycles
+
+    def peek(self, name):
+        value = ctypes.c_uint64()
+        if self.lib.soc_peek(self.sim, name.encode(), ctypes.byref(value)) < 0:
+            raise ValueError("Unknown signal '{}'".format(name))
+        return value.value
+
+    def poke(self, name, value):
+        if self.lib.soc_poke(self.sim, name.encode(), value) < 0:
+            raise ValueError("Unknown signal '{}'".format(name))
+
+    def close(self):
+        if self.sim is not None:
+            self.lib.soc_delete(self.sim)
+            self.sim = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        print("Usage: {} step_number [core] [option ...] [cycles=N]".format(
+            sys.argv[0]))
+        exit(1)
+    step = int(sys.argv[1])
+    cycles = 10000000
+    args = []
+    for x in sys.argv[2:]:
+        if x.startswith("cycles="):
+            cycles = int(x.split("=", 1)[1])
+        else:
+            args.append(x)
+    core, options = parse_options(args)
+
+    def putc(c):
+        print(chr(c), end="", flush=True)
+
+    soc = VerilatedSOC(step, core, options, on_uart=putc)
+    start = time.time()
+    soc.step(cycles)
+    elapsed = time.time() - start
+    print("")
+    print("{} cycles in {:.2f} s, leds = {:05b}".format(
+        soc.cycles, elapsed, soc.peek("leds")))
+    soc.close()
@@ -1,7 +1,7 @@
 from amaranth_boards.arty_a7 import *
 from amaranth.build import *
 
-from top import Top
+from top import build
 
 if __name__ == "__main__":
     platform = ArtyA7_35Platform(toolchain="Symbiflow")
@@ -24,5 +24,5 @@ if __name__ == "__main__":
     leds = [led0, led1, led2, led3, rgb.r]
     uart = platform.request('uart', 1)
 
-    platform.build(Top(leds, uart), do_program=True)
+    build(platform, leds, uart)
 
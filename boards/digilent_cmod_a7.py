@@ -1,7 +1,7 @@
 from amaranth.build import *
 from amaranth_boards.cmod_a7 import *
 
-from top import Top
+from top import build
 
 if __name__ == "__main__":
     platform = CmodA7_35Platform(toolchain="Symbiflow")
@@ -22,4 +22,4 @@ if __name__ == "__main__":
     leds = [led0, led1, rgb.r, rgb.g, rgb.b]
     uart = platform.request('uart', 1)
 
-    platform.build(Top(leds, uart), do_program=True)
+    build(platform, leds, uart)
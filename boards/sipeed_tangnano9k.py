@@ -1,7 +1,7 @@
 from amaranth_boards.tang_nano_9k import *
 from amaranth.build import *
 
-from top import Top
+from top import build
 
 if __name__ == "__main__":
     platform = TangNano9kPlatform(toolchain="Gowin") # toolchain = (Gowin, Apicula)
@@ -16,5 +16,5 @@ if __name__ == "__main__":
     leds = [led0, led1, led2, led3, led4]
     uart = platform.request('uart', 0)
 
-    platform.build(Top(leds, uart), do_program=True)
+    build(platform, leds, uart)
 
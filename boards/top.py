@@ -1,63 +1,57 @@
 from amaranth import *
+from amaranth.build.run import BuildPlan, LocalBuildProducts
 
+import os
 import sys
+import glob
+
+from design_cache import DesignCache
+from log_level import set_log_level
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def step_path(step):
+    # The directory of the step in the repository, wherever the board file
+    # is run from
+    paths = glob.glob(os.path.join(root, "{:02d}_*".format(step)))
+    paths = [p for p in paths if os.path.exists(os.path.join(p, "soc.py"))]
+    if len(paths) != 1:
+        print("Invalid step_number {}.".format(step))
+        exit(1)
+    return paths[0]
 
 class Top(Elaboratable):
     def __init__(self, leds, uart):
         if len(sys.argv) == 1:
-            print("Usage: {} step_number".format(sys.argv[0]))
+            print("Usage: {} step_number [core] [option ...]".format(
+                sys.argv[0]))
             exit(1)
         step = int(sys.argv[1])
         print("step = {}".format(step))
         self.leds = leds
         self.uart = uart
 
-        # TODO: this is messy and should be done with iterating over dirs
-        if step == 1:
-            path = "01_blink"
-        elif step == 2:
-            path = "02_slower_blinky"
-        elif step == 3:
-            path = "03_blink_from_rom"
-        elif step == 4:
-            path = "04_instruction_decoder"
-        elif step == 5:
-            path = "05_register_bank"
-        elif step == 6:
-            path = "06_alu"
-        elif step == 7:
-            path = "07_assembler"
-        elif step == 8:
-            path = "08_jumps"
-        elif step == 9:
-            path = "09_branches"
-        elif step == 10:
-            path = "10_lui_auipc"
-        elif step == 11:
-            path = "11_modules"
-        elif step == 12:
-            path = "12_size_optimisation"
-        elif step == 13:
-            path = "13_subroutines"
-        elif step == 14:
-            path = "14_subroutines_v2"
-        elif step == 15:
-            path = "15_load"
-        elif step == 16:
-            path = "16_store"
-        elif step == 17:
-            path = "17_memory_map"
-        elif step == 18:
-            path = "18_mandelbrot"
-        else:
-            print("Invalid step_number {}.".format(step))
-            exit(1)
+        path = step_path(step)
 
         # add project path to give priority to this project
         # and avoid global including "soc" packages
         sys.path = [path] + sys.path
         from soc import SOC
-        self.soc = SOC()
+        if len(sys.argv) > 2:
+            # Optionally select one of the CPU cores of the SOC and enable
+            # options, e.g. 'rv32m' or 'regfile=memory'
+            core = sys.argv[2]
+            options = {}
+            for x in sys.argv[3:]:
+                if "=" in x:
+                    key, value = x.split("=", 1)
+                    options[key] = value
+                else:
+                    options[x] = True
+            print("core = {}, options = {}".format(core, options))
+            self.soc = SOC(core=core, **options)
+        else:
+            self.soc = SOC()
 
     def elaborate(self, platform):
         m = Module()
@@ -82,3 +76,43 @@ class Top(Elaboratable):
             ]
 
         return m
+
+def build(platform, leds, uart, name="top", build_dir="build",
+          do_program=True):
+    # Builds (and programs) the bitfile of the step on the command line, like
+    # platform.build(Top(leds, uart)). The build plan (RTLIL, Verilog and the
+    # toolchain scripts) is cached by the hash of the sources and the command
+    # line, so the SOC is only elaborated when something changed, and the
+    # toolchain is not run again when build_dir has the result of the same
+    # plan.
+    set_log_level()
+    if len(sys.argv) == 1:
+        print("Usage: {} step_number [core] [option ...]".format(
+            sys.argv[0]))
+        exit(1)
+    path = step_path(int(sys.argv[1]))
+    cache = DesignCache(path, type(platform).__name__,
+                        getattr(platform, "toolchain", None), sys.argv[1:],
+                        files=[__file__, sys.argv[0]])
+
+    files = cache.load_files("plan")
+    if files is None:
+        plan = platform.prepare(Top(leds, uart), name)
+        cache.store_files("plan", plan.files)
+    else:
+        print("using cached build plan {}".format(cache.path))
+        plan = BuildPlan(script="build_{}".format(name))
+        for filename, content in files.items():
+            plan.add_file(filename, content)
+
+    stamp = os.path.join(build_dir, name + ".key")
+    if os.path.exists(stamp) and open(stamp).read() == cache.key:
+        print("{} is up to date".format(build_dir))
+        products = LocalBuildProducts(os.path.abspath(build_dir))
+    else:
+        products = plan.execute_local(build_dir)
+        with open(stamp, "w") as f:
+            f.write(cache.key)
+
+    if do_program:
+        platform.toolchain_program(products, name)
@@ -0,0 +1,115 @@
+import json
+
+import amaranth
+from amaranth import *
+from amaranth.hdl import Fragment, MemoryInstance
+
+# Checkpoints of a simulation: the state of a design (all signals driven by
+# a clock domain, i.e. the registers, FSM states and counters, and the
+# contents of all memories) is saved to a file and can be restored in
+# another simulation of the same design:
+#
+#   fragment = Fragment.get(soc, None)
+#   checkpoint = Checkpoint(fragment)
+#   sim = Simulator(fragment)
+#   ...
+#   # in a test bench
+#   checkpoint.save(ctx, "mandelbrot.json", cycle)
+#   ...
+#   # in a test bench of a new simulation, before the first clock edge
+#   cycle = checkpoint.restore(ctx, "mandelbrot.json")
+#
+# A checkpoint is taken after a clock edge and restored before the first
+# clock edge of the new simulation, which continues with the next edge.
+# Derived clocks (Clockworks with slow != 0) are computed from the restored
+# counter, a checkpoint has to be taken while they are low, otherwise the
+# restore makes an extra edge of the derived clock.
+#
+# Amaranth has no public interface to list the state of a design, the
+# elaborated fragments are walked. Their attributes are private and change
+# between Amaranth versions, they are only used in walk(), which is checked
+# against the versions it was written for.
+
+supported_versions = ["0.5"]
+
+def check_version():
+    version = ".".join(amaranth.__version__.split(".")[:2])
+    if version not in supported_versions:
+        raise RuntimeError("Checkpoint supports Amaranth {}, not {}".format(
+            ", ".join(supported_versions), amaranth.__version__))
+
+def walk(fragment, path):
+    # Yields ("signal", path, name, signal) for the signals driven by a clock
+    # domain and ("memory", path, name, data) for the memories
+    try:
+        if isinstance(fragment, MemoryInstance):
+            data = fragment._data
+            yield "memory", path, data.name, data
+            for port in fragment._read_ports:
+                if port._domain != "comb":
+                    for signal in port._data._rhs_signals():
+                        yield "signal", path, signal.name, signal
+        for domain, statements in fragment.statements.items():
+            if domain == "comb":
+                continue
+            signals = set()
+            for statement in statements:
+                signals |= statement._lhs_signals()
+            for signal in sorted(signals, key=lambda s: s.name):
+                yield "signal", path, signal.name, signal
+        subfragments = fragment.subfragments
+    except AttributeError as e:
+        raise RuntimeError("Checkpoint cannot walk the design with Amaranth "
+                           "{}: {}".format(amaranth.__version__, e)) from e
+    for i, (subfragment, name, src_loc) in enumerate(subfragments):
+        yield from walk(subfragment, "{}.{}".format(
+            path, name if name is not None else "U${}".format(i)))
+
+class Checkpoint():
+    def __init__(self, fragment):
+        check_version()
+        self.signals = {}
+        self.memories = {}
+        for kind, path, name, obj in walk(fragment, "top"):
+            self.add(self.signals if kind == "signal" else self.memories,
+                     path, name, obj)
+
+    def add(self, table, path, name, obj):
+        key = "{}.{}".format(path, name)
+        n = 1
+        while key in table:
+            n += 1
+            key = "{}.{}${}".format(path, name, n)
+        table[key] = obj
+
+    def save(self, ctx, filename, cycle=0):
+        state = {
+            "cycle": cycle,
+            "signals": {key: ctx.get(signal)
+                        for key, signal in self.signals.items()},
+            "memories": {key: [ctx.get(data[i]) for i in range(data.depth)]
+                         for key, data in self.memories.items()}
+        }
+        with open(filename, "w") as f:
+            json.dump(state, f)
+        print("checkpoint: cycle {}, {} signals, {} memories saved to {}"
+              .format(cycle, len(self.signals), len(self.memories),
+                      filename))
+
+    def restore(self, ctx, filename):
+        # Returns the cycle of the checkpoint
+        with open(filename) as f:
+            state = json.load(f)
+        if (state["signals"].keys() != self.signals.keys() or
+                state["memories"].keys() != self.memories.keys()):
+            raise ValueError("Checkpoint {} is not from this design".format(
+                filename))
+        for key, value in state["signals"].items():
+            ctx.set(self.signals[key], value)
+        for key, values in state["memories"].items():
+            data = self.memories[key]
+            for i, value in enumerate(values):
+                ctx.set(data[i], value)
+        print("checkpoint: cycle {} restored from {}".format(state["cycle"],
+                                                            filename))
+        return state["cycle"]
@@ -0,0 +1,101 @@
+import os
+import glob
+import hashlib
+
+import amaranth
+
+# Cache of what is generated from the design of a step (the Verilog for
+# Verilator, the build plan of a bitfile with the RTLIL and the toolchain
+# scripts), keyed by a hash of everything it is generated from: the Python
+# sources of the step, of lib, of the assembler and its runtime library (the
+# firmware is assembled by the SOC), the Amaranth version and the parameters
+# (core, options, board).
+# On a hit, the SOC is neither instantiated nor elaborated:
+#
+#   cache = DesignCache(step_path, "verilator", core, options)
+#   text = cache.load("soc.v")
+#   if text is None:
+#       text = convert(SOC())
+#       cache.store("soc.v", text)
+#
+# The cache is kept in .design_cache in the repository, it can be deleted at
+# any time.
+#
+# Simulator fragments are not cached, Amaranth can't pickle them, and the
+# test benches only spend a fraction of a second elaborating.
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cache_dir = os.path.join(root, ".design_cache")
+
+def source_hash(step_path, params, files=None):
+    if files is None:
+        files = []
+    h = hashlib.sha256(amaranth.__version__.encode())
+    paths = (glob.glob(os.path.join(step_path, "*.py")) +
+             glob.glob(os.path.join(root, "lib", "*.py")) +
+             [os.path.join(root, "tools", "riscv_assembler.py")] +
+             glob.glob(os.path.join(root, "tools", "runtime", "*.s")) +
+             [os.path.abspath(f) for f in files])
+    for path in sorted(set(paths)):
+        h.update(os.path.relpath(path, root).encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+    # Options from the command line, in any order
+    for param in params:
+        if isinstance(param, dict):
+            param = sorted(param.items())
+        h.update(repr(param).encode())
+    return h.hexdigest()[:16]
+
+class DesignCache():
+    def __init__(self, step_path, *params, files=None):
+        # step_path: absolute, the hash doesn't depend on the current
+        # directory. files: more sources, e.g. the board file
+        if not os.path.isabs(step_path):
+            raise ValueError("Step path {} is not absolute".format(step_path))
+        self.key = source_hash(step_path, params, files)
+        self.path = os.path.join(cache_dir, self.key)
+
+    def load(self, name):
+        # Returns the text stored as name, None if it isn't in the cache
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+    def store(self, name, text):
+        os.makedirs(self.path, exist_ok=True)
+        # Write and rename, an interrupted run doesn't leave half a file
+        path = os.path.join(self.path, name)
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def load_files(self, name):
+        # Returns the files stored as name (a dict of file name: bytes),
+        # None if they aren't in the cache
+        directory = os.path.join(self.path, name)
+        if not os.path.exists(os.path.join(directory, ".complete")):
+            return None
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(path, directory)
+                if relpath != ".complete":
+                    with open(path, "rb") as f:
+                        files[relpath] = f.read()
+        return files
+
+    def store_files(self, name, files):
+        # Stores a dict of file name: text or bytes, like BuildPlan.files
+        directory = os.path.join(self.path, name)
+        for filename, content in files.items():
+            path = os.path.join(directory, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if isinstance(content, str):
+                content = content.encode()
+            with open(path, "wb") as f:
+                f.write(content)
+        open(os.path.join(directory, ".complete"), "w").close()
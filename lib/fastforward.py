@@ -0,0 +1,191 @@
+from amaranth import *
+from amaranth.hdl import Shape
+
+# Fast-forward of spin loops in the simulation.
+#
+# The firmware spends most of its time in short loops that do nothing but
+# wait: counting down a register (wait_loop) or polling the UART until it is
+# ready (putc_loop). When the pc enters a backward branch whose loop body
+# has no side effects (no stores, jumps or system instructions), the loop is
+# measured for a few iterations. If the whole state of the SOC (the
+# registers of a Checkpoint, without the big memories) changes by the same
+# amount from iteration to iteration, or from every m iterations to the next
+# m, with m up to max_stride for periodic counters like the mtime
+# prescaler, the loop is fast-forwarded: all the state is advanced by k
+# times that amount and the UART transmitter by the cycles of k iterations
+# (UartTx.advance()). The number of iterations skipped is limited by the
+# branch (a register counting down to the other one), or for loops that
+# wait for the UART by the cycles until it is ready. The last iterations
+# always run in the simulation, the CPU leaves the loop by itself.
+#
+#   fragment = Fragment.get(soc, None)
+#   fastforward = FastForward(soc, Checkpoint(fragment))
+#   sim = Simulator(fragment)
+#   sim.add_testbench(fastforward.testbench)
+#
+# The simulated time does not include the skipped cycles, they are counted in
+# fastforward.skipped.
+
+OP_LOAD = 0b0000011
+OP_IMM = 0b0010011
+OP_AUIPC = 0b0010111
+OP_REG = 0b0110011
+OP_LUI = 0b0110111
+OP_BRANCH = 0b1100011
+
+BNE = 0b001
+
+def branch_offset(word):
+    offset = ((word >> 31) << 12) | (((word >> 7) & 1) << 11) | \
+             (((word >> 25) & 0x3f) << 5) | (((word >> 8) & 0xf) << 1)
+    return offset - (1 << 13) if offset >> 12 else offset
+
+class FastForward():
+    def __init__(self, soc, checkpoint, domain="slow", max_body=8,
+                 max_stride=12):
+        self.cpu = soc.cpu
+        self.uart = getattr(soc, "uart_tx", None)
+        self.domain = domain
+        self.max_stride = max_stride
+        self.skipped = 0
+
+        # The state to advance, the UART is advanced by its model and the
+        # memories with the program (no stores in the loops) are left out
+        uart = [] if self.uart is None else [self.uart.cnt, self.uart.shift,
+                                             self.uart.ready]
+        self.state_values = [s for s in checkpoint.signals.values()
+                             if not any(s is u for u in uart)]
+        for data in checkpoint.memories.values():
+            if data.depth <= 64:
+                self.state_values += [data[i] for i in range(data.depth)]
+        self.shapes = [Shape.cast(v.shape()) for v in self.state_values]
+        self.masks = [(1 << shape.width) - 1 for shape in self.shapes]
+
+        # Spin loops by the address of their first instruction:
+        # (address of the branch, branch, has loads)
+        self.loops = {}
+        words = soc.memory.instructions
+        for i, word in enumerate(words):
+            offset = branch_offset(word)
+            if word & 0x7f != OP_BRANCH or not -4 * max_body <= offset < 0:
+                continue
+            body = words[i + offset // 4:i]
+            ops = [w & 0x7f for w in body]
+            if all(op in (OP_LOAD, OP_IMM, OP_AUIPC, OP_REG, OP_LUI)
+                   for op in ops):
+                self.loops[4 * i + offset] = (4 * i, word, OP_LOAD in ops)
+
+    def state(self, ctx):
+        return [ctx.get(v) for v in self.state_values]
+
+    def reg(self, ctx, n):
+        return 0 if n == 0 else ctx.get(self.cpu.regs[n])
+
+    async def iteration(self, ctx, head, end):
+        # Cycles until the pc is back at head, None if the loop is left
+        n = 0
+        prev = ctx.get(self.cpu.pc)
+        while True:
+            await ctx.tick(self.domain)
+            n += 1
+            pc = ctx.get(self.cpu.pc)
+            if pc == head and prev != head:
+                return n
+            if not head <= pc <= end + 16 or n > 1000:
+                return None
+            prev = pc
+
+    def linear(self, s0, s1, s2):
+        # Changes from s0 to s1, None if s1 to s2 is different
+        deltas = []
+        for v0, v1, v2, mask in zip(s0, s1, s2, self.masks):
+            delta = (v1 - v0) & mask
+            if (v2 - v1) & mask != delta:
+                return None
+            deltas.append(delta)
+        return deltas
+
+    async def fast_forward(self, ctx, head):
+        # Returns False if the loop can't be fast-forwarded
+        end, branch, loads = self.loops[head]
+        rs1 = (branch >> 15) & 0x1f
+        rs2 = (branch >> 20) & 0x1f
+
+        # Iterations until the state changes the same way from m iterations
+        # to the next m
+        states = []
+        cycles = []
+        regs = []
+        deltas = None
+        while deltas is None:
+            if len(states) > 2 * self.max_stride:
+                return False
+            n = await self.iteration(ctx, head, end)
+            if n is None:
+                return False
+            states.append(self.state(ctx))
+            cycles.append(n)
+            regs.append((self.reg(ctx, rs1) - self.reg(ctx, rs2)) &
+                        0xffffffff)
+            for m in range(1, (len(states) - 1) // 2 + 1):
+                if sum(cycles[-2 * m:-m]) != sum(cycles[-m:]):
+                    continue
+                deltas = self.linear(states[-1 - 2 * m], states[-1 - m],
+                                     states[-1])
+                if deltas is not None:
+                    break
+        stride = sum(cycles[-m:])
+
+        # Strides until the CPU leaves the loop
+        limits = []
+        diff = regs[-1]
+        change = (regs[-1] - regs[-1 - m]) & 0xffffffff
+        if change != 0:
+            if (branch >> 12) & 0x7 != BNE:
+                return False
+            if change == (-m) & 0xffffffff:
+                limits.append(diff // m)
+            elif change == m:
+                limits.append(((-diff) & 0xffffffff) // m)
+            else:
+                return False
+        uart = None
+        if self.uart is not None:
+            uart = (ctx.get(self.uart.cnt), ctx.get(self.uart.shift),
+                    ctx.get(self.uart.ready))
+        if change == 0 or loads:
+            # Waiting for the UART
+            if uart is None or uart[2]:
+                return False
+            limits.append(self.uart.advance(*uart)[3] // stride)
+        k = min(limits) - 3
+        if k <= 0:
+            return False
+
+        for value, delta, shape, mask, v in zip(
+                states[-1], deltas, self.shapes, self.masks,
+                self.state_values):
+            if delta != 0:
+                value = (value + k * delta) & mask
+                if shape.signed and value >> (shape.width - 1):
+                    value -= 1 << shape.width
+                ctx.set(v, value)
+        if uart is not None:
+            cnt, data, ready, n = self.uart.advance(*uart, k * stride)
+            ctx.set(self.uart.cnt, cnt)
+            ctx.set(self.uart.shift, data)
+            ctx.set(self.uart.ready, ready)
+        self.skipped += k * stride
+        return True
+
+    async def testbench(self, ctx):
+        while True:
+            pc, = await ctx.changed(self.cpu.pc)
+            if pc not in self.loops:
+                continue
+            if not await self.fast_forward(ctx, pc):
+                # Not again until the loop is left
+                end = self.loops[pc][0]
+                head = pc
+                while head <= pc <= end + 16:
+                    pc, = await ctx.changed(self.cpu.pc)
@@ -0,0 +1,19 @@
+# The options of the SOCs and the CPU cores come from the command line,
+# either alone ('rv32m', True) or with a value ('predict=0', a string).
+
+true_values = ["1", "true", "yes", "on"]
+false_values = ["0", "false", "no", "off"]
+
+def bool_option(name, value):
+    # The value of a boolean option as True or False
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in [0, 1]:
+        return bool(value)
+    if isinstance(value, str):
+        if value.lower() in true_values:
+            return True
+        if value.lower() in false_values:
+            return False
+    raise ValueError("Option '{}' must be one of {}, not '{}'".format(
+        name, ", ".join(true_values + false_values), value))
@@ -0,0 +1,72 @@
+from amaranth import *
+
+# Building blocks for the test benches (Simulator.add_testbench).
+#
+# The test benches wait for the events they are interested in (a signal
+# changes, the slow clock ticks) instead of being woken up on every clock
+# cycle and comparing all signals with their previous values. Each of the
+# functions below returns a test bench, several of them can be added to the
+# same simulator:
+#
+#   sim.add_testbench(uart_monitor(soc))
+#   sim.add_testbench(nop_monitor(soc, print_regs))
+
+NOP = 0b00000000000000000000000000110011
+
+def on_change(signal, callback):
+    # Calls callback(ctx, value) whenever the value of signal changes. The
+    # test bench ends when callback returns True.
+    async def testbench(ctx):
+        prev = ctx.get(signal)
+        while True:
+            value, = await ctx.changed(signal)
+            # Glitches wake up the test bench without a change
+            if value == prev:
+                continue
+            prev = value
+            if callback(ctx, value):
+                break
+    return testbench
+
+def on_slow_clk(callback, domain="slow"):
+    # Calls callback(ctx) after every rising edge of the clock of domain.
+    # The test bench ends when callback returns True.
+    async def testbench(ctx):
+        while True:
+            await ctx.tick(domain)
+            if callback(ctx):
+                break
+    return testbench
+
+def uart_monitor(soc, on_uart=None, domain="slow"):
+    # Calls on_uart(c) (default: print it) with every byte the CPU sends to
+    # the UART of the SOC. The monitor only wakes up at the slow clock while
+    # uart_valid is set.
+    if on_uart is None:
+        def on_uart(c):
+            print("out: '{}'".format(chr(c)))
+
+    async def testbench(ctx):
+        while True:
+            valid, = await ctx.changed(soc.uart_valid)
+            while valid:
+                # uart_valid glitches while the bus of the pipelined cores
+                # settles, the byte is taken from the values at the edge
+                _, _, valid, data = await ctx.tick(domain).sample(
+                    soc.uart_valid, soc.cpu.mem_wdata[0:8])
+                if valid:
+                    on_uart(data)
+                valid = ctx.get(soc.uart_valid)
+    return testbench
+
+def nop_monitor(soc, on_nop):
+    # Calls on_nop(ctx, pc) when the pc of the CPU changes and the word read
+    # from the memory is a NOP (ADD x0, x0, x0), which the firmware uses as a
+    # marker for the test bench.
+    cpu = soc.cpu
+    mem = soc.memory
+
+    def changed(ctx, pc):
+        if ctx.get(mem.mem_rdata) == NOP:
+            on_nop(ctx, pc)
+    return on_change(cpu.pc, changed)
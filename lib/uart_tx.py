@@ -1,3 +1,5 @@
+import logging
+
 from amaranth import *
 
 # This module is designed after corescore_emitter_uart by Olof Kindgren which
@@ -9,6 +11,8 @@ from amaranth import *
 # A copy of this license file is included in this repository in the LICENSES
 # directory.
 
+log = logging.getLogger("uart_tx")
+
 class UartTx(Elaboratable):
 
     def __init__(self, freq_hz=0, baud_rate=57600):
@@ -28,11 +32,17 @@ class UartTx(Elaboratable):
         start_value = self.freq_hz // self.baud_rate
         width = len(Const(start_value))
 
-        print("UartTx: start_value = {}, width = {}".format(start_value, width))
+        log.info("start_value = %d, width = %d", start_value, width)
 
         cnt = Signal(width+1)
         data = Signal(10)
 
+        # For the model in advance()
+        self.start_value = start_value
+        self.width = width
+        self.cnt = cnt
+        self.shift = data
+
         ready = self.ready
         valid = self.valid
 
@@ -57,3 +67,27 @@ class UartTx(Elaboratable):
             m.d.sync += data.eq(Cat(C(0, 1), self.data, C(1, 1)))
 
         return m
+
+    def advance(self, cnt, data, ready, cycles=None):
+        # Model of the transmitter for the simulation (lib/fastforward.py):
+        # the state (cnt, data, ready) after a number of cycles without a
+        # new byte, or (cycles=None) when it gets ready. Returns the state and
+        # the number of cycles.
+        top = 1 << self.width
+        mask = (top << 1) - 1
+        left = cycles
+        n = 0
+        while not ready and (left is None or n < left):
+            if cnt & top:
+                ready = int(data == 0)
+                cnt = self.start_value
+                data >>= 1
+                n += 1
+            else:
+                step = cnt + 1 if left is None else min(cnt + 1, left - n)
+                cnt = (cnt - step) & mask
+                n += step
+        if ready and left is not None and left > 0:
+            cnt = self.start_value
+            n = left
+        return cnt, data, ready, n
@@ -0,0 +1,179 @@
+import os
+import gzip
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+
+from amaranth import *
+
+# Selective waveform capture, as an alternative to Simulator.write_vcd() which
+# records every signal change of the whole simulation.
+#
+# A Trace samples its signals once per clock cycle of a domain, but only from
+# the moment a trigger fires, for a number of cycles (or until the end of
+# the simulation):
+#
+#   trace = Trace("bench.vcd.gz", soc.ports, trigger=UartTrigger(soc, "\n"),
+#                 length=1000, history=100)
+#   sim.add_testbench(trace.testbench)
+#   ...
+#   trace.close()
+#
+# With history, the last cycles before the trigger are kept in a ring buffer
+# and written as well. Without trigger, only the ring buffer is kept, it is
+# written by dump(), e.g. when a test bench detects a failure.
+#
+# The time in the waveform is the number of the sample (one per cycle).
+# Files ending with '.gz' are compressed, '.fst' files are converted with
+# vcd2fst (from GTKWave).
+
+class WindowTrigger():
+    # Fires after start cycles
+    def __init__(self, start):
+        self.start = start
+
+    async def wait(self, ctx, domain):
+        await ctx.tick(domain).repeat(self.start)
+
+    def check(self, ctx, cycle):
+        return cycle >= self.start
+
+class PcTrigger():
+    # Fires when the pc is in start ... end - 1
+    def __init__(self, pc, start, end):
+        self.pc = pc
+        self.start = start
+        self.end = end
+
+    async def wait(self, ctx, domain):
+        pc = ctx.get(self.pc)
+        while not self.start <= pc < self.end:
+            pc, = await ctx.changed(self.pc)
+
+    def check(self, ctx, cycle):
+        return self.start <= ctx.get(self.pc) < self.end
+
+class UartTrigger():
+    # Fires when the character c (any character if None) is sent to the UART
+    def __init__(self, soc, c=None):
+        self.soc = soc
+        self.c = c
+
+    def sent(self, ctx):
+        return (ctx.get(self.soc.uart_valid) and
+                (self.c is None or
+                 ctx.get(self.soc.cpu.mem_wdata[0:8]) == ord(self.c)))
+
+    async def wait(self, ctx, domain):
+        while not self.sent(ctx):
+            await ctx.changed(self.soc.uart_valid, self.soc.cpu.mem_wdata)
+            # uart_valid glitches while the bus of the pipelined cores settles
+            await ctx.delay(0)
+
+    def check(self, ctx, cycle):
+        return self.sent(ctx)
+
+class Trace():
+    def __init__(self, filename, signals, trigger=None, length=None,
+                 history=0, domain="slow"):
+        if filename.endswith(".fst") and shutil.which("vcd2fst") is None:
+            print("vcd2fst not found, please install GTKWave.")
+            exit(1)
+        self.filename = filename
+        self.signals = list(signals)
+        self.trigger = trigger
+        # Number of cycles recorded after the trigger, None: no limit
+        self.length = length
+        self.history = deque(maxlen=history) if history > 0 else None
+        self.domain = domain
+
+        self.samples = []
+        self.triggered = None
+        self.written = False
+
+    def sample(self, ctx):
+        return tuple(ctx.get(s) for s in self.signals)
+
+    async def testbench(self, ctx):
+        cycle = 0
+        if self.history is not None:
+            # Sample every cycle into the ring buffer until the trigger
+            while self.trigger is None or not self.trigger.check(ctx, cycle):
+                self.history.append(self.sample(ctx))
+                await ctx.tick(self.domain)
+                cycle += 1
+        elif self.trigger is not None:
+            # Nothing to record until the trigger
+            await self.trigger.wait(ctx, self.domain)
+
+        self.triggered = len(self.history) if self.history is not None else 0
+        while self.length is None or len(self.samples) < self.length:
+            self.samples.append(self.sample(ctx))
+            await ctx.tick(self.domain)
+        self.close()
+
+    def dump(self, filename=None):
+        # Writes the ring buffer (and what has been recorded after the
+        # trigger)
+        self.write(filename or self.filename)
+
+    def close(self):
+        # Writes the trace, if the trigger has fired
+        if not self.written and self.triggered is not None:
+            self.write(self.filename)
+
+    def write(self, filename):
+        samples = list(self.history or []) + self.samples
+        if filename.endswith(".fst"):
+            with tempfile.TemporaryDirectory() as tmp:
+                vcd = os.path.join(tmp, "trace.vcd")
+                with open(vcd, "w") as f:
+                    self.write_vcd(f, samples)
+                subprocess.run(["vcd2fst", vcd, filename], check=True)
+        elif filename.endswith(".gz"):
+            with gzip.open(filename, "wt") as f:
+                self.write_vcd(f, samples)
+        else:
+            with open(filename, "w") as f:
+                self.write_vcd(f, samples)
+        self.written = True
+        print("trace: {} samples written to {}".format(len(samples),
+                                                       filename))
+
+    def write_vcd(self, f, samples):
+        ids = [self.vcd_id(i) for i in range(len(self.signals))]
+        f.write("$timescale 1 us $end\n")
+        if self.triggered is not None:
+            f.write("$comment triggered at {} $end\n".format(self.triggered))
+        f.write("$scope module top $end\n")
+        for signal, id in zip(self.signals, ids):
+            f.write("$var wire {} {} {} $end\n".format(len(signal), id,
+                                                       signal.name))
+        f.write("$upscope $end\n$enddefinitions $end\n")
+
+        prev = None
+        for time, values in enumerate(samples):
+            changes = [i for i, value in enumerate(values)
+                       if prev is None or prev[i] != value]
+            if changes:
+                f.write("#{}\n".format(time))
+            for i in changes:
+                width = len(self.signals[i])
+                value = values[i] & ((1 << width) - 1)
+                if width == 1:
+                    f.write("{}{}\n".format(value, ids[i]))
+                else:
+                    f.write("b{:b} {}\n".format(value, ids[i]))
+            prev = values
+        f.write("#{}\n".format(len(samples)))
+
+    @staticmethod
+    def vcd_id(i):
+        # Short identifiers of printable characters
+        id = ""
+        while True:
+            id += chr(33 + i % 94)
+            i //= 94
+            if i == 0:
+                return id
@@ -3,34 +3,25 @@ from amaranth.sim import *
 from ctypes import c_int32 as int32
 
 from soc import SOC
+from testbench import uart_monitor, nop_monitor
+from log_level import set_log_level
 
+set_log_level()
 soc = SOC()
 
 sim = Simulator(soc)
 
-def proc():
+def print_regs(ctx, pc):
     cpu = soc.cpu
-    mem = soc.memory
-    prev_pc = 0
-    while True:
-        pc = yield cpu.pc
-        uart_valid = (yield soc.uart_valid)
-        if uart_valid:
-            print("out: '{}'".format(chr((yield soc.mem_wdata[0:8]))))
-        rdata = (yield mem.mem_rdata)
-        if prev_pc != pc:
-            prev_pc = pc
-            if rdata == 0b00000000000000000000000000110011:
-                print("pc=0x{:04x}={:4d} NOP!".format(pc, pc))
-                for i in range(5):
-                    reg = (yield cpu.regs[10 + i])
-                    regi = int32(reg).value
-                    print("   a{} = {}={}".format(i, regi, hex(reg)))
-
-        yield
+    print("pc=0x{:04x}={:4d} NOP!".format(pc, pc))
+    for i in range(5):
+        reg = ctx.get(cpu.regs[10 + i])
+        regi = int32(reg).value
+        print("   a{} = {}={}".format(i, regi, hex(reg)))
 
 sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+sim.add_testbench(uart_monitor(soc))
+sim.add_testbench(nop_monitor(soc, print_regs))
 
 with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
     # Let's run for a quite long time
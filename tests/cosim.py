@@ -0,0 +1,136 @@
+import sys
+from amaranth import *
+from amaranth.sim import *
+
+from soc import SOC
+from riscv_iss import RiscvISS
+from log_level import set_log_level
+
+# Lockstep co-simulation of the CPU against the instruction set simulator in
+# tools/riscv_iss.py.
+#
+# Every instruction the CPU executes is also executed by the instruction set
+# simulator, then the results are compared: the pc, the register written
+# back and the data stored to memory. The co-simulation stops at the first
+# difference, when the CPU halts (EBREAK) or after n_cycles.
+#
+# Values loaded from the IO page (e.g. the UART status) can't be known by the
+# instruction set simulator, it takes the values the CPU has read.
+#
+# python cosim.py [program.s] [n_cycles]
+# Without a program, the test code of the assembler is used.
+
+def compare(expected, writes, stores):
+    pc, rd, value, store = expected
+    if rd == 0:
+        if len(writes) > 0:
+            return "unexpected write of x{} = 0x{:08x}".format(*writes[0])
+    elif writes != [(rd, value)]:
+        return "expected write of x{} = 0x{:08x}, got {}".format(
+            rd, value, ", ".join("x{} = 0x{:08x}".format(*w) for w in writes)
+            or "none")
+
+    if store is None:
+        if len(stores) > 0:
+            return "unexpected store {}".format(stores[0])
+    else:
+        addr, wmask, wdata = store
+        mask = sum(0xff << (8 * i) for i in range(4) if (wmask >> i) & 1)
+        if (len(stores) != 1 or stores[0][0] != addr or
+                stores[0][1] != wmask or (stores[0][2] & mask) != wdata & mask):
+            return ("expected store addr=0x{:08x} wmask=0b{:04b} "
+                    "wdata=0x{:08x}, got {}".format(addr, wmask, wdata & mask,
+                                                    stores or "none"))
+    return None
+
+def cosim(program=None, n_cycles=100000):
+    soc = SOC(program=program)
+    sim = Simulator(soc)
+    cpu = soc.cpu
+
+    instructions = soc.memory.instructions
+    iss = RiscvISS(instructions, ram_size=4 * len(instructions))
+
+    result = {"instructions": 0, "cycles": 0, "error": None}
+
+    async def testbench(ctx):
+        expected = None
+        ioLoad = False
+        writes = []
+        stores = []
+
+        for cycle in range(n_cycles):
+            result["cycles"] = cycle
+
+            if ctx.get(cpu.execute):
+                # The previous instruction is complete
+                if expected is not None:
+                    if ioLoad and expected[1] != 0 and len(writes) == 1:
+                        iss.x[expected[1]] = writes[0][1]
+                        expected = expected[0:2] + (writes[0][1],) + \
+                            expected[3:]
+                    error = compare(expected, writes, stores)
+                    if error is not None:
+                        result["error"] = "pc=0x{:08x}: {}".format(
+                            expected[0], error)
+                        return
+                    result["instructions"] += 1
+
+                writes = []
+                stores = []
+
+                # Next instruction
+                pc = ctx.get(cpu.pc)
+                if pc != iss.pc:
+                    result["error"] = "pc=0x{:08x}, expected 0x{:08x}".format(
+                        pc, iss.pc)
+                    return
+
+                op, rd, funct3, rs1, rs2, funct7, imm = iss.decode(
+                    iss.ram[iss.pc >> 2])
+                ioLoad = (op == 0b0000011 and
+                          ((iss.x[rs1] + imm) >> 22) & 1 == 1)
+
+                expected = iss.step()
+                if ctx.get(cpu.isSystem):
+                    if not iss.halted:
+                        result["error"] = "pc=0x{:08x}: CPU halted".format(pc)
+                    return
+                if iss.halted:
+                    result["error"] = "pc=0x{:08x}: CPU did not halt".format(
+                        pc)
+                    return
+
+            if ctx.get(cpu.writeBackEn):
+                writes.append((ctx.get(cpu.rdId), ctx.get(cpu.writeBackData)))
+            wmask = ctx.get(cpu.mem_wmask)
+            if wmask != 0:
+                stores.append((ctx.get(cpu.mem_addr) & ~3, wmask,
+                               ctx.get(cpu.mem_wdata)))
+
+            await ctx.tick("slow")
+
+    sim.add_clock(1e-6)
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return result
+
+if __name__ == "__main__":
+    set_log_level()
+    program = None
+    n_cycles = 100000
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            n_cycles = int(arg)
+        else:
+            with open(arg) as f:
+                program = f.read()
+
+    result = cosim(program, n_cycles)
+    print("{} instructions in {} cycles".format(result["instructions"],
+                                                result["cycles"]))
+    if result["error"] is not None:
+        print("DIVERGED: {}".format(result["error"]))
+        exit(1)
+    print("OK")
@@ -11,6 +11,11 @@ class CPU(Elaboratable):
         self.x10 = Signal(32)
         self.fsm = None
 
+        # For the co-simulation: an instruction is in EXECUTE for one cycle,
+        # its result is written back in EXECUTE (or WAIT_DATA for loads)
+        self.execute = Signal()
+        self.writeBackEn = Signal()
+
     def elaborate(self, platform):
         m = Module()
 
@@ -284,6 +289,11 @@ class CPU(Elaboratable):
         writeBackEn = ((fsm.ongoing("EXECUTE") & ~isBranch & ~isStore & ~isLoad)
                        | fsm.ongoing("WAIT_DATA"))
 
+        m.d.comb += [
+            self.execute.eq(fsm.ongoing("EXECUTE")),
+            self.writeBackEn.eq(writeBackEn & (rdId != 0))
+        ]
+
         self.writeBackData = writeBackData
 
 
@@ -1,18 +1,29 @@
+import logging
 from amaranth import *
 from riscv_assembler import RiscvAssembler
 
+log = logging.getLogger("memory")
+
 class Mem(Elaboratable):
 
-    def __init__(self, simulation = False):
+    def __init__(self, simulation = False, program = None):
         self.simulation = simulation
 
         a = RiscvAssembler(simulation=simulation)
-        a.read(a.testCode())
+        if program is None:
+            a.read(a.testCode())
+        else:
+            a.read(program)
         a.assemble()
 
         self.instructions = a.mem
 
-        print("memory = {}".format(self.instructions))
+        # Other programs get 6 kB of RAM, for data and the stack
+        if program is not None:
+            while len(self.instructions) < (1024 * 6 / 4):
+                self.instructions.append(0)
+
+        log.debug("memory = %s", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Memory(width=32, depth=len(self.instructions),
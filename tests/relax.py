@@ -0,0 +1,53 @@
+from riscv_assembler import RiscvAssembler
+from riscv_iss import RiscvISS
+from log_level import set_log_level
+
+# Jumps and branches by a number of bytes across a CALL, which the assembler
+# relaxes to a single JAL. The offsets are written for the AUIPC / JALR pair
+# of the CALL, they have to reach the same instructions when the CALL is
+# shorter. The program is run by the instruction set simulator with and
+# without relaxation.
+#
+# python relax.py
+
+program = """
+begin:
+    LI   a0, 0
+    LI   a1, 3
+    CALL inc                ; 2 instructions without relaxation
+    ADDI a1, a1, -1
+    BNE  a1, zero, -12      ; back to the CALL
+    JAL  zero, 16           ; over the CALL and the ADDI
+    CALL inc
+    ADDI a0, a0, 100
+    EBREAK
+inc:
+    ADDI a0, a0, 1
+    RET
+"""
+
+def run(relax):
+    a = RiscvAssembler(cache=False, relax=relax)
+    a.read(program)
+    a.assemble()
+    iss = RiscvISS(a.mem, ram_size=4 * len(a.mem))
+    iss.run(1000)
+    return len(a.mem), iss
+
+if __name__ == "__main__":
+    set_log_level()
+    errors = 0
+    sizes = {}
+    for relax in [False, True]:
+        sizes[relax], iss = run(relax)
+        if not iss.halted or iss.x[10] != 3:
+            print("relax={}: expected a0 = 3 at EBREAK, got a0 = {}{}".format(
+                relax, iss.x[10], "" if iss.halted else ", not halted"))
+            errors += 1
+    if sizes[True] != sizes[False] - 2:
+        print("expected both CALLs to be relaxed, {} instead of {} "
+              "instructions".format(sizes[True], sizes[False]))
+        errors += 1
+    if errors:
+        exit(1)
+    print("OK")
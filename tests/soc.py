@@ -8,7 +8,11 @@ from uart_tx import UartTx
 
 class SOC(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, program=None):
+
+        # Assembly code for the memory, the test code of the assembler if
+        # None
+        self.program = program
 
         self.leds = Signal(5)
         self.tx = Signal()
@@ -22,7 +26,8 @@ class SOC(Elaboratable):
 
         m = Module()
         cw = Clockworks(m)
-        memory = DomainRenamer("slow")(Mem(simulation=simulation))
+        memory = DomainRenamer("slow")(Mem(simulation=simulation,
+                                             program=self.program))
         cpu = DomainRenamer("slow")(CPU())
         uart_tx = DomainRenamer("slow")(
                 UartTx(freq_hz=12*1000000, baud_rate=1000000))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import time
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+
+from regression import steps, jobs, make_sim
+from log_level import set_log_level
+
+# Simulation throughput of all steps.
+#
+# The SOC of every step (step 18 with each CPU core) is elaborated and
+# simulated for a fixed number of clock cycles, once without and once with
+# a VCD file. Each run is a process of its own, one after the other, so the
+# runs don't compete for the CPU and the peak memory is that of the run.
+# Every run is repeated (repeat=N, default 3), a single run can be off by
+# more than the tolerance. The best of the runs is reported for the times
+# and speeds (other processes only ever slow a run down), the median for
+# the rest. The report has, per step:
+#
+#   elaborate_s           SOC(), elaboration and Simulator() (make_sim() of
+#                         the regression), in seconds
+#   cycles_per_s          simulated clock cycles per second
+#   peak_kib              peak memory (max RSS) of the process
+#   vcd_cycles_per_s      the same with a VCD file
+#   vcd_peak_kib
+#   vcd_bytes             size of the VCD file
+#   ..._spread            (max - min) / best of the runs, in %, for the
+#                         times and speeds
+#
+# and is written as JSON. With a baseline (an earlier report), the change of
+# each number is printed, and the exit code is 1 if a step got slower than
+# the tolerance (default 10 %) and than the spread of the runs (of the
+# report or the baseline, whichever is larger). A job that fails is listed
+# in the report as failed, the exit code is 1 as well.
+#
+# python tools/benchmark.py [step ...] [cycles=N] [repeat=N] [report=file]
+#                           [baseline=file] [tolerance=percent]
+# e.g. python tools/benchmark.py report=before.json
+#      python tools/benchmark.py baseline=before.json
+
+def worker(step, core, cycles, vcd):
+    # Runs one benchmark of the SOC the regression simulates, returns the
+    # result as a dict
+    start = time.perf_counter()
+    soc, fragment, sim = make_sim(step, core)
+    elaborate = time.perf_counter() - start
+
+    result = {"elaborate_s": elaborate}
+    start = time.perf_counter()
+    if vcd:
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "bench.vcd")
+            with sim.write_vcd(filename):
+                sim.run_until(cycles * 1e-6)
+            result["bytes"] = os.path.getsize(filename)
+    else:
+        sim.run_until(cycles * 1e-6)
+    result["cycles_per_s"] = cycles / (time.perf_counter() - start)
+    # KiB on Linux
+    result["peak_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def run(job, cycles, vcd):
+    step, core = job
+    args = [sys.executable, os.path.abspath(__file__), "worker", str(step),
+            str(cycles), "vcd" if vcd else "novcd"]
+    if core is not None:
+        args.append(core)
+    p = subprocess.run(args, capture_output=True, text=True)
+    for line in p.stdout.splitlines():
+        if line.startswith("benchmark: "):
+            return json.loads(line[len("benchmark: "):])
+    lines = (p.stdout + p.stderr).strip().splitlines()
+    print("    " + "\n    ".join(lines[-10:]))
+    return None
+
+def repeated(job, cycles, vcd, repeat):
+    # Best of repeated runs for the times and speeds, with their spread,
+    # the median for the rest
+    runs = [run(job, cycles, vcd) for i in range(repeat)]
+    if None in runs:
+        return None
+    result = {}
+    for key in runs[0]:
+        values = [r[key] for r in runs]
+        if key == "elaborate_s":
+            result[key] = min(values)
+        elif key == "cycles_per_s":
+            result[key] = max(values)
+        else:
+            result[key] = statistics.median(values)
+            continue
+        result[key + "_spread"] = \
+            100 * (max(values) - min(values)) / result[key]
+    return result
+
+def benchmark(job, cycles, repeat):
+    result = repeated(job, cycles, False, repeat)
+    with_vcd = repeated(job, cycles, True, repeat)
+    if result is None or with_vcd is None:
+        return None
+    result["vcd_cycles_per_s"] = with_vcd["cycles_per_s"]
+    result["vcd_cycles_per_s_spread"] = with_vcd["cycles_per_s_spread"]
+    result["vcd_peak_kib"] = with_vcd["peak_kib"]
+    result["vcd_bytes"] = with_vcd["bytes"]
+    return result
+
+def compare(name, result, baseline, tolerance):
+    # Prints the changes of the best runs against the baseline, returns
+    # False if the simulation got slower than the tolerance and the spread
+    # of the runs
+    ok = True
+    changes = []
+    for key in ["elaborate_s", "cycles_per_s", "vcd_cycles_per_s",
+                "peak_kib"]:
+        if baseline.get(key):
+            change = 100 * (result[key] / baseline[key] - 1)
+            changes.append("{} {:+.1f} %".format(key, change))
+            spread = max(result.get(key + "_spread", 0),
+                         baseline.get(key + "_spread", 0))
+            if (key.endswith("cycles_per_s") and
+                    change < -max(tolerance, spread)):
+                ok = False
+    print("    {}{}".format(", ".join(changes), "" if ok else "  SLOWER"))
+    return ok
+
+if __name__ == "__main__":
+    set_log_level()
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        step = int(sys.argv[2])
+        cycles = int(sys.argv[3])
+        vcd = sys.argv[4] == "vcd"
+        core = sys.argv[5] if len(sys.argv) > 5 else None
+        print("benchmark: {}".format(json.dumps(
+            worker(step, core, cycles, vcd))))
+        exit(0)
+
+    selected = []
+    cycles = 20000
+    repeat = 3
+    report_file = "benchmark.json"
+    baseline_file = None
+    tolerance = 10.0
+    for arg in sys.argv[1:]:
+        if arg.startswith("cycles="):
+            cycles = int(arg.split("=", 1)[1])
+        elif arg.startswith("repeat="):
+            repeat = max(1, int(arg.split("=", 1)[1]))
+        elif arg.startswith("report="):
+            report_file = arg.split("=", 1)[1]
+        elif arg.startswith("baseline="):
+            baseline_file = arg.split("=", 1)[1]
+        elif arg.startswith("tolerance="):
+            tolerance = float(arg.split("=", 1)[1])
+        else:
+            selected.append(int(arg))
+    if not selected:
+        selected = list(steps.keys())
+
+    baseline = {}
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline["cycles"] != cycles:
+            print("Baseline {} has {} cycles per run, not {}.".format(
+                baseline_file, baseline["cycles"], cycles))
+            exit(1)
+
+    import amaranth
+    report = {
+        "cycles": cycles,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "amaranth": amaranth.__version__,
+        "machine": platform.machine(),
+        "results": {},
+        "failed": []
+    }
+    slower = 0
+    for job in jobs(selected):
+        step, core = job
+        name = "{} {}".format(step, core) if core is not None else str(step)
+        result = benchmark(job, cycles, repeat)
+        if result is None:
+            print("{:16s} FAILED".format(name))
+            report["failed"].append(name)
+            continue
+        report["results"][name] = result
+        print("{:16s} {:8.3f} s  {:9.0f} cycles/s ({:.0f} %)  "
+              "{:9.0f} cycles/s vcd ({:.0f} %)  {:7.0f} KiB".format(
+                  name, result["elaborate_s"], result["cycles_per_s"],
+                  result["cycles_per_s_spread"],
+                  result["vcd_cycles_per_s"],
+                  result["vcd_cycles_per_s_spread"],
+                  result["peak_kib"]))
+        if name in baseline.get("results", {}):
+            if not compare(name, result, baseline["results"][name],
+                           tolerance):
+                slower += 1
+
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print("report written to {}".format(report_file))
+    if slower:
+        print("{} slower".format(slower))
+    if report["failed"]:
+        print("{} failed: {}".format(len(report["failed"]),
+                                     ", ".join(report["failed"])))
+    exit(1 if slower or report["failed"] else 0)
@@ -0,0 +1,21 @@
+import os
+import logging
+
+# The assembler, the memories of the steps and the UART log what they do, but
+# as modules they don't configure logging. The scripts that are run (benches,
+# board builds, the regression) call set_log_level(), which takes the level
+# from the environment:
+#
+#   LOG_LEVEL=debug python bench.py
+
+levels = ["debug", "info", "warning", "error", "critical"]
+
+def set_log_level(default=None):
+    level = os.environ.get("LOG_LEVEL") or default
+    if not level:
+        return
+    if level.lower() not in levels:
+        print("LOG_LEVEL must be one of {}, not '{}'".format(
+            ", ".join(levels), level))
+        exit(1)
+    logging.basicConfig(format="%(name)s: %(message)s", level=level.upper())
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import sys
+import os
+import glob
+import json
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from log_level import set_log_level
+
+# Regression of all steps of the tutorial in the simulator.
+#
+# The SOC of every step is simulated in a process of its own (the steps have
+# modules with the same names, soc, cpu, memory, ... which can't be imported
+# into one process), with as many processes in parallel as there are CPU
+# cores. Each job runs until its checks pass or its cycle budget is used up:
+#
+#   leds    number of changes of the LEDs
+#   pattern the first values the LEDs change to, in this order
+#   halt    the CPU executes EBREAK
+#   uart    number of characters sent to the UART, which have to be the
+#           same as what the instruction set simulator prints
+#
+# Step 18 is run with each of its CPU cores. In steps 13 to 15, 17 and 18,
+# the spin loops are fast-forwarded (lib/fastforward.py), the cycles include
+# the skipped ones.
+#
+# python tools/regression.py [step ...] [jobs=N]
+# e.g. python tools/regression.py 17 18 jobs=2
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# step: (cycles, checks)
+steps = {
+    1: (100, {"leds": 16}),
+    2: (2200000, {"leds": 1}),
+    3: (2200000, {"leds": 1}),
+    4: (2200000, {"leds": 1}),
+    5: (300000, {"leds": 4}),
+    6: (300000, {"leds": 4}),
+    7: (600000, {"halt": True}),
+    8: (100000, {"leds": 4}),
+    9: (600000, {"halt": True}),
+    10: (600000, {"halt": True}),
+    11: (600000, {"halt": True}),
+    12: (600000, {"halt": True}),
+    # The LEDs count the returns from the wait subroutine
+    13: (20000, {"pattern": [1, 2, 3, 4]}),
+    14: (20000, {"pattern": [1, 2, 3, 4]}),
+    # The bytes loaded from the data, the last one is sign extended
+    15: (50000, {"pattern": list(range(1, 16)) + [31], "halt": True}),
+    16: (300000, {"halt": True}),
+    17: (100000, {"leds": 15, "uart": 28}),
+    18: (200000, {"uart": 20}),
+}
+
+cores = ["fsm", "pipelined", "five_stage"]
+
+fastforward = [13, 14, 15, 17, 18]
+
+def jobs(selected):
+    for step in selected:
+        if step == 18:
+            for core in cores:
+                yield (step, core)
+        else:
+            yield (step, None)
+
+def step_path(step):
+    return glob.glob(os.path.join(root, "{:02d}_*".format(step)))[0]
+
+def iss_uart(instructions, n_chars):
+    from riscv_iss import RiscvISS
+    iss = RiscvISS(instructions)
+    while len(iss.uart) < n_chars and not iss.halted and iss.instret < 10**7:
+        iss.step()
+    return bytes(iss.uart[0:n_chars])
+
+def make_sim(step, core):
+    # The SOC of the step (with the CPU core of step 18), its fragment and
+    # the simulator, the same for the regression and the benchmark
+    from amaranth.sim import Simulator
+    from amaranth.hdl import Fragment
+
+    sys.path = [step_path(step), os.path.join(root, "lib"),
+                os.path.join(root, "tools")] + sys.path
+    from soc import SOC
+    soc = SOC(core=core) if core is not None else SOC()
+    fragment = Fragment.get(soc, None)
+    sim = Simulator(fragment)
+    sim.add_clock(1e-6)
+    return soc, fragment, sim
+
+def worker(step, core):
+    # Runs one job, returns the result as a dict
+    from amaranth import Signal
+
+    budget, checks = steps[step]
+    soc, fragment, sim = make_sim(step, core)
+    from testbench import uart_monitor
+    from checkpoint import Checkpoint
+    from fastforward import FastForward
+
+    ff = None
+    if step in fastforward:
+        ff = FastForward(soc, Checkpoint(fragment))
+        sim.add_testbench(ff.testbench)
+
+    cpu = getattr(soc, "cpu", soc)
+    state = {"leds": 0, "pattern": [], "halt": False, "uart": []}
+
+    async def leds(ctx):
+        prev = ctx.get(soc.leds)
+        while True:
+            value, = await ctx.changed(soc.leds)
+            if value != prev:
+                state["leds"] += 1
+                state["pattern"].append(value)
+                prev = value
+
+    async def halt(ctx):
+        # isSystem is an expression in some steps, the instruction register
+        # is watched instead
+        watched = cpu.isSystem
+        if not isinstance(watched, Signal):
+            watched = cpu.instr
+        while not state["halt"]:
+            await ctx.changed(watched)
+            state["halt"] = ctx.get(cpu.isSystem) == 1
+
+
+    def passed():
+        return (state["leds"] >= checks.get("leds", 0) and
+                len(state["pattern"]) >= len(checks.get("pattern", [])) and
+                state["halt"] >= checks.get("halt", False) and
+                len(state["uart"]) >= checks.get("uart", 0))
+
+    if "leds" in checks or "pattern" in checks:
+        sim.add_testbench(leds)
+    if "halt" in checks:
+        sim.add_testbench(halt)
+    if "uart" in checks:
+        sim.add_testbench(uart_monitor(soc, state["uart"].append))
+
+    start = time.time()
+    cycles = 0
+    chunk = max(1, min(10000, budget // 100))
+    while cycles < budget and not passed():
+        cycles += chunk
+        sim.run_until(cycles * 1e-6)
+    elapsed = time.time() - start
+    if ff is not None:
+        cycles += ff.skipped
+
+    result = {"cycles": cycles, "time": elapsed, "leds": state["leds"],
+              "halt": state["halt"], "uart": bytes(state["uart"]).decode(
+                  errors="replace"), "error": None}
+    if not passed():
+        result["error"] = "checks {} not met after {} cycles".format(
+            checks, cycles)
+    elif "pattern" in checks and (state["pattern"][:len(checks["pattern"])]
+                                  != checks["pattern"]):
+        result["error"] = "LEDs {}, expected {}".format(
+            state["pattern"], checks["pattern"])
+    elif "uart" in checks:
+        expected = iss_uart(soc.memory.instructions, len(state["uart"]))
+        if bytes(state["uart"]) != expected:
+            result["error"] = "UART output {!r}, expected {!r}".format(
+                bytes(state["uart"]), expected)
+    return result
+
+def run(job):
+    step, core = job
+    args = [sys.executable, os.path.abspath(__file__), "worker", str(step)]
+    if core is not None:
+        args.append(core)
+    start = time.time()
+    p = subprocess.run(args, capture_output=True, text=True)
+    result = None
+    for line in p.stdout.splitlines():
+        if line.startswith("regression: "):
+            result = json.loads(line[len("regression: "):])
+    if result is None:
+        lines = (p.stdout + p.stderr).strip().splitlines()
+        result = {"cycles": 0, "error": "\n".join(lines[-10:])}
+    result["wall"] = time.time() - start
+    return job, result
+
+if __name__ == "__main__":
+    set_log_level()
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        step = int(sys.argv[2])
+        core = sys.argv[3] if len(sys.argv) > 3 else None
+        print("regression: {}".format(json.dumps(worker(step, core))))
+        exit(0)
+
+    selected = []
+    n_jobs = os.cpu_count()
+    for arg in sys.argv[1:]:
+        if arg.startswith("jobs="):
+            n_jobs = int(arg.split("=", 1)[1])
+        else:
+            selected.append(int(arg))
+    if not selected:
+        selected = list(steps.keys())
+
+    start = time.time()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for (step, core), result in pool.map(run, jobs(selected)):
+            name = "{:2d} {}".format(step, core or "")
+            status = "PASS" if result["error"] is None else "FAIL"
+            print("{:16s} {}  {:8d} cycles  {:7.2f} s".format(
+                name, status, result["cycles"], result["wall"]))
+            if result["error"] is not None:
+                failed += 1
+                print("    " + result["error"].replace("\n", "\n    "))
+    print("{} jobs, {} failed, {:.2f} s".format(
+        len(list(jobs(selected))), failed, time.time() - start))
+    exit(1 if failed else 0)
@@ -1,5 +1,61 @@
 #!/usr/bin/env python3
+import os
 import re
+import json
+import hashlib
+import logging
+
+# What the assembler finds and encodes is logged at the DEBUG level, nothing
+# is printed by default. The scripts set the level from the environment
+# (log_level.py):
+#
+#   LOG_LEVEL=debug python bench.py
+#
+# The listing (labels, pseudo ops and the encoded instructions) can also be
+# written to a file, RiscvAssembler(listing=file) or RISCV_LISTING=file in
+# the environment, it is written at the end of assemble().
+
+log = logging.getLogger("riscv_assembler")
+
+# The assembled programs are cached in .design_cache/asm of the repository,
+# by a hash of the source code, the simulation flag and this file. A cached
+# program is neither parsed nor encoded again, assemble() only sets mem,
+# labels and debug_args (not instructions). RISCV_CACHE=0 in the
+# environment turns the cache off, it can be deleted at any time.
+
+cache_dir = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), ".design_cache", "asm")
+with open(os.path.abspath(__file__), "rb") as f:
+    assembler_hash = hashlib.sha256(f.read()).hexdigest()
+
+# Routines used by several programs (wait, putc, mulsi3) are kept in files of
+# their own in tools/runtime and included by the programs:
+#
+#   INCLUDE wait.s          ; or: .include "wait.s"
+#
+# An included file is assembled on its own into an object (and cached like a
+# program), the objects are linked after the program in the order of the
+# INCLUDE lines. Its labels can be used by the program, and constants it
+# doesn't define itself (like slow_bit of wait) are taken from the program
+# by the linker, as the immediate of an I-type instruction.
+
+runtime_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "runtime")
+include_line = re.compile(r'^\s*(?:INCLUDE|\.INCLUDE)\s+"?([^"\s;]+)"?',
+                          re.IGNORECASE | re.MULTILINE)
+
+number = re.compile(r"-?(0[xX][0-9A-Fa-f]+|0[bB][01]+|[0-9]+)")
+
+def isNumber(arg):
+    return number.fullmatch(arg) is not None
+
+def findInclude(name):
+    # Relative to the current directory or in the runtime library
+    for path in [name, os.path.join(runtime_dir, name)]:
+        if os.path.exists(path):
+            return path
+    print("Include file '{}' not found".format(name))
+    exit(1)
 
 # instructions
 
@@ -16,6 +72,21 @@ RInstructions = [
     ("AND",  0b111, 0b0000000)
 ]
 ROps = [x[0] for x in RInstructions]
+RTable = {x[0]: x for x in RInstructions}
+
+# RV32M extension
+MInstructions = [
+    ("MUL",    0b000, 0b0000001),
+    ("MULH",   0b001, 0b0000001),
+    ("MULHSU", 0b010, 0b0000001),
+    ("MULHU",  0b011, 0b0000001),
+    ("DIV",    0b100, 0b0000001),
+    ("DIVU",   0b101, 0b0000001),
+    ("REM",    0b110, 0b0000001),
+    ("REMU",   0b111, 0b0000001)
+]
+MOps = [x[0] for x in MInstructions]
+MTable = {x[0]: x for x in MInstructions}
 
 IInstructions = [
     ("ADDI",  0b000),
@@ -26,6 +97,7 @@ IInstructions = [
     ("ANDI",  0b111)
 ]
 IOps = [x[0] for x in IInstructions]
+ITable = {x[0]: x for x in IInstructions}
 
 IRInstructions = [
     ("SLLI", 0b001, 0b0000000),
@@ -33,12 +105,14 @@ IRInstructions = [
     ("SRAI", 0b101, 0b0100000)
 ]
 IROps = [x[0] for x in IRInstructions]
+IRTable = {x[0]: x for x in IRInstructions}
 
 JInstructions = [
     ("JAL",  0b1101111),
     ("JALR", 0b1100111, 0b000)
 ]
 JOps = [x[0] for x in JInstructions]
+JTable = {x[0]: x for x in JInstructions}
 
 BInstructions = [
     ("BEQ",  0b000),
@@ -49,12 +123,17 @@ BInstructions = [
     ("BGEU", 0b111)
 ]
 BOps = [x[0] for x in BInstructions]
+BTable = {x[0]: x for x in BInstructions}
+# The branch taken when the other one isn't
+BInverse = {"BEQ": "BNE", "BNE": "BEQ", "BLT": "BGE", "BGE": "BLT",
+            "BLTU": "BGEU", "BGEU": "BLTU"}
 
 UInstructions = [
     ("LUI",   0b0110111),
     ("AUIPC", 0b0010111)
 ]
 UOps = [x[0] for x in UInstructions]
+UTable = {x[0]: x for x in UInstructions}
 
 LInstructions = [
     ("LB",  0b000),
@@ -64,6 +143,7 @@ LInstructions = [
     ("LHU", 0b101)
 ]
 LOps = [x[0] for x in LInstructions]
+LTable = {x[0]: x for x in LInstructions}
 
 SInstructions = [
     ("SB",  0b000),
@@ -71,19 +151,32 @@ SInstructions = [
     ("SW",  0b010)
 ]
 SOps = [x[0] for x in SInstructions]
+STable = {x[0]: x for x in SInstructions}
 
 SysInstructions = [
     ("FENCE",),
     ("FENCE_I",),
     ("ECALL",),
     ("EBREAK",),
-    ("CSRRW",),
-    ("CSRRS",),
-    ("CSRRWI",),
-    ("CSRRSI",),
-    ("CSRRCI",)
+    ("CSRRW",  0b001),
+    ("CSRRS",  0b010),
+    ("CSRRC",  0b011),
+    ("CSRRWI", 0b101),
+    ("CSRRSI", 0b110),
+    ("CSRRCI", 0b111)
 ]
 SysOps = [x[0] for x in SysInstructions]
+SysTable = {x[0]: x for x in SysInstructions}
+
+# Zicsr: CSRs that can be given by name
+csr_names = {
+    'cycle'    : 0xc00,
+    'time'     : 0xc01,
+    'instret'  : 0xc02,
+    'cycleh'   : 0xc80,
+    'timeh'    : 0xc81,
+    'instreth' : 0xc82
+}
 
 PseudoInstructions = [
     ("LI",),
@@ -95,6 +188,13 @@ PseudoInstructions = [
     ("BEQZ",),
     ("BNEZ",),
     ("BGT",),
+    ("CSRR",),
+    ("RDCYCLE",),
+    ("RDCYCLEH",),
+    ("RDTIME",),
+    ("RDTIMEH",),
+    ("RDINSTRET",),
+    ("RDINSTRETH",),
 ]
 PseudoOps = [x[0] for x in PseudoInstructions]
 
@@ -117,10 +217,10 @@ class LabelRef():
     def __repr__(self):
         text = "LABELREF({:4} {} {})".format(self.op, self.name, self.arg)
         return text
+    separators = re.compile('[ ()]+')
     @classmethod
     def fromString(cls, string):
-        r = re.compile('[ ()]+')
-        args = r.split(string)
+        args = cls.separators.split(string)
         op = args[1]
         name = args[2]
         arg = args[3]
@@ -188,21 +288,310 @@ def reg2int(arg):
         exit(-1)
 
 class RiscvAssembler():
-    def __init__(self, simulation = False):
+    def __init__(self, simulation = False, listing = None, cache = None,
+                 relax = True):
+        # Defaults from the environment, at the time of the call
+        if listing is None:
+            listing = os.environ.get("RISCV_LISTING")
+        if cache is None:
+            cache = os.environ.get("RISCV_CACHE") != "0"
         self.pc = 0
+        self.sources = []
         self.labels = {}
         self.constants = {}
         self.pseudos = {}
         self.instructions = []
         self.mem = []
         self.debug_args = []
+        self.includes = []
+        # Assembled as an included object, constants it doesn't define are
+        # left to the linker: (pc, constant, mask of the immediate)
+        self.object = False
+        self.relocating = False
+        self.relocations = []
+        self.unresolved = []
         self.simulation = simulation
+        self.listing = listing
+        self.listing_lines = []
+        self.report = False
+        self.cache = cache
+        # A CALL in the range of JAL is a single JAL (relax() below)
+        self.relax = relax
+
+        log.info("Simulation = %s", "OFF" if simulation==False else "ON")
 
-        print("Simulation = ", "OFF" if simulation==False else "ON")
+        # Encoder by op, instead of testing the lists of ops one by one
+        self.encoders = {}
+        for ops, encoder in [
+                (ROps, self.encodeRops), (MOps, self.encodeMops),
+                (IOps, self.encodeIops), (IROps, self.encodeIRops),
+                (JOps, self.encodeJops), (BOps, self.encodeBops),
+                (UOps, self.encodeUops), (LOps, self.encodeLops),
+                (SOps, self.encodeSops), (SysOps, self.encodeSysops),
+                (MemOps, self.encodeMemops), (DebugOps, self.encodeDebugops)]:
+            for op in ops:
+                self.encoders.setdefault(op, encoder)
+
+        # Labels by pc, built by assemble()
+        self.labels_by_pc = {}
 
     def assemble(self):
+        # Lines of the listing are only formatted if they go somewhere
+        self.report = (bool(self.listing) or
+                       log.isEnabledFor(logging.DEBUG))
+        # Without the listing, a cached program will do
+        cache = self.cache and not self.report
+        if cache and self.loadCached():
+            return
+        for text in self.sources:
+            self.parse(text)
+        objects, object_labels = self.loadObjects()
+        self.layout(object_labels)
+        end = 4 * len(self.instructions)
+        for label, offset in object_labels.items():
+            self.labels[label] = end + offset
+        self.labels_by_pc = {}
+        for label, pc in self.labels.items():
+            self.labels_by_pc.setdefault(pc, []).append(label)
+        self.relocating = self.object
         for inst in self.instructions:
             self.mem.append(self.encode(inst))
+        self.relocating = False
+        self.link(objects)
+        if self.listing:
+            with open(self.listing, "w") as f:
+                f.write("".join(line + "\n" for line in self.listing_lines))
+        if cache:
+            self.storeCached()
+
+    def loadObjects(self):
+        # Assembles the included files, returns them and their labels, by
+        # the offset from the end of the program
+        objects = []
+        object_labels = {}
+        pc = 0
+        for name in self.includes:
+            obj = RiscvAssembler(simulation=self.simulation, listing=False,
+                                 cache=self.cache, relax=self.relax)
+            obj.object = True
+            with open(findInclude(name)) as f:
+                obj.read(f.read())
+            obj.assemble()
+            if obj.debug_args:
+                print("TRACE can't be used in included file '{}'".format(name))
+                exit(1)
+            for label, offset in obj.labels.items():
+                if label in self.labels or label in object_labels:
+                    print("Label '{}' of '{}' is already defined".format(
+                        label, name))
+                    exit(1)
+                object_labels[label] = pc + offset
+            objects.append((name, obj))
+            pc += 4 * len(obj.mem)
+        return objects, object_labels
+
+    def labelOf(self, arg, object_labels):
+        # The label an instruction refers to, None for a number
+        upp = arg.upper()
+        if upp.startswith("LABELREF"):
+            upp = LabelRef.fromString(upp).arg
+        if upp in self.labels or upp in object_labels:
+            return upp
+        return None
+
+    def layout(self, object_labels):
+        # Relaxation of CALL and the branches to labels: a CALL in the range
+        # of JAL (+-1 MB) is a single JAL instead of AUIPC and JALR, a branch
+        # out of range (+-4 kB) becomes the inverted branch over a JAL. LI of
+        # a label is a single ADDI, or LUI and ADDI for an address that
+        # doesn't fit in 12 bits. Starting with the short forms, instructions
+        # only ever get longer, until the addresses don't change anymore.
+        # Jumps and branches by a number of bytes are moved along, they keep
+        # pointing to the same instruction.
+        n = len(self.instructions)
+        calls = {}
+        branches = {}
+        lis = {}
+        jumps = {}
+        auipcs = []
+        for i, inst in enumerate(self.instructions):
+            if (inst.op == "ADDI" and
+                    inst.args[2].upper().startswith("LABELREF(LI")):
+                label = self.labelOf(inst.args[2], object_labels)
+                if label is not None:
+                    lis[i] = label
+            elif (self.relax and inst.op == "AUIPC" and
+                    inst.args[1].upper().startswith("LABELREF(CALL")):
+                label = self.labelOf(inst.args[1], object_labels)
+                if label is not None:
+                    calls[i] = label
+            elif inst.op in BOps or inst.op == "JAL":
+                arg = inst.args[1] if inst.op == "JAL" else inst.args[2]
+                label = self.labelOf(arg, object_labels)
+                if label is not None:
+                    if inst.op != "JAL":
+                        branches[i] = label
+                elif isNumber(arg) or arg.upper() in self.constants:
+                    jumps[i] = self.imm2int(arg)
+            elif (inst.op == "AUIPC" and isNumber(inst.args[1]) and
+                    self.imm2int(inst.args[1]) != 0):
+                auipcs.append(i)
+        if auipcs:
+            # The target of AUIPC by a number is completed by the following
+            # instruction, it can't be moved along, the CALLs are kept
+            calls = {}
+        if not calls and not branches and not lis:
+            return
+        # Index of each label in the instructions
+        index = {label: pc // 4 for label, pc in self.labels.items()}
+
+        def address(label, pcs):
+            if label in index:
+                return pcs[index[label]]
+            return pcs[-1] + object_labels[label]
+
+        size = [1] * n
+        for i in calls:
+            size[i + 1] = 0
+        def target(i, offset, pcs):
+            # The new address of the instruction a jump by offset points to,
+            # the included objects follow the program
+            if offset % 4 != 0:
+                return pcs[i] + offset
+            t = i + offset // 4
+            if t < 0:
+                return 4 * t
+            if t >= n:
+                return pcs[n] + 4 * (t - n)
+            if size[t] == 0:
+                print("Jump by {} at pc {} points into a relaxed CALL, use a "
+                      "label".format(offset, 4 * i))
+                exit(1)
+            return pcs[t]
+
+        changed = True
+        while changed:
+            pcs = []
+            pc = 0
+            for s in size:
+                pcs.append(pc)
+                pc += 4 * s
+            pcs.append(pc)
+            changed = False
+            for i, label in calls.items():
+                offset = address(label, pcs) - pcs[i]
+                if size[i + 1] == 0 and not -(1 << 20) <= offset < 1 << 20:
+                    size[i + 1] = 1
+                    changed = True
+            for i, label in branches.items():
+                offset = address(label, pcs) - pcs[i]
+                if size[i] == 1 and not -(1 << 12) <= offset < 1 << 12:
+                    size[i] = 2
+                    changed = True
+            for i, label in lis.items():
+                if size[i] == 1 and not -2048 <= address(label, pcs) < 2048:
+                    size[i] = 2
+                    changed = True
+        if auipcs and any(s != 1 for s in size):
+            print("AUIPC by a number at pc {} can't be kept over the long "
+                  "branches or LI, use a label".format(4 * auipcs[0]))
+            exit(1)
+
+        instructions = []
+        for i, inst in enumerate(self.instructions):
+            if i in calls and size[i + 1] == 0:
+                instructions.append(Instruction("JAL", "ra", calls[i]))
+            elif i in branches and size[i] == 2:
+                rs1, rs2 = inst.args[0], inst.args[1]
+                instructions.append(Instruction(BInverse[inst.op], rs1, rs2,
+                                                "8"))
+                instructions.append(Instruction("JAL", "zero", branches[i]))
+            elif i in lis and size[i] == 2:
+                rd = inst.args[0]
+                hi = LabelRef("LI", "hi", lis[i])
+                lo = LabelRef("LI", "lo", lis[i])
+                instructions.append(self.iFromLine("LUI {}, {}".format(rd, hi)))
+                instructions.append(self.iFromLine("ADDI {}, {}, {}".format(
+                    rd, rd, lo)))
+            elif i in jumps and size[i] == 1:
+                args = list(inst.args)
+                args[-1] = str(target(i, jumps[i], pcs) - pcs[i])
+                instructions.append(Instruction(inst.op, *args))
+            elif size[i] == 1:
+                instructions.append(inst)
+        self.instructions = instructions
+        self.labels = {label: pcs[i] for label, i in index.items()}
+        self.pseudos = {pcs[pc // 4]: op for pc, op in self.pseudos.items()}
+
+    def link(self, objects):
+        for name, obj in objects:
+            base = 4 * len(self.mem)
+            words = list(obj.mem)
+            for offset, constant, mask in obj.relocations:
+                if constant in self.constants:
+                    words[offset // 4] |= (self.constants[constant] & mask) << 20
+                elif self.object:
+                    self.relocations.append((base + offset, constant, mask))
+                else:
+                    print("Constant '{}' used by '{}' is not defined".format(
+                        constant, name))
+                    exit(1)
+            if self.report:
+                self.listLine("  inc@pc=0x{:03x} {}".format(base, name))
+                for i, word in enumerate(words):
+                    pc = base + 4 * i
+                    for l in self.labels_by_pc.get(pc, []):
+                        self.listLine("  lab@pc=0x{:03x}={} -> {}".format(
+                            pc, pc, l))
+                    self.listLine("  lnk@pc=0x{:03x} -> 0b{:032b}".format(
+                        pc, word))
+            self.mem += words
+        self.pc = 4 * len(self.mem)
+
+    def cachePath(self):
+        h = hashlib.sha256(assembler_hash.encode())
+        h.update(repr((self.simulation, self.object, self.relax)).encode())
+        for text in self.sources:
+            h.update(text.encode())
+            h.update(b"\0")
+            # The objects of the included files are linked into the program
+            for name in include_line.findall(text):
+                with open(findInclude(name), "rb") as f:
+                    h.update(f.read())
+        return os.path.join(cache_dir, h.hexdigest()[:32] + ".json")
+
+    def loadCached(self):
+        try:
+            with open(self.cachePath()) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.mem += cached["mem"]
+        self.labels.update(cached["labels"])
+        self.debug_args += [tuple(args) for args in cached["debug_args"]]
+        self.relocations += [tuple(r) for r in cached["relocations"]]
+        self.pc = 4 * len(cached["mem"])
+        log.debug("assembled program from the cache")
+        return True
+
+    def storeCached(self):
+        path = self.cachePath()
+        # Write and rename, parallel runs don't read half a file
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"mem": self.mem, "labels": self.labels,
+                           "debug_args": self.debug_args,
+                           "relocations": self.relocations}, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def listLine(self, line):
+        log.debug(line)
+        if self.listing:
+            self.listing_lines.append(line)
 
     def encodeR(self, f7, rs2, rs1, f3, rd, op):
         return ((f7 << 25) | (rs2 << 20) | (rs1 << 15)
@@ -238,56 +627,67 @@ class RiscvAssembler():
 
     def encodeRops(self, instruction):
         rd, rs1, rs2 = [reg2int(x) for x in instruction.args]
-        _, f3, f7 = [x for x in RInstructions if x[0] == instruction.op][0]
+        _, f3, f7 = RTable[instruction.op]
+        return self.encodeR(f7, rs2, rs1, f3, rd, 0b0110011)
+
+    def encodeMops(self, instruction):
+        rd, rs1, rs2 = [reg2int(x) for x in instruction.args]
+        _, f3, f7 = MTable[instruction.op]
         return self.encodeR(f7, rs2, rs1, f3, rd, 0b0110011)
 
     def encodeIops(self, instruction):
         rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in IInstructions if x[0] == instruction.op][0]
+        _, f3 = ITable[instruction.op]
         return self.encodeI(imm, rs, f3, rd, 0b0010011)
 
     def encodeIRops(self, instruction):
         rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3, f7 = [x for x in IRInstructions if x[0] == instruction.op][0]
+        _, f3, f7 = IRTable[instruction.op]
         return self.encodeR(f7, imm, rs, f3, rd, 0b0010011)
 
     def encodeJops(self, instruction):
         if instruction.op == "JAL":
             rd = reg2int(instruction.args[0])
             imm = self.imm2int(instruction.args[1])
-            _, op = [x for x in JInstructions if x[0] == instruction.op][0]
+            if not -(1 << 20) <= imm < 1 << 20:
+                print("Jump out of range in {}".format(instruction))
+                exit(1)
+            _, op = JTable[instruction.op]
             return self.encodeJ(imm, rd, 0b1101111)
         elif instruction.op == "JALR":
             rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
             imm = self.imm2int(instruction.args[2])
-            _, op, f3 = [x for x in JInstructions if x[0] == instruction.op][0]
+            _, op, f3 = JTable[instruction.op]
             return self.encodeI(imm, rs, f3, rd, 0b1100111)
 
     def encodeBops(self, instruction):
         rs1, rs2 = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in BInstructions if x[0] == instruction.op][0]
+        if not -(1 << 12) <= imm < 1 << 12:
+            print("Branch out of range in {}".format(instruction))
+            exit(1)
+        _, f3 = BTable[instruction.op]
         return self.encodeB(imm, rs2, rs1, f3, 0b1100011)
 
     def encodeUops(self, instruction):
         rd = reg2int(instruction.args[0])
         imm = self.imm2int(instruction.args[1])
-        _, op = [x for x in UInstructions if x[0] == instruction.op][0]
+        _, op = UTable[instruction.op]
         return self.encodeU(imm, rd, op)
 
     def encodeLops(self, instruction):
         rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in LInstructions if x[0] == instruction.op][0]
+        _, f3 = LTable[instruction.op]
         return self.encodeI(imm, rs, f3, rd, 0b0000011)
 
     def encodeSops(self, instruction):
         # Swapped rs2, rs1 to match assembly code
         rs2, rs1 = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in SInstructions if x[0] == instruction.op][0]
+        _, f3 = STable[instruction.op]
         return self.encodeS(imm, rs2, rs1, f3, 0b0100011)
 
     def encodeSysops(self, instruction):
@@ -300,9 +700,25 @@ class RiscvAssembler():
             return 0b00000000000000000000000001110011
         elif op == "EBREAK":
             return 0b00000000000100000000000001110011
+        elif op in ["CSRRW", "CSRRS", "CSRRC"]:
+            rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[2])
+            csr = self.csr2int(instruction.args[1])
+            _, f3 = SysTable[op]
+            return self.encodeI(csr, rs, f3, rd, 0b1110011)
+        elif op in ["CSRRWI", "CSRRSI", "CSRRCI"]:
+            rd = reg2int(instruction.args[0])
+            csr = self.csr2int(instruction.args[1])
+            uimm = self.imm2int(instruction.args[2]) & 0x1f
+            _, f3 = SysTable[op]
+            return self.encodeI(csr, uimm, f3, rd, 0b1110011)
         else:
             print("Unhandled system op {}".format(op))
 
+    def csr2int(self, arg):
+        if arg.lower() in csr_names:
+            return csr_names[arg.lower()]
+        return self.imm2int(arg)
+
     def encodeMemops(self, instruction):
         op = instruction.op
         if op == "DATAW":
@@ -327,6 +743,12 @@ class RiscvAssembler():
         instr = []
         if op == "NOP":
             instr.append(self.iFromLine("ADD x0, x0, x0"))
+        elif (op == "LI" and re.fullmatch(r"[A-Za-z_]\w*", instruction.args[1])
+                and instruction.args[1].upper() not in self.constants):
+            # The address of a label, one or two instructions (layout())
+            rd = instruction.args[0]
+            ref = LabelRef(op, "abs", instruction.args[1])
+            instr.append(self.iFromLine("ADDI {}, zero, {}".format(rd, ref)))
         elif op == "LI":
             rd = instruction.args[0]
             imm = self.imm2int(instruction.args[1])
@@ -370,45 +792,46 @@ class RiscvAssembler():
             ref = LabelRef(op, "imm", instruction.args[2])
             instr.append(self.iFromLine("BLT   {}, {}, {}".format(
                 rs2, rs1, ref)))
+        elif op == "CSRR":
+            rd = instruction.args[0]
+            csr = instruction.args[1]
+            instr.append(self.iFromLine("CSRRS {}, {}, zero".format(rd, csr)))
+        elif op in ["RDCYCLE", "RDCYCLEH", "RDTIME", "RDTIMEH", "RDINSTRET",
+                    "RDINSTRETH"]:
+            rd = instruction.args[0]
+            csr = op[2:].lower()
+            instr.append(self.iFromLine("CSRRS {}, {}, zero".format(rd, csr)))
         else:
             return [instruction], False
         return instr, True
 
     def encode(self, instruction):
-        encoded = 0
-        if instruction.op in ROps:
-            encoded = self.encodeRops(instruction)
-        elif instruction.op in IOps:
-            encoded = self.encodeIops(instruction)
-        elif instruction.op in IROps:
-            encoded = self.encodeIRops(instruction)
-        elif instruction.op in JOps:
-            encoded = self.encodeJops(instruction)
-        elif instruction.op in BOps:
-            encoded = self.encodeBops(instruction)
-        elif instruction.op in UOps:
-            encoded = self.encodeUops(instruction)
-        elif instruction.op in LOps:
-            encoded = self.encodeLops(instruction)
-        elif instruction.op in SOps:
-            encoded = self.encodeSops(instruction)
-        elif instruction.op in SysOps:
-            encoded = self.encodeSysops(instruction)
-        elif instruction.op in MemOps:
-            encoded = self.encodeMemops(instruction)
-        elif instruction.op in DebugOps:
-            encoded = self.encodeDebugops(instruction)
-        else:
+        encoder = self.encoders.get(instruction.op)
+        if encoder is None:
             print("Unhandled instruction / opcode {}".format(instruction))
             exit(1)
-        for l in self.labels:
-            if self.labels[l] == self.pc:
-                print("  lab@pc=0x{:03x}={} -> {}".format(self.pc, self.pc, l))
-        if self.pc in self.pseudos:
-            print("  psu@pc=0x{:03x}={} -> {}".format(self.pc, self.pc,
-                                                      self.pseudos[self.pc]))
-        print("  enc@pc=0x{:03x} {} -> 0b{:032b}".format(
-            self.pc, instruction, encoded))
+        encoded = encoder(instruction)
+        if self.unresolved:
+            # Only immediates of I-type instructions are linked
+            if instruction.op in IROps:
+                mask = 0x1f
+            elif instruction.op in IOps or instruction.op in LOps:
+                mask = 0xfff
+            else:
+                print("Constant {} can't be linked in {}".format(
+                    self.unresolved[0], instruction))
+                exit(1)
+            self.relocations += [(self.pc, c, mask) for c in self.unresolved]
+            self.unresolved = []
+        if self.report:
+            for l in self.labels_by_pc.get(self.pc, []):
+                self.listLine("  lab@pc=0x{:03x}={} -> {}".format(
+                    self.pc, self.pc, l))
+            if self.pc in self.pseudos:
+                self.listLine("  psu@pc=0x{:03x}={} -> {}".format(
+                    self.pc, self.pc, self.pseudos[self.pc]))
+            self.listLine("  enc@pc=0x{:03x} {} -> 0b{:032b}".format(
+                self.pc, instruction, encoded))
         self.pc += 4
         return encoded
 
@@ -426,10 +849,19 @@ class RiscvAssembler():
             return Instruction(op, *items)
 
     def read(self, text):
+        # The text is parsed by assemble(), if it isn't in the cache
+        self.sources.append(text)
+
+    def parse(self, text):
         instructions = []
         for line in text.splitlines():
             line = line.strip()
             i = None
+            # Included files, linked after the program
+            m = include_line.match(line)
+            if m is not None:
+                self.includes.append(m.group(1))
+                continue
             # Quoted characters
             if "TRACE" in line:
                 if self.simulation == False:
@@ -450,21 +882,21 @@ class RiscvAssembler():
                 name = items[0]
                 value = "".join(items[2:])
                 self.constants[name.upper()] = int(value)
-                print("found equ '{}', value = '{}'".format(name, value))
+                log.debug("found equ '%s', value = '%s'", name, value)
                 continue
             # Labels
             if ':' in line:
                 label, line = [x.strip() for x in line.split(':', maxsplit=1)]
                 pc = len(instructions) * 4
                 self.labels[label.upper()] = pc
-                print("found label '{}', pc = {}".format(label, pc))
+                log.debug("found label '%s', pc = %d", label, pc)
             i = self.iFromLine(line)
             if i is not None:
                 unravelled, isPseudo = self.unravelPseudoOps(i)
                 if isPseudo:
                     pc = len(instructions) * 4
                     self.pseudos[pc] = i.op
-                    print("found peudo '{}', pc = {}".format(i.op, pc))
+                    log.debug("found pseudo '%s', pc = %d", i.op, pc)
                 for u in unravelled:
                     instructions.append(u)
         self.instructions += instructions
@@ -481,20 +913,31 @@ class RiscvAssembler():
             # print("label offset = {}".format(offset))
             return offset
         if upp.startswith("LABELREF"):
-            print("  found labelref")
+            log.debug("  found labelref")
             l = LabelRef.fromString(upp)
             if l.op == "CALL":
                 offset = self.imm2int(l.arg)
-                print("    resolving label {} -> {}".format(l.arg, offset))
+                log.debug("    resolving label %s -> %s", l.arg, offset)
                 # print("offset = {}".format(offset))
                 if l.name == "OFFSET":
                     return offset
                 if l.name == "OFFSET12":
                     return (offset + 4) & 0xfff
+            elif l.op == "LI":
+                # The address of the label, placed by layout()
+                if l.arg not in self.labels:
+                    print("Unknown label '{}' in LI".format(l.arg))
+                    exit(1)
+                address = self.labels[l.arg]
+                if l.name == "HI":
+                    return address + ((address & 0x800) << 1)
+                if l.name == "LO":
+                    return address & 0xfff
+                return address
             elif (l.op in ["J", "BEQZ", "BNEZ", "BGT"]):
                 if l.name == "IMM":
                     imm = self.imm2int(l.arg)
-                    print("    resolving label {} -> {}".format(l.arg, imm))
+                    log.debug("    resolving label %s -> %s", l.arg, imm)
                     return imm
         if arg.startswith('"'):
             if arg.endswith('"'):
@@ -507,6 +950,10 @@ class RiscvAssembler():
                     raise ValueError("Expected quoted char, but got {}".format(arg))
             else:
                 raise ValueError("Strange argument: {}".format(arg))
+        if self.relocating and re.fullmatch(r"[A-Z_]\w*", upp):
+            # A constant of the program, filled in by the linker
+            self.unresolved.append(upp)
+            return 0
         try:
             return int(arg)
         except ValueError as e:
@@ -680,7 +1127,9 @@ class RiscvAssembler():
     """
 
 if __name__ == "__main__":
+    from log_level import set_log_level
+    set_log_level("debug")
     a = RiscvAssembler(simulation=True)
     a.read(a.testCode())
-    print(a.instructions)
     a.assemble()
+    print(a.instructions)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+import sys
+import os
+import inspect
+
+from log_level import set_log_level
+
+# Instruction set simulator for the firmware assembled by RiscvAssembler.
+#
+# It runs the RV32I instructions (plus RV32M and the Zicsr counters) of the
+# words in RiscvAssembler.mem, with the memory map of the SOC:
+#
+#   RAM                   0x000000 ... ram_size - 1
+#   IO page               mem_addr[22] set, one bit of the word address per
+#                         device:
+#     LEDs                word address bit 0 (byte offset 0x04), write
+#     UART data           word address bit 1 (byte offset 0x08), write
+#     UART status         word address bit 2 (byte offset 0x10), read, the
+#                         UART is never busy (bit 9 is 0)
+#
+# Other IO reads return 0. There are no clock cycles, every instruction takes
+# one step (cycle and instret count the instructions, time is 1 us per
+# instruction). EBREAK and ECALL halt the simulator, like the CPU.
+#
+# Usage: python riscv_iss.py step_dir [n_instructions] [rv32m]
+# e.g. python tools/riscv_iss.py 18_mandelbrot 1000000
+#
+# step_dir is a step with the firmware in memory.py (11_modules and later,
+# tests), rv32m only for 18_mandelbrot.
+
+IO_LEDS_bit = 0
+IO_UART_DAT_bit = 1
+IO_UART_CNTL_bit = 2
+
+def sign_extend(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+def to_signed(value):
+    return value - (1 << 32) if value >> 31 else value
+
+class RiscvISS():
+    def __init__(self, mem, ram_size=6*1024, on_uart=None, on_leds=None):
+        n_words = ram_size // 4
+        if len(mem) > n_words:
+            raise ValueError("Program of {} words does not fit in {} bytes "
+                             "of RAM".format(len(mem), ram_size))
+        self.ram = list(mem) + [0] * (n_words - len(mem))
+        self.ram_size = ram_size
+
+        self.x = [0] * 32
+        self.pc = 0
+        self.instret = 0
+        self.halted = False
+
+        self.leds = 0
+        self.uart = []
+        self.on_uart = on_uart
+        self.on_leds = on_leds
+
+        # Decoded instructions by instruction word
+        self.decoded = {}
+
+    def decode(self, word):
+        op = word & 0x7f
+        rd = (word >> 7) & 0x1f
+        funct3 = (word >> 12) & 0x7
+        rs1 = (word >> 15) & 0x1f
+        rs2 = (word >> 20) & 0x1f
+        funct7 = word >> 25
+        if op == 0b0100011:
+            imm = sign_extend(((word >> 25) << 5) | rd, 12)
+        elif op == 0b1100011:
+            imm = sign_extend(((word >> 31) << 12) | (((word >> 7) & 1) << 11)
+                              | (((word >> 25) & 0x3f) << 5)
+                              | (((word >> 8) & 0xf) << 1), 13)
+        elif op == 0b1101111:
+            imm = sign_extend(((word >> 31) << 20)
+                              | (((word >> 12) & 0xff) << 12)
+                              | (((word >> 20) & 1) << 11)
+                              | (((word >> 21) & 0x3ff) << 1), 21)
+        elif op in (0b0110111, 0b0010111):
+            imm = word & 0xfffff000
+        else:
+            imm = sign_extend(word >> 20, 12)
+        decoded = (op, rd, funct3, rs1, rs2, funct7, imm)
+        self.decoded[word] = decoded
+        return decoded
+
+    def check_address(self, addr):
+        if addr >= self.ram_size:
+            raise ValueError("Memory access at 0x{:08x} outside of RAM "
+                             "(pc=0x{:08x})".format(addr, self.pc))
+
+    def load(self, addr):
+        if (addr >> 22) & 1:
+            return 0
+        self.check_address(addr)
+        return self.ram[addr >> 2]
+
+    def store(self, addr, wmask, wdata):
+        if (addr >> 22) & 1:
+            wordaddr = addr >> 2
+            if (wordaddr >> IO_LEDS_bit) & 1:
+                self.leds = wdata & 0x1f
+                if self.on_leds is not None:
+                    self.on_leds(self.leds)
+            if (wordaddr >> IO_UART_DAT_bit) & 1:
+                c = wdata & 0xff
+                self.uart.append(c)
+                if self.on_uart is not None:
+                    self.on_uart(c)
+            return
+        self.check_address(addr)
+        mask = 0
+        for i in range(4):
+            if (wmask >> i) & 1:
+                mask |= 0xff << (8 * i)
+        i = addr >> 2
+        self.ram[i] = (self.ram[i] & ~mask) | (wdata & mask)
+
+    def csr(self, number):
+        counters = {0xc00: self.instret, 0xc01: self.instret,
+                    0xc02: self.instret}
+        value = counters.get(number & 0xf7f, 0)
+        return value >> 32 if number & 0x080 else value
+
+    def step(self):
+        # Execute one instruction. Returns (pc, rd, value, store) of the
+        # instruction: the register written (rd = 0: none) with its value,
+        # and the store (addr, wmask, wdata) as it appears on the memory bus,
+        # or None.
+        if self.halted:
+            return None
+        x = self.x
+        pc = self.pc
+        if pc >= self.ram_size:
+            raise ValueError("pc=0x{:08x} outside of RAM".format(pc))
+        word = self.ram[pc >> 2]
+        decoded = self.decoded.get(word)
+        if decoded is None:
+            decoded = self.decode(word)
+        op, rd, funct3, rs1, rs2, funct7, imm = decoded
+
+        v1 = x[rs1]
+        v2 = x[rs2]
+        next_pc = pc + 4
+        value = None
+        store = None
+
+        if op == 0b0010011 or (op == 0b0110011 and funct7 != 1):
+            # ALU, with register or immediate
+            b = v2 if op == 0b0110011 else imm & 0xffffffff
+            if funct3 == 0b000:
+                if op == 0b0110011 and funct7 & 0x20:
+                    value = v1 - b
+                else:
+                    value = v1 + b
+            elif funct3 == 0b001:
+                value = v1 << (b & 0x1f)
+            elif funct3 == 0b010:
+                value = int(to_signed(v1) < to_signed(b))
+            elif funct3 == 0b011:
+                value = int(v1 < b)
+            elif funct3 == 0b100:
+                value = v1 ^ b
+            elif funct3 == 0b101:
+                if funct7 & 0x20:
+                    value = to_signed(v1) >> (b & 0x1f)
+                else:
+                    value = v1 >> (b & 0x1f)
+            elif funct3 == 0b110:
+                value = v1 | b
+            else:
+                value = v1 & b
+        elif op == 0b1100011:
+            s1 = to_signed(v1)
+            s2 = to_signed(v2)
+            if funct3 == 0b000:
+                taken = v1 == v2
+            elif funct3 == 0b001:
+                taken = v1 != v2
+            elif funct3 == 0b100:
+                taken = s1 < s2
+            elif funct3 == 0b101:
+                taken = s1 >= s2
+            elif funct3 == 0b110:
+                taken = v1 < v2
+            elif funct3 == 0b111:
+                taken = v1 >= v2
+            else:
+                taken = False
+            if taken:
+                next_pc = pc + imm
+        elif op == 0b0000011:
+            # Byte lanes selected like in the CPU (also when misaligned)
+            addr = (v1 + imm) & 0xffffffff
+            data = self.load(addr & ~3)
+            halfword = (data >> 16) if addr & 2 else data & 0xffff
+            byte = (halfword >> 8) if addr & 1 else halfword & 0xff
+            if funct3 == 0b000:
+                value = sign_extend(byte, 8)
+            elif funct3 == 0b001:
+                value = sign_extend(halfword, 16)
+            elif funct3 == 0b100:
+                value = byte
+            elif funct3 == 0b101:
+                value = halfword
+            else:
+                value = data
+        elif op == 0b0100011:
+            addr = (v1 + imm) & 0xffffffff
+            shift = 8 * (addr & 3)
+            if funct3 == 0b000:
+                wmask = 0b0001 << (addr & 3)
+                wdata = (v2 & 0xff) * 0x01010101
+            elif funct3 == 0b001:
+                wmask = 0b0011 << (addr & 2)
+                wdata = (v2 & 0xffff) * 0x00010001
+            else:
+                wmask = 0b1111
+                wdata = v2
+            wdata &= 0xffffffff
+            store = (addr & ~3, wmask, wdata)
+            self.store(addr & ~3, wmask, wdata)
+        elif op == 0b1101111:
+            value = next_pc
+            next_pc = pc + imm
+        elif op == 0b1100111:
+            value = next_pc
+            next_pc = (v1 + imm) & 0xfffffffe
+        elif op == 0b0110111:
+            value = imm
+        elif op == 0b0010111:
+            value = pc + imm
+        elif op == 0b0110011:
+            value = self.muldiv(funct3, v1, v2)
+        elif op == 0b1110011:
+            if funct3 == 0:
+                # EBREAK, ECALL: halt
+                self.halted = True
+                return (pc, 0, 0, None)
+            value = self.csr((imm & 0xfff))
+        else:
+            raise ValueError("Unknown instruction 0x{:08x} at pc=0x{:08x}"
+                             .format(word, pc))
+
+        if value is not None and rd != 0:
+            value &= 0xffffffff
+            x[rd] = value
+        else:
+            rd = 0
+            value = 0
+        self.pc = next_pc & 0xffffffff
+        self.instret += 1
+        return (pc, rd, value, store)
+
+    def muldiv(self, funct3, v1, v2):
+        s1 = to_signed(v1)
+        s2 = to_signed(v2)
+        if funct3 == 0b000:
+            return v1 * v2
+        elif funct3 == 0b001:
+            return (s1 * s2) >> 32
+        elif funct3 == 0b010:
+            return (s1 * v2) >> 32
+        elif funct3 == 0b011:
+            return (v1 * v2) >> 32
+        elif funct3 == 0b100:
+            if v2 == 0:
+                return 0xffffffff
+            if s1 == -2**31 and s2 == -1:
+                return v1
+            q = abs(s1) // abs(s2)
+            return -q if (s1 < 0) != (s2 < 0) else q
+        elif funct3 == 0b101:
+            return 0xffffffff if v2 == 0 else v1 // v2
+        elif funct3 == 0b110:
+            if v2 == 0:
+                return v1
+            if s1 == -2**31 and s2 == -1:
+                return 0
+            r = abs(s1) % abs(s2)
+            return -r if s1 < 0 else r
+        else:
+            return v1 if v2 == 0 else v1 % v2
+
+    def run(self, n_instructions):
+        # Run until the CPU halts or n_instructions are executed, returns the
+        # number of executed instructions
+        n = 0
+        while n < n_instructions and not self.halted:
+            self.step()
+            n += 1
+        return n
+
+
+if __name__ == "__main__":
+    set_log_level()
+    if len(sys.argv) < 2:
+        print("Usage: {} step_dir [n_instructions] [rv32m]".format(
+            sys.argv[0]))
+        exit(1)
+    step_dir = sys.argv[1]
+    n_instructions = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    rv32m = "rv32m" in sys.argv[3:]
+
+    tools = os.path.dirname(os.path.abspath(__file__))
+    sys.path = [step_dir, tools,
+                os.path.join(os.path.dirname(tools), "lib")] + sys.path
+    if not os.path.exists(os.path.join(step_dir, "memory.py")):
+        print("{} has no memory.py with the firmware".format(step_dir))
+        exit(1)
+    import memory
+    # Mem in the later steps, Memory before, with the options they have
+    Mem = getattr(memory, "Mem", None) or getattr(memory, "Memory")
+    accepted = inspect.signature(Mem).parameters
+    options = {}
+    if "simulation" in accepted:
+        options["simulation"] = True
+    if rv32m:
+        if "rv32m" not in accepted:
+            print("The firmware of {} has no rv32m option".format(step_dir))
+            exit(1)
+        options["rv32m"] = True
+    mem = Mem(**options)
+
+    def putc(c):
+        print(chr(c), end="", flush=True)
+
+    iss = RiscvISS(mem.instructions, on_uart=putc)
+    n = iss.run(n_instructions)
+    print("")
+    print("{} instructions, pc=0x{:08x}{}".format(
+        n, iss.pc, ", halted" if iss.halted else ""))
@@ -0,0 +1,13 @@
+; Integer multiplication, a0 <- a0 * a1
+mulsi3:
+MV      a2, a0
+LI      a0, 0
+mulsi3_l0:
+ANDI    a3, a1, 1
+BEQZ    a3, mulsi3_l1
+ADD     a0, a0, a2
+mulsi3_l1:
+SRLI    a1, a1, 1
+SLLI    a2, a2, 1
+BNEZ    a1, mulsi3_l0
+RET
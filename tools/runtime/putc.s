@@ -0,0 +1,9 @@
+; Sends the character in a0 to the UART, gp points to the IO page
+putc:
+SW      a0, gp, 8       ; (1 << IO_UART_DAT_bit + 2)
+LI      t0, 0x200       ; Test bit 9 (status bit) below
+putc_loop:
+LW      t1, gp, 0x10    ; (1 << IO_UART_CNTL_bit + 2)
+AND     t1, t1, t0      ; Test
+BNEZ    t1, putc_loop
+RET
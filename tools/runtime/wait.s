@@ -0,0 +1,9 @@
+; Waits for (1 << slow_bit) loop iterations, slow_bit is a constant of the
+; program that includes this file
+wait:
+LI      t0, 1
+SLLI    t0, t0, slow_bit
+wait_loop:
+ADDI    t0, t0, -1
+BNEZ    t0, wait_loop
+RET